@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+""" This script checks and times the vectorised window averaging of the CII map against the average_el_Xel_FPC_FPS generator
+
+Usage: Benchmark_CII_Window_Averaging.py Recorded_TelmetryFile.tlm[:StartTime:EndTime]
+"""
+import sys
+import time
+import numpy as np
+from Telemetry_Processing import process_raw_data_dict, load_pickle_data_dict_file
+from Telemetry_CII_Map import average_el_Xel_FPC_FPS, iterate_dense_window_blocks, WINDOW_SMOOTH
+
+def compare_window_averages(data_dict,window=WINDOW_SMOOTH):
+    """ Returns the number of windows in which the dense arrays differ from the average_el_Xel_FPC_FPS generator output """
+    windows = average_el_Xel_FPC_FPS(data_dict,window=window)
+    n_bad = 0
+    for el_median, xel_median, fpc_bins, fps_median, updown_median in iterate_dense_window_blocks(data_dict,window=window):
+        bin_index = {fpc:b for b,fpc in enumerate(fpc_bins)}
+        for w in range(len(el_median)):
+            generator_window = next(windows,None)
+            if generator_window is None:
+                n_bad += 1  # Window missing in the generator output
+                continue
+            mean_el, mean_xel, FPC_dict, FPC_dict_UD = generator_window
+            dense_bins = set(fpc_bins[~np.isnan(fps_median[w])])
+            if ((mean_el != el_median[w]) or (mean_xel != xel_median[w]) or (dense_bins != set(FPC_dict.keys())) or
+                any((FPC_dict[fpc] != fps_median[w,bin_index[fpc]]) or (FPC_dict_UD[fpc] != updown_median[w,bin_index[fpc]]) for fpc in FPC_dict)):
+                n_bad += 1
+    n_bad += sum(1 for _ in windows)  # Windows missing in the dense arrays
+    return n_bad
+
+if __name__ == '__main__':
+    data_dict = load_pickle_data_dict_file(sys.argv[1])
+    data_dict = process_raw_data_dict(data_dict)
+    print('Loaded {0} frames from {1}'.format(len(data_dict['FPC 1']),sys.argv[1]))
+
+    n_bad = compare_window_averages(data_dict)
+    if n_bad:
+        sys.exit('ERROR: {0} windows differ between the dense arrays and the average_el_Xel_FPC_FPS generator'.format(n_bad))
+    print('Dense window averages match the average_el_Xel_FPC_FPS generator')
+
+    t0 = time.perf_counter()
+    n_windows = sum(1 for _ in average_el_Xel_FPC_FPS(data_dict,window=WINDOW_SMOOTH))
+    t_generator = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    for _ in iterate_dense_window_blocks(data_dict,window=WINDOW_SMOOTH):
+        pass
+    t_dense = time.perf_counter()-t0
+    print('{0} windows of {1} frames'.format(n_windows,WINDOW_SMOOTH))
+    print('average_el_Xel_FPC_FPS generator : {0:8.3f} s'.format(t_generator))
+    print('average_el_Xel_FPC_FPS_dense     : {0:8.3f} s | speedup x{1:.1f}'.format(t_dense,t_generator/t_dense))
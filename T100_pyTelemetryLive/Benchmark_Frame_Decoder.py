@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" This script compares the speed of the numpy frame decoder against the old per word hex string decoding of the UDP packets
+
+Usage: Benchmark_Frame_Decoder.py [NumberOfPackets]
+"""
+import sys
+import time
+import numpy as np
+from Telemetry_Frame_Decoder import load_telemetry_word_file, build_frame_layout, decode_packet, decode_packets
+from Telemetry_Frame_Decoder import words_to_extract
+
+def decode_packet_per_word(message,word_dict,words=words_to_extract):
+    """ Old decoding of the packet, one word at a time via hex strings. Kept here for reference and benchmark """
+    row = []
+    for w_name in words:
+        i = word_dict[w_name] + 5  # Add 5 since the Telemetry words start there
+        word = message[i*2+1+1:i*2+2+1]+message[i*2+1:i*2+1+1] # Swap the bytes to make LSM into MSB
+        row.append(int(word.hex(),16)//2)  # Shift one parity byte out by diving by 2 in decimal
+    row.append(int(message[4:6].hex()))
+    row.append(int(message[6:7].hex()))
+    row.append(int(message[7:8].hex()))
+    row.append(int(message[8:9].hex()))
+    row.append(int(message[9:11].hex()))
+    return row
+
+def random_packets(n_packets,packet_length,seed=0):
+    """ Returns a list of random packets with a valid BCD time stamp prefix """
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0,256,size=(n_packets,packet_length),dtype=np.uint8)
+    bcd_digits = rng.integers(0,10,size=(n_packets,7,2),dtype=np.uint8)
+    raw[:,4:11] = bcd_digits[:,:,0]*16 + bcd_digits[:,:,1]
+    return [bytes(row) for row in raw]
+
+def time_it(func,repeat=3):
+    """ Returns the best of `repeat` wall clock times of func() """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best,time.perf_counter()-t0)
+    return best
+
+if __name__ == '__main__':
+    try:
+        n_packets = int(sys.argv[1])
+    except IndexError:
+        n_packets = 20000
+
+    word_dict = load_telemetry_word_file()
+    layout = build_frame_layout(word_dict,words_to_extract)
+    packets = random_packets(n_packets,layout['packet_length'])
+
+    # First make sure both decoders agree
+    reference = np.array([decode_packet_per_word(message,word_dict) for message in packets])
+    if not (np.array_equal(reference,decode_packets(packets,layout)) and
+            np.array_equal(reference,[decode_packet(message,layout) for message in packets])):
+        sys.exit('ERROR: Frame decoder output does not match the per word decoding')
+
+    results = [('Per word hex decoding', time_it(lambda: [decode_packet_per_word(message,word_dict) for message in packets])),
+               ('decode_packet per packet', time_it(lambda: [decode_packet(message,layout) for message in packets])),
+               ('decode_packets in batch', time_it(lambda: decode_packets(packets,layout)))]
+
+    print('Decoding {0} packets of {1} words + time stamp'.format(n_packets,len(words_to_extract)))
+    for name,t in results:
+        print('{0:<28s}: {1:8.3f} s | {2:8.2f} us/packet | {3:10.0f} packets/s | speedup x{4:.1f}'.format(name,t,t/n_packets*1e6,n_packets/t,results[0][1]/t))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+""" This script runs reproducible end to end benchmarks of the telemetry pipeline on synthetic telemetry, to catch performance regressions
+
+Usage: Benchmark_Pipeline.py [processing|recorder|capture|all] [ResultsFile.json] [BaselineResultsFile.json]
+
+processing : Time of process_raw_data_dict, interpolate_FPC_values, the CII map window averaging and its background subtraction and flux at several data sizes
+recorder   : Time the recorder takes to write out the frames captured during one of its sleeps, and its lag behind the FIFO
+capture    : Frames per second Capture_UDP_Telemetry_live.py sustains. Synthetic frames are sent at several rates to a
+             capture process listening on the loopback, and the frames missing in its FIFO ring buffer are counted as lost.
+
+The results are saved in the optional ResultsFile.json (give - to not save them). If a BaselineResultsFile.json (saved by an earlier run) is given,
+the results which are worse than the baseline by more than REGRESSION_TOLERANCE are reported, and the script exits with an error.
+"""
+import os
+import sys
+import io
+import json
+import time
+import signal
+import shutil
+import socket
+import tempfile
+import platform
+import subprocess
+from contextlib import redirect_stdout
+import numpy as np
+from Benchmark_Frame_Decoder import time_it
+from Telemetry_Synthetic_Generator import SyntheticTelemetryGenerator, send_packets
+from Telemetry_Ring_Buffer import TelemetryRingBuffer, is_ring_buffer_file
+from Telemetry_Recording_File import RecordingWriter
+from Telemetry_Recording_Pyramid import RecordingPyramidWriter
+from Telemetry_Derived_Channels import DerivedChannelWriter
+from Telemetry_Frame_Decoder import timestamp_ticks
+from Telemetry_Processing import process_raw_data_dict, interpolate_FPC_values, strip_data_outside_timestamp
+from Telemetry_CII_Map import average_el_Xel_FPC_FPS, average_el_Xel_FPC_FPS_dense, StreamingCIIMap, WINDOW_SMOOTH
+
+PROCESSING_SIZES = [1000, 10000, 100000]  # Number of frames
+OLD_AVERAGING_MAX_FRAMES = 100000  # The average_el_Xel_FPC_FPS generator is too slow for larger sizes
+RECORDER_RATES = [1000, 10000]  # Frames per second
+RECORDER_POLL_SECONDS = 2.  # Sleep of Record_Captured_Telemetry.py between its saves
+CAPTURE_RATES = [1000, 5000, 20000, 50000, 100000]  # Frames per second
+CAPTURE_SECONDS = 3.  # Duration of sending at each rate
+CAPTURE_UDP_PORT = 5099  # Not the control room port 5000, so that a running capture is not disturbed
+SEED = 0
+
+REGRESSION_TOLERANCE = 1.25  # Fraction by which a result can be worse than the baseline
+REGRESSION_SLACK = 1e-3  # Absolute slack for the results which are close to zero (seconds or loss fraction)
+
+
+def quietly(func):
+    """ Returns a function which calls func without letting it print """
+    def quiet_func():
+        with redirect_stdout(io.StringIO()):
+            return func()
+    return quiet_func
+
+
+def benchmark_processing(sizes=PROCESSING_SIZES):
+    """ Returns the dictionary of the processing times (seconds) at each of the data sizes """
+    results = {}
+    for n_frames in sizes:
+        raw_data_dict = strip_data_outside_timestamp(SyntheticTelemetryGenerator(seed=SEED).frames(n_frames))
+        results['process_raw_data_dict {0} frames seconds'.format(n_frames)] = \
+            time_it(quietly(lambda: process_raw_data_dict(dict(raw_data_dict))))
+        data_dict = quietly(lambda: process_raw_data_dict(dict(raw_data_dict)))()
+        results['interpolate_FPC_values {0} frames seconds'.format(n_frames)] = \
+            time_it(quietly(lambda: interpolate_FPC_values(dict(data_dict))))
+        if n_frames <= OLD_AVERAGING_MAX_FRAMES:
+            results['average_el_Xel_FPC_FPS {0} frames seconds'.format(n_frames)] = \
+                time_it(lambda: sum(1 for _ in average_el_Xel_FPC_FPS(data_dict,window=WINDOW_SMOOTH)),repeat=1)
+        results['average_el_Xel_FPC_FPS_dense {0} frames seconds'.format(n_frames)] = \
+            time_it(lambda: average_el_Xel_FPC_FPS_dense(data_dict,window=WINDOW_SMOOTH))
+        dense_windows = average_el_Xel_FPC_FPS_dense(data_dict,window=WINDOW_SMOOTH)
+        results['StreamingCIIMap.add_windows {0} frames seconds'.format(n_frames)] = \
+            time_it(lambda: StreamingCIIMap().add_windows(*dense_windows))
+    return results
+
+
+def benchmark_recorder(rates=RECORDER_RATES,poll_seconds=RECORDER_POLL_SECONDS,n_polls=5,ring_capacity=65536):
+    """ Returns the dictionary of the recorder write time and lag (seconds), and the frames it lost, at each of the frame rates.
+    Each poll of the recorder reads the new frames from the FIFO ring buffer and appends them to the recording file, its pyramid and derived channels,
+    like Record_Captured_Telemetry.py does after each of its sleeps."""
+    results = {}
+    directory = tempfile.mkdtemp(prefix='T100_benchmark_')
+    try:
+        for rate in rates:
+            generator = SyntheticTelemetryGenerator(frame_rate=rate,seed=SEED)
+            ring_buffer = TelemetryRingBuffer.create(os.path.join(directory,'ring'),generator.layout['columns'],ring_capacity)
+            writer = RecordingWriter(os.path.join(directory,'recording.tlm'),ring_buffer.columns)
+            pyramid_writer = RecordingPyramidWriter(os.path.join(directory,'recording.tlm'),ring_buffer.columns)
+            derived_writer = DerivedChannelWriter(os.path.join(directory,'recording.tlm'))
+            read_cursor = None
+            last_ticks = -1
+            write_times = []
+            n_lost = 0
+            for _ in range(n_polls):
+                ring_buffer.append(generator.rows(int(rate*poll_seconds)))  # Frames captured during one sleep of the recorder
+                t0 = time.perf_counter()
+                data_dict, write_count = ring_buffer.read(since=read_cursor)
+                if read_cursor is not None:
+                    n_lost += write_count - read_cursor - len(data_dict['DAY'])
+                read_cursor = write_count
+                ticks = timestamp_ticks(data_dict)
+                first_new = int(np.searchsorted(ticks,last_ticks,side='right'))
+                new_data_dict = {w_name:data_dict[w_name][first_new:] for w_name in writer.columns}
+                writer.append(new_data_dict,time_ticks=ticks[first_new:])
+                writer.sync()
+                pyramid_writer.append(new_data_dict)
+                pyramid_writer.flush()
+                derived_writer.append(new_data_dict)
+                derived_writer.flush()
+                last_ticks = ticks[-1]
+                write_times.append(time.perf_counter()-t0)
+            writer.close()
+            pyramid_writer.close()
+            derived_writer.close()
+            ring_buffer.close()
+            results['recorder write {0} frames/s seconds'.format(rate)] = max(write_times)
+            results['recorder lag {0} frames/s seconds'.format(rate)] = poll_seconds + max(write_times)
+            results['recorder lost {0} frames/s frames'.format(rate)] = n_lost
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def benchmark_capture(rates=CAPTURE_RATES,duration=CAPTURE_SECONDS,udp_port=CAPTURE_UDP_PORT):
+    """ Returns the dictionary of the frames lost (fraction) by Capture_UDP_Telemetry_live.py at each of the frame rates,
+    the rate at which the frames were actually sent, and the highest rate without any loss """
+    results = {}
+    directory = tempfile.mkdtemp(prefix='T100_benchmark_')
+    ring_filename = os.path.join(directory,'ring')
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    capture = subprocess.Popen([sys.executable,'Capture_UDP_Telemetry_live.py',ring_filename,str(udp_port)],
+                               cwd=script_directory,stdout=subprocess.DEVNULL)
+    try:
+        t0 = time.time()
+        while not (os.path.exists(ring_filename) and is_ring_buffer_file(ring_filename)):
+            if (capture.poll() is not None) or (time.time() - t0 > 30):
+                raise RuntimeError('Capture_UDP_Telemetry_live.py did not start')
+            time.sleep(0.1)
+        time.sleep(1)  # Let it bind the socket
+        ring_buffer = TelemetryRingBuffer(ring_filename)
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        generator = SyntheticTelemetryGenerator(seed=SEED)
+        lossless_rate = 0
+        for rate in rates:
+            packets = generator.packets(int(rate*duration))
+            start_count = ring_buffer.write_count
+            send_time = send_packets(sock,packets,('127.0.0.1',udp_port),packets_per_second=rate)
+            time.sleep(1)  # Let the capture drain its queues
+            n_received = ring_buffer.write_count - start_count
+            loss = 1 - n_received/len(packets)
+            results['capture loss at {0} frames/s fraction'.format(rate)] = loss
+            results['capture sent at {0} frames/s frames/s'.format(rate)] = len(packets)/send_time
+            if loss == 0:
+                lossless_rate = max(lossless_rate,len(packets)/send_time)
+        results['capture highest lossless frames/s'] = lossless_rate
+        sock.close()
+        ring_buffer.close()
+    finally:
+        capture.send_signal(signal.SIGINT)
+        try:
+            capture.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            capture.kill()
+        shutil.rmtree(directory)
+    return results
+
+
+def is_regression(name,value,baseline_value):
+    """ Returns True if the result is worse than the baseline by more than the tolerance """
+    if name.endswith('frames/s'): # Higher is better
+        return value < baseline_value/REGRESSION_TOLERANCE
+    return value > baseline_value*REGRESSION_TOLERANCE + REGRESSION_SLACK
+
+BENCHMARKS = {'processing':benchmark_processing, 'recorder':benchmark_recorder, 'capture':benchmark_capture}
+
+if __name__ == '__main__':
+    try:
+        selected = sys.argv[1]
+    except IndexError:
+        selected = 'all'
+    benchmark_names = list(BENCHMARKS) if selected == 'all' else [selected]
+
+    results = {}
+    for benchmark_name in benchmark_names:
+        print('Running {0} benchmark'.format(benchmark_name),flush=True)
+        benchmark_results = BENCHMARKS[benchmark_name]()
+        for name,value in benchmark_results.items():
+            print('   {0:<56s} {1:12.6g}'.format(name,value),flush=True)
+        results.update(benchmark_results)
+
+    if sys.argv[2:] and (sys.argv[2] != '-'):
+        with open(sys.argv[2],'w') as resultsfile:
+            json.dump({'time':time.time(),'python':platform.python_version(),'numpy':np.__version__,
+                       'machine':platform.node(),'results':results},resultsfile,indent=1)
+        print('Saved the results in {0}'.format(sys.argv[2]))
+
+    if sys.argv[3:]:
+        with open(sys.argv[3],'r') as baselinefile:
+            baseline = json.load(baselinefile)['results']
+        regressions = [name for name in results if (name in baseline) and is_regression(name,results[name],baseline[name])]
+        for name in regressions:
+            print('REGRESSION: {0} is {1:.6g}, baseline {2:.6g}'.format(name,results[name],baseline[name]))
+        if regressions:
+            sys.exit('ERROR: {0} results are worse than the baseline {1}'.format(len(regressions),sys.argv[3]))
+        print('No regressions against the baseline {0}'.format(sys.argv[3]))
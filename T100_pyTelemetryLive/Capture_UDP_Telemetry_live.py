@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 """ This script is to capture the telemetry live broadcasted via UDP in the control room 
 
+Usage: Capture_UDP_Telemetry_live.py [RingBufferFile] [UDP_PORT]
+
+By default the FIFO ring buffer is /mnt/tmp_fast/T100_data_ring_buffer.ring and the UDP port is 5000.
+The decoded frames are also published to the subscribers of the Unix domain socket beside it (see Telemetry_PubSub.py),
+by default /mnt/tmp_fast/T100_data_ring_buffer.sock
+
 Last updated: JPN 20221123
 """
 #########################################################
@@ -11,110 +17,155 @@ Last updated: JPN 20221123
 # sudo systemctl stop firewalld
 # sudo systemctl status firewalld
 #########################################################
-import socket
-import binascii
-from collections import deque
-import pickle
 import sys
 import signal
+import threading
+import queue
+import time
+from Telemetry_Frame_Decoder import load_telemetry_word_file, build_frame_layout, decode_packets
+from Telemetry_Frame_Decoder import words_to_extract
+from Telemetry_Ring_Buffer import TelemetryRingBuffer
+from Telemetry_PubSub import TelemetryPublisher, pubsub_socket_path
+from Telemetry_UDP_Receiver import open_udp_socket, receive_packet_batch, FrameGapDetector, DEFAULT_RECEIVE_BUFFER_BYTES
+from Telemetry_Metrics import PipelineMetrics
 
 # Fast tmpfs file to chache FIFO data stram
-data_output_filename = '/mnt/tmp_fast/T100_data_queue_dict.pkl'
-
-def load_telemetry_word_file():
-    """ Returns a dictionary of the words and the position number in a frame from the Telemetry definition file TelemetryFrameWords.txt"""
-    word_dict = {}
-    with open('TelemetryFrameWords.txt','r') as framewordfile:
-        for line in framewordfile:
-            line = line.rstrip()
-            if len(line.split()) > 1:
-                word_dict[' '.join(line.split()[1:])] = int(line.split()[0])
-    return word_dict
-
-# Load the word number dictionary to interpret frame data
-word_dict = load_telemetry_word_file()
+try:
+    data_output_filename = sys.argv[1]
+except IndexError:
+    data_output_filename = '/mnt/tmp_fast/T100_data_ring_buffer.ring'
 
-# Only the following selected words are extracted from the frame and saved into the FIFO file
-words_to_extract = ['SYNC 0','SYNC 1','SYNC 2']+\
-                   ['MAG - I','MAG - II','Coarse Elev. S. E.']+\
-                   ['PDA No. {0}'.format(i+1) for i in range(8)]+\
-                   ['DC PDA {0}'.format(i+1) for i in range(8)]+\
-                   ['S.T. Elev. Error','S.T. Xelev. Error']+\
-                   ['Fine Elev. S. E.','Fine Xelev. S. E.']+\
-                   ['Time H','Time L','Command Address','Command Data','Frame Number']+\
-                   ['FPC COUNTER','DET SIGNAL','FPS SCAN STATUS']+\
-                   ['FPS {0} L'.format(i+1) for i in range(4)]+\
-                   ['FPS {0} H'.format(i+1) for i in range(4)]
+# Load the word number dictionary to interpret frame data and build the frame layout once
+word_dict = load_telemetry_word_file()
+frame_layout = build_frame_layout(word_dict,words_to_extract)
+#FIFO queue to stor the last N frame points
+buffer_size = 65536  # Size of the FIFO ring buffer. Writing a frame costs the same for any size
+print_count = 11 # Print the time stamp after receiving these many number of frames
 
+max_batch_packets = 256  # Maximum number of packets drained from the socket in one go
+packet_queue_size = 1024  # Maximum number of packet batches waiting for the writer thread. Batches are dropped (and counted) if it is full
+METRICS_PROFILE_EVERY = None  # Set to N to run 1 in N packet batches of the writer under cProfile
 
-extra_frameprefix_keywords = ['DAY','HH','MM','SEC','MSEC']
-#FIFO queue to stor the last N frame points
-buffer_size = 1000  # Size of the FIFO queue
-file_write_count = 11 # Write the FIFO file out after receiving these many number of frames
+# Pipeline health metrics, see Watch_Pipeline_Metrics.py. Only the writer thread updates them.
+metrics = PipelineMetrics('capture',profile_every=METRICS_PROFILE_EVERY)
 
-# Initialise the FIFO dictionary for all the words with 0
-data_queue_dict = {}
-for w in words_to_extract + extra_frameprefix_keywords:
-    data_queue_dict[w] = deque([0]*buffer_size,maxlen=buffer_size)
+# Initialise the FIFO ring buffer file for all the words
+ring_buffer = TelemetryRingBuffer.create(data_output_filename,frame_layout['columns'],buffer_size)
+# Publish the new frames to the recorder and plots which subscribe, instead of polling the ring buffer
+publisher = TelemetryPublisher(pubsub_socket_path(data_output_filename),frame_layout['columns'])
 
 
 ###############################  Setup socket object to capture UDP packets
 UDP_IP = "0.0.0.0"
-UDP_PORT = 5000
+try:
+    UDP_PORT = int(sys.argv[2])
+except IndexError:
+    UDP_PORT = 5000
+UDP_RECEIVE_BUFFER_BYTES = DEFAULT_RECEIVE_BUFFER_BYTES
 
-s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)  # UDP
-s.bind((UDP_IP,UDP_PORT))
+s = open_udp_socket(UDP_IP,UDP_PORT,receive_buffer_bytes=UDP_RECEIVE_BUFFER_BYTES)
 ###############################
 
+# The receiver (main thread) only drains the socket, and the writer thread decodes the packets, writes them to the FIFO and prints
+packet_queue = queue.Queue(maxsize=packet_queue_size)
+stop_event = threading.Event()
+gap_detector = FrameGapDetector()
+n_queue_dropped = 0  # Packets dropped because the writer thread could not keep up
+n_queue_dropped_reported = 0
+last_time_stamp = 0
+last_command = (0,0)  # Command before the first frame, as in the FIFO initialised with 0, so that the first command received is printed
+f_c = 0
+
+def process_packet_batch(receive_time,packets):
+    """ Decodes the packet batch, checks for lost frames, writes them to the FIFO and prints the status """
+    global last_time_stamp, last_command, f_c, n_queue_dropped_reported
+    metrics.observe('queue_wait_seconds',time.time()-receive_time)
+    metrics.set_gauge('packet_queue_depth',packet_queue.qsize())
+    metrics.set_gauge('batch_packets',len(packets))
+    metrics.count('packets_received',len(packets))
+    if n_queue_dropped > n_queue_dropped_reported:
+        print('WARNING: Writer is not keeping up. Dropped {0} frames in the writer queue so far'.format(n_queue_dropped))
+        metrics.count('packets_dropped_in_queue',n_queue_dropped-n_queue_dropped_reported)
+        n_queue_dropped_reported = n_queue_dropped
+    packets = [message for message in packets if len(message) >= frame_layout['packet_length']] # Ignore truncated packets
+    if not packets:
+        return
+    with metrics.timer('decode_seconds'):
+        rows = decode_packets(packets,frame_layout)
+    with metrics.timer('fifo_write_seconds'):
+        ring_buffer.append(rows,receive_time=receive_time)
+    with metrics.timer('publish_seconds'):
+        publisher.publish(rows,ring_buffer.write_count,receive_time)
+    metrics.set_gauge('subscribers',publisher.n_subscribers)
+    metrics.set_gauge('subscriber_batches_dropped',publisher.n_dropped)
+    frames = dict(zip(frame_layout['columns'],rows.T))
+
+    n_lost = gap_detector.update(frames['Frame Number'],frames['Time H'],frames['Time L'])
+    if n_lost > 0:
+        print('WARNING: Lost {0} frames. Total lost {1} of {2} frames'.format(n_lost,gap_detector.n_lost,gap_detector.n_frames+gap_detector.n_lost))
+        metrics.count('frames_lost',n_lost)
+
+    # Print if the latest command reported in telemetry changes form the one before
+    for command in zip(frames['Command Address'].tolist(),frames['Command Data'].tolist()):
+        if command != last_command:
+            print(oct(command[0]),oct(command[1]))
+            last_command = command
+
+    f_c += len(packets)
+    if f_c > print_count: # Print the time stamp if we reached the count
+        frame = {w_name:int(frames[w_name][-1]) for w_name in frames}
+        last_time_stamp = frame['DAY'] + frame['HH']/24. +\
+                          frame['MM']/(24*60.) + frame['SEC']/(24*60*60.) +\
+                          frame['MSEC']/(24*60*60*10000.)
+        print('Time:{0} | {1}T{2}:{3}:{4}:{5} | TCounter {6} H {7} L'.format(last_time_stamp,frame['DAY'],
+                                                                             frame['HH'],frame['MM'],
+                                                                             frame['SEC'],frame['MSEC'],
+                                                                             frame['Time H'],frame['Time L']))
+        # print('T Counter {0} ; Frame Number {1}'.format(frame['Time H']*4096 + frame['Time L'] , frame['Frame Number']))
+        f_c = 0
+
+def telemetry_writer():
+    """ Writer thread: processes the packet batches from the packet_queue till the capture is stopped """
+    while not (stop_event.is_set() and packet_queue.empty()):
+        try:
+            receive_time, packets = packet_queue.get(timeout=0.5)
+        except queue.Empty:
+            metrics.maybe_write()
+            continue
+        with metrics.profiled('writer_batch_seconds'):
+            process_packet_batch(receive_time,packets)
+        metrics.maybe_write()
+
+writer_thread = threading.Thread(target=telemetry_writer,name='telemetry_writer',daemon=True)
+
 # Function to cleanup and exit if Cntrl+C is pressed.
-data_stream_started = False
 def handler(signum, frame):
     """ Gets called when an interrupt signal is received """
+    if stop_event.is_set():
+        return  # Already stopping
     print('Cntrl +C Received. Stopping.')
-    if data_stream_started:
-        print('Saving file and stoping at time {0}.'.format(last_time_stamp))
-        with open(data_output_filename,'wb') as datafile:
-            pickle.dump(data_queue_dict,datafile)
+    stop_event.set()
+    writer_thread.join()
+    print('Stoping at time {0}. Last {1} frames are in {2}'.format(last_time_stamp,buffer_size,data_output_filename))
+    print('Received {0} frames. Lost {1} frames in {2} gaps. Dropped {3} frames in the writer queue'.format(gap_detector.n_frames,gap_detector.n_lost,
+                                                                                                          gap_detector.n_gaps,n_queue_dropped))
+    metrics.maybe_write(force=True)
+    publisher.close()
+    ring_buffer.close()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, handler)
 
 ############################################################################
 print('Starting Telemetry Capture to {0}'.format(data_output_filename))
-f_c = 0
+writer_thread.start()
 while True:
-    message, addr = s.recvfrom(4096)
-    data_stream_started = True
-    # print("Raw msg : ",message,addr)
-    # print(len(message[11:]))
-    for w_name in words_to_extract:
-        i = word_dict[w_name] + 5  # Add 5 since the Telemetry words start there
-        word = message[i*2+1+1:i*2+2+1]+message[i*2+1:i*2+1+1] # Swap the bytes to make LSM into MSB
-        value = int(word.hex(),16)//2  # Shift one parity byte out by diving by 2 in decimal
-        # print(w_name,value)
-        data_queue_dict[w_name].append(value)
-    # also save the time stamp prefix in hex format sent along with the UDP packet
-    data_queue_dict['DAY'].append(int(message[4:6].hex()))
-    data_queue_dict['HH'].append(int(message[6:7].hex()))
-    data_queue_dict['MM'].append(int(message[7:8].hex()))
-    data_queue_dict['SEC'].append(int(message[8:9].hex()))
-    data_queue_dict['MSEC'].append(int(message[9:11].hex()))
-    # Print if the latest command reported in telemetry changes form the one before
-    if (data_queue_dict['Command Address'][-1],data_queue_dict['Command Data'][-1]) != (data_queue_dict['Command Address'][-2],data_queue_dict['Command Data'][-2]):
-        print(oct(data_queue_dict['Command Address'][-1]),oct(data_queue_dict['Command Data'][-1]))
-    if f_c > file_write_count: # Overwrite the FIFO file on the disk if we reached the count
-        last_time_stamp = data_queue_dict['DAY'][-1] + data_queue_dict['HH'][-1]/24. +\
-                          data_queue_dict['MM'][-1]/(24*60.) + data_queue_dict['SEC'][-1]/(24*60*60.) +\
-                          data_queue_dict['MSEC'][-1]/(24*60*60*10000.)
-        print('Time:{0} | {1}T{2}:{3}:{4}:{5} | TCounter {6} H {7} L'.format(last_time_stamp,data_queue_dict['DAY'][-1],
-                                                                             data_queue_dict['HH'][-1],data_queue_dict['MM'][-1],
-                                                                             data_queue_dict['SEC'][-1],data_queue_dict['MSEC'][-1],
-                                                                             data_queue_dict['Time H'][-1],data_queue_dict['Time L'][-1]))
-        # print('T Counter {0} ; Frame Number {1}'.format(data_queue_dict['Time H'][-1]*4096 + data_queue_dict['Time L'][-1] , data_queue_dict['Frame Number'][-1]))
-        with open(data_output_filename,'wb') as datafile:
-            pickle.dump(data_queue_dict,datafile)
-        f_c = 0
-    else:
-        f_c += 1
+    packets = receive_packet_batch(s,max_batch=max_batch_packets)
+    if not packets:
+        continue
+    try:
+        packet_queue.put_nowait((time.time(),packets))
+    except queue.Full:
+        n_queue_dropped += len(packets)  # Reported by the writer thread
 print('End')
 ############################################################################
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+""" This script converts the old pickled telemetry recordings into the chunked binary recording format
+
+Usage: Convert_Pickle_Recording.py Recorded_TelmetryFile.pkl Recorded_TelmetryFile.tlm
+"""
+import sys
+import pickle
+import numpy as np
+from Telemetry_Recording_File import RecordingWriter
+from Telemetry_Frame_Decoder import timestamp_ticks
+
+def convert_pickle_recording(pickle_filename,output_filename):
+    """ Converts the pickled dictionary recording into the chunked recording file. Returns the number of frames converted """
+    with open(pickle_filename,'rb') as pdatafile:
+        data_dict = pickle.load(pdatafile)
+    data_dict = {w_name:np.array(data_dict[w_name],dtype=np.uint16) for w_name in data_dict}
+    # The recording should be in time order, without the zero time stamp frames of the initial FIFO buffer
+    time_ticks = timestamp_ticks(data_dict)
+    time_order = np.argsort(time_ticks,kind='stable')
+    time_order = time_order[time_ticks[time_order] > 0]
+    data_dict = {w_name:data_dict[w_name][time_order] for w_name in data_dict}
+    writer = RecordingWriter(output_filename,list(data_dict.keys()))
+    writer.append(data_dict,time_ticks=time_ticks[time_order])
+    writer.close()
+    return writer.n_frames
+
+if __name__ == '__main__':
+    n_frames = convert_pickle_recording(sys.argv[1],sys.argv[2])
+    print('Converted {0} frames from {1} into {2}'.format(n_frames,sys.argv[1],sys.argv[2]))
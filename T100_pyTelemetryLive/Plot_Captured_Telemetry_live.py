@@ -1,200 +1,219 @@
 #!/usr/bin/env python
 """ This script is to plot captured telemetry from the file 
-Usage: Plot_Captured_Telemetry_live.py [RecorderdTelemetryFile.pkl:StartTime:EndTime]
-If no RecorderdTelemetryFile.pkl is prvided, it will plot /mnt/tmp_fast/T100_data_queue_dict.pkl
+Usage: Plot_Captured_Telemetry_live.py [RecorderdTelemetryFile.tlm:StartTime:EndTime]
+RecorderdTelemetryFile can be a recording from Record_Captured_Telemetry.py or an old pickled .pkl recording.
+If no RecorderdTelemetryFile.tlm is prvided, it will plot the live FIFO ring buffer /mnt/tmp_fast/T100_data_ring_buffer.ring
 
 Start and End times are in the unit of day of the year. They are optional.
 
 Last updated: JPN 20221123
 """
-import pickle
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib import style
 import numpy as np
 import sys
+import time
+from Telemetry_Metrics import PipelineMetrics
+from Telemetry_Ring_Buffer import is_ring_buffer_file
+from Telemetry_PubSub import LiveFrameReader
+from Telemetry_Recording_File import is_recording_file
+from Telemetry_Recording_Pyramid import RecordingPyramid, build_recording_pyramid, is_recording_pyramid_current, RAW_LEVEL
+from Telemetry_Frame_Decoder import TICKS_PER_DAY, day_of_year_to_ticks
+from Telemetry_Processing import load_pickle_data_dict_file, strip_data_outside_timestamp, process_raw_data_dict, FPCTriangleWaveform, IncrementalDataProcessor
 
 REFRESH_RATE = 1000  # Refresh rate of plot in milliseconds
-
-# If user provided a custom file, use that, otherwise use the default live telemetry pkl file
+LIVE_PLOT_FRAMES = 1000  # Number of latest frames to plot from the live FIFO ring buffer
+INCREMENTAL_PROCESSING = True  # Process only the new frames from the live FIFO ring buffer on each refresh
+METRICS_PROFILE_EVERY = None  # Run 1 in N refreshes under cProfile (see Watch_Pipeline_Metrics.py). None to disable
+BLITTED_RENDERING = True  # Only redraw the lines of the words on each refresh (see BlittedWordPlot). False to redraw the whole figure
+PLOT_PDA_FPS_WORDS = False  # Also plot all the PDA and FPS words
+SUBSCRIBE_TO_CAPTURE = True  # Receive the new frames from the capture script (see Telemetry_PubSub.py) instead of polling the live FIFO ring buffer
+RECORDING_LOD_BROWSING = True  # Plot recordings from their level of detail pyramid (see Telemetry_Recording_Pyramid.py) at the resolution of the view
+
+# If user provided a custom file, use that, otherwise use the default live telemetry FIFO ring buffer file
 try:
     TELEMETRY_INPUT_FILE = sys.argv[1]
 except IndexError:
-    TELEMETRY_INPUT_FILE = '/mnt/tmp_fast/T100_data_queue_dict.pkl'
-
-def load_pickle_data_dict_file(raw_data_dict_file):
-    """ Loads pickled dictionary file inside the optional time interval defined by :Start:End suffix"""
-    try:
-        start_time = float(raw_data_dict_file.split(':')[1])
-    except (IndexError, ValueError):
-        start_time = ''
-    try:
-        end_time = float(raw_data_dict_file.split(':')[2])
-    except (IndexError, ValueError):
-        end_time = ''
-    data_dict_file = raw_data_dict_file.split(':')[0]
-
-    # Read the pickled file first and ask pickle to deserialise to python dictionay object
-    read_data = open(data_dict_file,'rb').read()
-    full_data_dict = pickle.loads(read_data)
-
-    # Strip out any data which is outside the optional Start and End time.
-    data_dict = strip_data_outside_timestamp(full_data_dict,start_t=start_time,end_t=end_time)
-
-    return data_dict
-
-def strip_data_outside_timestamp(data_dict,start_t='',end_t=''):
-    """ Strips out the data before start_1 and after end_t """
-    time_axis = np.array(data_dict['DAY'])+np.array(data_dict['HH'])/24.+\
-                np.array(data_dict['MM'])/(24*60.)+np.array(data_dict['SEC'])/(24*60*60.)+\
-                np.array(data_dict['MSEC'])/(24*60*60*10000.)
-    mask = time_axis > 0 # Initialise mask for all positive time data
-    if start_t is not '':
-        mask[time_axis<start_t] = False
-    if end_t is not '':
-        mask[time_axis>end_t] = False
-    new_dict = {}
-    for w_name in data_dict:
-        new_dict[w_name] = np.array(data_dict[w_name])[mask]
-    return new_dict
-
-
-def process_raw_data_dict(data_queue_dict,MaxDiff=None,maxtp=None,mintp=None):
-    """ This function does all the processing of the raw data dict frames for display"""
-    # Combine the H and L Time counter in telmetry to a new keyword Time HL
-    data_queue_dict['Time HL'] = np.array(data_queue_dict['Time H'])*4096 + np.array(data_queue_dict['Time L'])
-    # Calculate 16bit FPS values by combining the H and L words after shifting to right by 4 bits (divide by 16)
-    for i in range(4):
-        data_queue_dict['FPS {0} HL'.format(i+1)] = np.array(data_queue_dict['FPS {0} H'.format(i+1)])*256//16 + np.array(data_queue_dict['FPS {0} L'.format(i+1)])//16 
-
-    # Extract the Up/DOWN scan bit from the FPS SCAN STATUS word and save it to 'FPC Up/Down'
-    data_queue_dict['FPC Up/Down'] = np.array([int(format(sbit,'b')[-3]) if (len(format(sbit,'b')) > 3) else 0 for sbit in data_queue_dict['FPS SCAN STATUS']])
-
-    # Calculate FPC values for the 4 FPS values inside each frame
-    data_queue_dict = interpolate_FPC_values(data_queue_dict,
-                                             MaxDiff=MaxDiff,maxtp=maxtp,mintp=mintp)
-
-    return data_queue_dict
-
-def interpolate_FPC_values(data_queue_dict,MaxDiff=None,maxtp=None,mintp=None):
-    """
-    Returns the Data dict after interpolating the 4 FPC values in each frame (FPC1,FPC2,FPC3,FPC4), 
-    based on the measured 'FPC COUNTER', which corresponds to FPS3 readout.
-    Assumption is that, the FPC is sampled from a neat triangular waveform.
-    If turning points (maxtp and mintp) are not inputed. It will try to estimate the turning points.
-    But, this needs atleast two points of the measured FPC to be on same ramp of triangle.
-    """
-
-    FPC3_array = np.array(data_queue_dict['FPC COUNTER'])
-
-    # If turning points maxtp and mintp are not provided, we shall estimate them from data.
-    if MaxDiff is None: # This is almost always 520 in fast scan
-        # We take the most frequent difference between the point sas the actuall difference between rows
-        MaxDiff = np.argmax(np.bincount(np.abs(np.diff(FPC3_array))))
-        #----
-        # The command below is slower, but will work for non-integer FPC values also. If ever needed!!
-        # from scipy.stats import mode  # Add this in begining of code.
-        # MaxDiff = mode(np.abs(DataT['rawTele_FPC'][1:]-DataT['rawTele_FPC'][:-1]))[0][0]
-        #----
-    if (maxtp is None) or (mintp is None):
-        # The max turning point can be calculated as (sum of the top most points + Distance between them )/ 2
-        maxtp = np.max((FPC3_array[1:]+FPC3_array[:-1] +MaxDiff)/2)
-        # Similarly, min is the (sum of the bottom most points - Distance between them )/ 2
-        mintp = np.min((FPC3_array[1:]+FPC3_array[:-1] -MaxDiff)/2)
-
-        print('Estimated FPC Triangle Waveform.')
-        print('SampleGap= {0}, MaxTurningPoint= {1}, MinTurningPoint= {2}'.format(MaxDiff,maxtp,mintp))
-
-
-    down_mask = data_queue_dict['FPC Up/Down'] == 0
-
-    # Initialise the new FPC arrays
-    FPC1_array = np.zeros(len(data_queue_dict))
-    FPC2_array = np.zeros(len(data_queue_dict))
-    FPC4_array = np.zeros(len(data_queue_dict))
-
-    # First calculate for up scan # will result in garbage values in down scan
-    FPC1_array = FPC3_array - MaxDiff*2/4.
-    FPC1_array[FPC1_array < mintp] = 2*mintp - FPC1_array[FPC1_array < mintp]
-    FPC2_array = FPC3_array - MaxDiff/4.
-    FPC2_array[FPC2_array < mintp] = 2*mintp - FPC2_array[FPC2_array < mintp]
-    FPC4_array = FPC3_array + MaxDiff/4.
-    FPC4_array[FPC4_array > maxtp] = 2*maxtp - FPC4_array[FPC4_array > maxtp]
-    # Now calculate for the down scan and update the down scan values
-    FPC1_array[down_mask] = FPC3_array[down_mask] + MaxDiff*2/4.
-    FPC1_array[down_mask & (FPC1_array > maxtp)] = 2*maxtp - FPC1_array[down_mask & (FPC1_array > maxtp)]
-    FPC2_array[down_mask] = FPC3_array[down_mask] + MaxDiff/4.
-    FPC2_array[down_mask & (FPC2_array > maxtp)] = 2*maxtp - FPC2_array[down_mask & (FPC2_array > maxtp)]
-    FPC4_array[down_mask] = FPC3_array[down_mask] - MaxDiff/4.
-    FPC4_array[down_mask & (FPC4_array < mintp)] = 2*mintp - FPC4_array[down_mask & (FPC4_array < mintp)]
-
-
-    #######################################
-    #Same as above,but slow. Kept here since this is more easier to understand the logic of the above steps.
-    #######################################
-    # for i,row in enumerate(DataT):
-    #     fpc3 = row['FPC COUNTER']
-
-    #     if int(row['FPC Up/Down']) == 1:  # Scan waveform is going UP
-    #         # Now we should fold the values into the triangular wave if they overshoot turning points
-    #         fpc1 = fpc3 - MaxDiff*2/4. if (fpc3 - MaxDiff*2/4.) > mintp else 2*mintp - (fpc3 - MaxDiff*2/4.)
-    #         fpc2 = fpc3 - MaxDiff/4. if (fpc3 - MaxDiff/4.) > mintp else 2*mintp - (fpc3 - MaxDiff/4.)
-    #         fpc4 = fpc3 + MaxDiff/4. if (fpc3 + MaxDiff/4.) < maxtp else 2*maxtp - (fpc3 + MaxDiff/4.)
-            
-    #     else: # Scan waveform is going DOWN
-    #         fpc1 = fpc3 + MaxDiff*2/4. if (fpc3 + MaxDiff*2/4.) < maxtp else 2*maxtp - (fpc3 + MaxDiff*2/4.)
-    #         fpc2 = fpc3 + MaxDiff/4. if (fpc3 + MaxDiff/4.) < maxtp else 2*maxtp - (fpc3 + MaxDiff/4.)
-    #         fpc4 = fpc3 - MaxDiff/4. if (fpc3 - MaxDiff/4.) > mintp else 2*mintp - (fpc3 - MaxDiff/4.)
-
-    #     # Update the table
-    #     DataT['FPC1'][i] = fpc1
-    #     DataT['FPC2'][i] = fpc2
-    #     DataT['FPC3'][i] = fpc3
-    #     DataT['FPC4'][i] = fpc4
-    #######################################
-
-    data_queue_dict['FPC 1'] = FPC1_array
-    data_queue_dict['FPC 2'] = FPC2_array
-    data_queue_dict['FPC 3'] = FPC3_array
-    data_queue_dict['FPC 4'] = FPC4_array
-
-    # Also add UPSCAN X arrays to identify up and down scans
-    all_FPC_combined = np.dstack([FPC1_array,FPC2_array,FPC3_array,FPC4_array]).flatten()
-    all_FPC_combined_upmask = np.gradient(all_FPC_combined) > 0
-    all_FPC_combined_upmask_reshaped = all_FPC_combined_upmask.reshape(len(FPC1_array),4)
-
-    # 1 is UP and 0 is DOWN as usuall
-    data_queue_dict['UPSCAN 1'] = all_FPC_combined_upmask_reshaped[:,0].astype(int)
-    data_queue_dict['UPSCAN 2'] = all_FPC_combined_upmask_reshaped[:,1].astype(int)
-    data_queue_dict['UPSCAN 3'] = all_FPC_combined_upmask_reshaped[:,2].astype(int)
-    data_queue_dict['UPSCAN 4'] = all_FPC_combined_upmask_reshaped[:,3].astype(int)
-
-    return data_queue_dict
-
+    TELEMETRY_INPUT_FILE = '/mnt/tmp_fast/T100_data_ring_buffer.ring'
 
 def animate(i):
-    try:
-        data_queue_dict = load_pickle_data_dict_file(TELEMETRY_INPUT_FILE)
-    except EOFError:
-        return  # Will update the plot in next refresh.
-    # Do data processing
-    data_queue_dict = process_raw_data_dict(data_queue_dict)
+    """ Refreshes the plot, and records its timing in the metrics """
+    with metrics.profiled('refresh_seconds'):
+        draw_frame(i)
+    metrics.maybe_write()
+
+def draw_frame(i):
+    """ Reads, processes and plots the latest frames """
+    if recording_plot is not None:
+        # Re-query the view, to show the frames recorded since the last refresh
+        with metrics.timer('file_read_seconds'):
+            recording_plot.refresh()
+        return
+    if live_processor is not None:
+        # Read and process only the frames which arrived since the last refresh
+        with metrics.timer('fifo_read_seconds'):
+            new_data_dict = live_reader.read(n_frames=LIVE_PLOT_FRAMES)
+        if len(new_data_dict['DAY']) == 0:
+            return  # Nothing new to process or draw
+        metrics.count('frames_processed',len(new_data_dict['DAY']))
+        with metrics.timer('processing_seconds'):
+            data_queue_dict = live_processor.update(strip_data_outside_timestamp(new_data_dict))
+        if data_queue_dict is None:
+            return  # Not enough frames captured yet
+    else:
+        try:
+            with metrics.timer('file_read_seconds'):
+                data_queue_dict = load_pickle_data_dict_file(TELEMETRY_INPUT_FILE,n_live_frames=LIVE_PLOT_FRAMES)
+        except EOFError:
+            return  # Will update the plot in next refresh.
+        # Do data processing, with the cached FPC triangle waveform once it is estimated
+        with metrics.timer('processing_seconds'):
+            if fpc_waveform.update(data_queue_dict['FPC COUNTER']):
+                data_queue_dict = process_raw_data_dict(data_queue_dict,*fpc_waveform.parameters())
+            else:
+                data_queue_dict = process_raw_data_dict(data_queue_dict)
 
     time_axis = np.array(data_queue_dict['DAY'])+np.array(data_queue_dict['HH'])/24.+\
                 np.array(data_queue_dict['MM'])/(24*60.)+np.array(data_queue_dict['SEC'])/(24*60*60.)+\
                 np.array(data_queue_dict['MSEC'])/(24*60*60*10000.)
+    m = time_axis > 0 # remove data with zero timestamp from plots
+    title = 'FPS STATUS:{0} | Command :{1} {2}'.format(format(data_queue_dict['FPS SCAN STATUS'][-1],'b')[-4:],
+                                                       oct(data_queue_dict['Command Address'][-1]),
+                                                       oct(data_queue_dict['Command Data'][-1]))
+    if word_plot is not None:
+        # The time axis is relative, so show the time of the latest frame in the title
+        title += ' | DAY {0} {1:02d}:{2:02d}:{3:02d}.{4:04d}'.format(*[data_queue_dict[w_name][-1] for w_name in ['DAY','HH','MM','SEC','MSEC']])
+        word_plot.update(time_axis[m],{w_name:np.asarray(data_queue_dict[w_name])[m] for w_name in words_to_extract},title)
+        if live_processor is not None:
+            observe_packet_to_pixel_latency(None)
+        return
+
     ylim = ax1.get_ylim() # Get the previous y axis limits before clearing
     ax1.clear()
-    m = time_axis > 0 # remove data with zero timestamp from plots
     for w_name in words_to_extract:
         ax1.plot(time_axis[m],np.array(data_queue_dict[w_name])[m],marker='.',label=w_name,alpha=.4)
     ax1.set_ylim(ylim)
     ax1.legend()
-    ax1.set_title('FPS STATUS:{0} | Command :{1} {2}'.format(format(data_queue_dict['FPS SCAN STATUS'][-1],'b')[-4:],
-                                                             oct(data_queue_dict['Command Address'][-1]),
-                                                             oct(data_queue_dict['Command Data'][-1])))
+    ax1.set_title(title)
+
+class BlittedWordPlot(object):
+    """ Line plot of the words, which creates its Line2D artists, legend and title once, and only updates their data on each refresh.
+    The rest of the figure is cached as a background image, and each refresh only draws the lines and the title over it (blitting).
+    The time axis is in seconds before the latest frame, so that it stays fixed while the data scrolls through it.
+    The axis limits are set once from the data, and the limits chosen by the user (zoom, pan) are kept. """
+
+    def __init__(self,fig,ax,words):
+        self.fig = fig
+        self.ax = ax
+        self.lines = {w_name:ax.plot([],[],marker='.',label=w_name,alpha=.4)[0] for w_name in words}
+        # The legend is placed beside the axes, so that it stays in the background without the lines drawn over it.
+        # It is created before the lines are animated, since the legend copies their properties
+        n_columns = 1 + len(words)//20
+        ax.legend(loc='upper left',bbox_to_anchor=(1.01,1),fontsize='x-small',ncol=n_columns)
+        fig.subplots_adjust(right=0.8-0.15*n_columns)
+        for line in self.lines.values():
+            line.set_animated(True)  # Not drawn in the background, only by the blitting
+        self.title = fig.suptitle('',x=0.02,ha='left',fontsize='medium',animated=True)  # Over the whole figure, since the axes are narrowed by the legend
+        ax.set_xlabel('Seconds before the latest frame')
+        self.background = None
+        self.auto_xlim = None  # The x limits set from the data. The user chose any other limits.
+        fig.canvas.mpl_connect('draw_event',self._on_draw)
+
+    def _on_draw(self,event):
+        """ Caches the newly drawn background (after a resize, zoom, or limit change) and draws the lines over it """
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for line in self.lines.values():
+            self.ax.draw_artist(line)
+        self.fig.draw_artist(self.title)
+
+    def update(self,time_axis,data_dict,title):
+        """ Updates the lines to the words in the data dict against the time_axis (day of the year), and redraws them """
+        seconds = (time_axis - time_axis[-1])*24*60*60 if len(time_axis) else time_axis
+        for w_name,line in self.lines.items():
+            line.set_data(seconds,data_dict[w_name])
+        self.title.set_text(title)
+        if self._set_time_limits(seconds) or (self.background is None):
+            self.fig.canvas.draw_idle()  # Full redraw, which caches the new background in _on_draw
+            return
+        self.fig.canvas.restore_region(self.background)
+        self._draw_animated()
+        self.fig.canvas.blit(self.fig.bbox)
+        self.fig.canvas.flush_events()
+
+    def _set_time_limits(self,seconds):
+        """ Sets the time axis limits to fit the data, unless the user chose other limits.
+        They are set again only if the data no longer fits well. Returns True if the limits were changed. """
+        if len(seconds) < 2:
+            return False
+        xlim = self.ax.get_xlim()
+        if (self.auto_xlim is not None) and (xlim != self.auto_xlim):
+            return False  # Limits chosen by the user
+        span = -seconds[0]
+        if (self.auto_xlim is not None) and (2*span > -self.auto_xlim[0] > span):
+            return False  # Still fits
+        self.ax.set_xlim((-1.1*span,0.05*span))
+        self.auto_xlim = self.ax.get_xlim()
+        return True
+
+class RecordingWordPlot(object):
+    """ Line plot of the words of a (multi-hour) recording, read from its level of detail pyramid.
+    Only about one min/max/mean tile per pixel of the visible time range is read, and they are read again whenever the view is zoomed or panned.
+    The mean of each word is plotted as a line, and the range between its min and max as a faint band of the same colour.
+    When zoomed in to less than a frame per pixel, the frames themselves are plotted.
+    The refreshes while neither the view nor the recording has changed do not read or draw anything. """
+
+    def __init__(self,fig,ax,words,pyramid,start_time=None,end_time=None):
+        self.fig = fig
+        self.ax = ax
+        self.words = words
+        self.pyramid = pyramid
+        self.mean_lines = {w_name:ax.plot([],[],marker='.',label=w_name,alpha=.4)[0] for w_name in words}
+        self.range_bands = {w_name:ax.fill_between([],[],[],color=self.mean_lines[w_name].get_color(),alpha=.15,linewidth=0) for w_name in words}
+        self.last_view = None  # (time range, width, recording size) of the latest refresh
+        ax.legend(loc='upper right')  # Fixed, since finding the best location goes through all the points on every draw
+        time_range = pyramid.time_range()
+        if time_range is not None:
+            ax.set_xlim(start_time if start_time is not None else time_range[0]/TICKS_PER_DAY,
+                        end_time if end_time is not None else time_range[1]/TICKS_PER_DAY)
+        ax.callbacks.connect('xlim_changed',lambda ax: self.refresh())
+
+    def refresh(self):
+        """ Reads the tiles of the visible time range at the level of detail of the axes width, and updates the lines """
+        start_time, end_time = self.ax.get_xlim()
+        n_points = max(1,int(self.ax.bbox.width))
+        view = (start_time,end_time,n_points,self.pyramid.size())
+        if view == self.last_view:
+            return
+        self.last_view = view
+        level, time_ticks, minimum, maximum, mean = self.pyramid.query(self.words,day_of_year_to_ticks(start_time),
+                                                                       day_of_year_to_ticks(end_time),n_points)
+        time_axis = time_ticks/TICKS_PER_DAY
+        for w_name in self.words:
+            self.mean_lines[w_name].set_data(time_axis,mean[w_name])
+            # Outline of the band: along the minimum, and back along the maximum
+            band = np.column_stack([np.concatenate([time_axis,time_axis[::-1]]),np.concatenate([minimum[w_name],maximum[w_name][::-1]])])
+            self.range_bands[w_name].set_verts([band] if len(time_axis) else [])
+        self.ax.set_title('{0} | {1} points of {2}'.format(self.pyramid.recording_filename.split('/')[-1],len(time_axis),
+                                                           'frames' if level == RAW_LEVEL else '{0} frames each'.format(2**level)))
+        self.fig.canvas.draw_idle()
+
+def observe_packet_to_pixel_latency(event):
+    """ Records the latency from the arrival of the latest packet at the capture to its drawing on the screen """
+    if live_reader.last_receive_time > 0:
+        metrics.observe('packet_to_pixel_seconds',time.time()-live_reader.last_receive_time)
 
 if __name__ == '__main__':
+    # Only the plot needs matplotlib, so that the processing can be imported without it (see Telemetry_Processing.py)
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+    metrics = PipelineMetrics('word_plot',profile_every=METRICS_PROFILE_EVERY)
+    live_processor = None
+    recording_plot = None
+    fpc_waveform = FPCTriangleWaveform()
+    if INCREMENTAL_PROCESSING and is_ring_buffer_file(TELEMETRY_INPUT_FILE.split(':')[0]):
+        live_reader = LiveFrameReader(TELEMETRY_INPUT_FILE,subscribe=SUBSCRIBE_TO_CAPTURE)
+        live_processor = IncrementalDataProcessor(LIVE_PLOT_FRAMES)
     # Start plotting
     fig = plt.figure()
     ax1 = fig.add_subplot(1,1,1)
@@ -210,6 +229,30 @@ if __name__ == '__main__':
                        # ['PDA No. {0}'.format(i+1) for i in range(8)]+\
                        #                   ['FPS {0} L'.format(i+1) for i in range(4)]+\ 
     #                   ['FPS {0} H'.format(i+1) for i in range(4)]
+    if PLOT_PDA_FPS_WORDS:
+        words_to_extract = words_to_extract + ['PDA No. {0}'.format(i+1) for i in range(8)]+\
+                                              ['FPS {0} L'.format(i+1) for i in range(4)]+\
+                                              ['FPS {0} H'.format(i+1) for i in range(4)]
+    recording_filename = TELEMETRY_INPUT_FILE.split(':')[0]
+    if RECORDING_LOD_BROWSING and is_recording_file(recording_filename):
+        if not is_recording_pyramid_current(recording_filename):
+            print('Building the level of detail pyramid of {0}'.format(recording_filename))
+            build_recording_pyramid(recording_filename)
+        start_time, end_time = [float(t) if t else None for t in (TELEMETRY_INPUT_FILE.split(':')[1:]+['',''])[:2]]
+        recording_plot = RecordingWordPlot(fig,ax1,words_to_extract,RecordingPyramid(recording_filename),start_time,end_time)
+        word_plot = None
+    elif BLITTED_RENDERING:
+        word_plot = BlittedWordPlot(fig,ax1,words_to_extract)
+    else:
+        word_plot = None
+        if live_processor is not None:
+            fig.canvas.mpl_connect('draw_event',observe_packet_to_pixel_latency)
     animate(0) # Plot once before startig the animation
-    ani = animation.FuncAnimation(fig, animate, interval=REFRESH_RATE)
+    if BLITTED_RENDERING or (recording_plot is not None):
+        # Refresh by a timer instead of FuncAnimation, which would redraw the whole figure after each refresh
+        timer = fig.canvas.new_timer(interval=REFRESH_RATE)
+        timer.add_callback(animate,0)
+        timer.start()
+    else:
+        ani = animation.FuncAnimation(fig, animate, interval=REFRESH_RATE)
     plt.show()
@@ -6,142 +6,97 @@ Usage: Plot_Recorded_CII_map_live.py Recorded_TelmetryFile.pkl:BkgStartTime:BkgE
 Start and End times are in the unit of day of the year. They are optional.
 
 If one wants the background to be estimated by median combing nearest data points, provide the keywords `NEAREST_BKG` as the first argument instead of the pkl file.
+To map the live telemetry as it is captured instead of a recording, provide the keyword `LIVE` as the second argument.
+The co-added map on the el/Xel grid (see SkyGridMap) is saved beside the recording as _skygrid.npz when the plot window is closed.
+The frames are read and processed in a worker process (see Telemetry_CII_Map_Worker.py), and the plot only draws the newest map it has sent.
 Last updated: JPN 20221123
 
 """
-import pickle
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import matplotlib
-from matplotlib import style
 import numpy as np
-from Plot_Captured_Telemetry_live import process_raw_data_dict, load_pickle_data_dict_file
-from collections import defaultdict, deque
+from Telemetry_CII_Map import StreamingCIIMap, load_background_spectrum, down_scan_offset_fpc, N_GOOD_SIGNAL_SPECTRA
+from Telemetry_CII_Map_Worker import CIIMapWorker, LIVE_RING_BUFFER_FILE
+from Telemetry_PubSub import LiveFrameReader
+from Telemetry_Metrics import PipelineMetrics
 import sys
 
-# Set the FPC scan parameters to None to esimtate automatically from the data
-MAXDIFF = None #520 # 
-MAXTP = None #2580 # None #
-MINTP = None #1020  # None #
-
-down_scan_offset_fpc = 580 # Adjusted by eye looking at the atmospheric line spectrum offsets
-REFRESH_RATE = 100000  #  Refresh rate of plot in milliseconds # Set this to slow rate if you want to interact with the plot
-WINDOW_SMOOTH = 18
-
+REFRESH_RATE = 5000  #  Refresh rate of plot in milliseconds # Each refresh only processes the newly recorded frames
+COMPUTE_WORKER = True  # Read and process the frames in a worker process, so that the plot does not freeze. False to process them in the refreshes
+WORKER_REFRESH_RATE = 200  # Milliseconds between the checks for a new map from the worker. The plot is only redrawn when there is one
 USE_NEAREST_BKG = True
-BKG_BUFFER_SIZE = 10
-LINE_FPC_W = (1750,2500) # Window inside to sum the flux for C II 158 icron line
-
-def average_el_Xel_FPC_FPS(data_dict,window=WINDOW_SMOOTH):
-    """ Generater which returns the average of FPS values in the `window` number of frames at el and Xel values for different FPC values.
-    Up/DOWN seperation logic assumes FPC values are not same for UP and DOWN scans"""
-
-    # ALERT: For unknow reason, testing on 2018 Oct W3 data shows, the Elevation is given by 'Fine Xelev. S. E.' and Xel by 'Fine Elev. S. E.'. Reason Unknown!!!!!!
-    el_array = np.array(data_dict['Fine Xelev. S. E.']) + (np.array(data_dict['S.T. Elev. Error'])-2048)*-0.02188  # 0.022 is Approximate scaling value fom SKG's code # Ignoring corss talk
-    xel_array = np.array(data_dict['Fine Elev. S. E.']) + (np.array(data_dict['S.T. Xelev. Error'])-2048)*-0.02217
-    for i in range(0,len(data_dict['FPC 1']),window//3): #Sample only 3 ponts inside a window 
-        FPC_dict_t = defaultdict(list) # Temperory storage for averaging
-        FPC_dict_UDt = defaultdict(list) # UP/DOWN mask bit
-        for j in range(window):
-            if i+j < len(data_dict['FPC 1']):
-                for f in range(1,5):
-                    FPC_dict_t[data_dict['FPC {0}'.format(f)][i+j]].append(data_dict['FPS {0} HL'.format(f)][i+j])
-                    FPC_dict_UDt[data_dict['FPC {0}'.format(f)][i+j]].append(data_dict['UPSCAN {0}'.format(f)][i+j])
-
-        FPC_dict = {}
-        FPC_dict_UD = {}
-        for fpc in FPC_dict_t:
-            FPC_dict[fpc] = np.median(FPC_dict_t[fpc])  # Median combine for robustness
-            FPC_dict_UD[fpc] = np.median(FPC_dict_UDt[fpc])
-
-        mean_el = np.median(el_array[i:i+window])
-        mean_xel = np.median(xel_array[i:i+window]) 
-        # This is a python generator, hence yield
-        yield mean_el, mean_xel, FPC_dict, FPC_dict_UD
-        
+GRIDDED_MAP = True  # Show the co-added map on a grid of MAP_PIXEL_SIZE pixels (see SkyGridMap) instead of the scatter of every window
 
 def animate(i):
-    global avg_bkg_fpc_dict
-    try:
-        data_queue_dict = load_pickle_data_dict_file(recorded_input_file)
-    except EOFError:
-        return
-    if USE_NEAREST_BKG:
-        bkg_dict_buffer = deque(maxlen=BKG_BUFFER_SIZE)
-
-    # # Do data processing
-    data_queue_dict = process_raw_data_dict(data_queue_dict,MaxDiff=MAXDIFF,maxtp=MAXTP,mintp=MINTP)
-
-    el_list = []
-    xel_list = []
-    flux_list = []
-    up_spectrum_list = []
-    down_spectrum_list = []
-    good_signal_spectra_up = []
-    good_signal_spectra_down = []
-    for mean_el, mean_xel, FPC_dict, FPC_dict_UD in average_el_Xel_FPC_FPS(data_queue_dict,window=WINDOW_SMOOTH):
-        if USE_NEAREST_BKG:
-            bkg_dict_buffer.append(FPC_dict)
-            avg_bkg_fpc_dict = {fpc:np.median([f_dict[fpc] for f_dict in bkg_dict_buffer if fpc in f_dict.keys()]) for fpc in FPC_dict}
+    """ Draws the newest map from the worker, or without the worker reads and processes the new frames and draws the map """
+    if cii_worker is not None:
+        snapshot = cii_worker.latest_snapshot()
+        if snapshot is None:
+            return  # No new map yet
+    else:
+        n_windows = len(cii_map.flux_list)
         try:
-            up_spectrum = np.array([FPC_dict[fpc]-avg_bkg_fpc_dict[fpc] for fpc in FPC_dict if FPC_dict_UD[fpc]==1])
-            down_spectrum = np.array([FPC_dict[fpc]-avg_bkg_fpc_dict[fpc] for fpc in FPC_dict if FPC_dict_UD[fpc]==0])
-        except KeyError:
-            # Bad data in the stream which was not present in bkg. Ignore and continue
-            continue
-        else:
-            goodmask_up = np.abs(up_spectrum) < 200 # remove deivations larger than 200 after bkg subtraction
-            goodmask_down = np.abs(down_spectrum) < 200
-
-            up_scan_fpc = np.array([fpc for fpc in FPC_dict if FPC_dict_UD[fpc]==1])
-            down_scan_fpc = np.array([fpc for fpc in FPC_dict if FPC_dict_UD[fpc]==0])
-
-            line_mask_up = (up_scan_fpc > LINE_FPC_W[0]) & (up_scan_fpc < LINE_FPC_W[1])
-            line_mask_down = (down_scan_fpc+down_scan_offset_fpc > LINE_FPC_W[0]) & (down_scan_fpc+down_scan_offset_fpc < LINE_FPC_W[1])
-            # Flux is defined as the max minus median
-            flux_list.append(np.mean([np.sum(spectrum[mask])-np.median(spectrum)*np.sum(mask) for spectrum,mask in [(up_spectrum,goodmask_up&line_mask_up),(down_spectrum,goodmask_down&line_mask_down)] if len(spectrum[mask]) > 1])) 
-
-            el_list.append(mean_el)
-            xel_list.append(mean_xel)
-
-
-            up_spectrum_list.append((up_scan_fpc,up_spectrum))
-            down_spectrum_list.append((down_scan_fpc,down_spectrum))
-
-            if flux_list[-1] > 40:
-                good_signal_spectra_up.append(up_spectrum_list[-1])
-                good_signal_spectra_down.append(down_spectrum_list[-1])
-    
-    # xlim = ax1.get_xlim()
+            with metrics.timer('processing_seconds'):
+                if live_reader is not None:
+                    n_new_frames = cii_map.read_live_frames(live_reader)
+                else:
+                    n_new_frames = cii_map.read_new_frames(recorded_input_file)
+        except EOFError:
+            return
+        metrics.count('frames_processed',n_new_frames)
+        metrics.count('windows_processed',len(cii_map.flux_list)-n_windows)
+        snapshot = cii_map.snapshot(GRIDDED_MAP)
+    with metrics.timer('draw_seconds'):
+        draw_map(snapshot)
+        fig.canvas.draw_idle()
+    metrics.maybe_write()
+
+def draw_map(snapshot):
+    """ Plots the map and the spectra of a snapshot of the windows processed so far (see StreamingCIIMap.snapshot).
+    The axes which were zoomed or panned keep their view across the refreshes. """
+    global map_axes, auto_views
+    user_views = [(ax.get_xlim(),ax.get_ylim()) for ax in map_axes]
     fig.clear()
     ax1 = fig.add_subplot(2,1,1)
-    ax1.plot(el_list,xel_list,alpha=0.1,color='k')#,norm=True)
-    sp = ax1.scatter(el_list,xel_list,c=flux_list)#,norm=matplotlib.colors.LogNorm())
+    if GRIDDED_MAP:
+        # A single image of the co-added pixels, whose drawing does not slow down as the windows accumulate
+        sp = ax1.imshow(snapshot['flux_map'].T,origin='lower',extent=snapshot['extent'],aspect='auto',interpolation='nearest')
+    else:
+        ax1.plot(snapshot['el'],snapshot['xel'],alpha=0.1,color='k')#,norm=True)
+        sp = ax1.scatter(snapshot['el'],snapshot['xel'],c=snapshot['flux'])#,norm=matplotlib.colors.LogNorm())
     ax1.set_xlabel('Fine el SE + S.T. Elev Error *0.022')
     ax1.set_ylabel('Fine Xel SE + S.T. Xelev Error * 0.022')
     fig.colorbar(sp,ax=ax1)
-    # print(FPC_dict.keys(),[FPC_dict[fpc]-avg_bkg_fpc_dict[fpc] for fpc in FPC_dict],[avg_bkg_fpc_dict[fpc] for fpc in FPC_dict],[FPC_dict[fpc] for fpc in FPC_dict])
     ax2 = fig.add_subplot(2,1,2)
     # First lot the best spectrum in the bkg for reference
-    for fpc,spec in good_signal_spectra_up:
-        ax2.plot(fpc,spec,'o',color='k')
-    for fpc,spec in good_signal_spectra_down:
-        ax2.plot(fpc+down_scan_offset_fpc,spec,'s',color='k')
+    if GRIDDED_MAP:
+        if snapshot['peak_spectrum'] is not None:
+            ax2.plot(*snapshot['peak_spectrum'],'o',color='k',label='Co-added peak pixel')
+            ax2.legend()
+    else:
+        for fpc,spec in snapshot['good_spectra_up']:
+            ax2.plot(fpc,spec,'o',color='k')
+        for fpc,spec in snapshot['good_spectra_down']:
+            ax2.plot(fpc+down_scan_offset_fpc,spec,'s',color='k')
     # Plot the latest few spectra
-    for fpc,spec in up_spectrum_list[-20::2]:
+    for fpc,spec in snapshot['up_spectra'][::2]:
         ax2.plot(fpc,spec,'v')
-    for fpc,spec in down_spectrum_list[-20::2]:
+    for fpc,spec in snapshot['down_spectra'][::2]:
         ax2.plot(fpc+down_scan_offset_fpc,spec,'^')
 
-
     ax2.set_xlabel('FPC')
     ax2.set_ylabel('Counts')
     # ax2.set_ylim((-50,100))#ax2_ylim)
-    # ax1.set_ylim(ylim)
-    
+    new_auto_views = [(ax.get_xlim(),ax.get_ylim()) for ax in (ax1,ax2)]
+    for ax,user_view,auto_view in zip((ax1,ax2),user_views,auto_views):
+        if user_view != auto_view:
+            ax.set_xlim(user_view[0])
+            ax.set_ylim(user_view[1])
+    map_axes, auto_views = (ax1,ax2), new_auto_views
 
 
 if __name__ == '__main__':
+    # Only the plot needs matplotlib, so that the map computation can be imported without it (see Telemetry_CII_Map.py)
+    import matplotlib.pyplot as plt
+    metrics = PipelineMetrics('cii_map_plot' if COMPUTE_WORKER else 'cii_map')
     # First argument is background and second is the live target.
     bkg_input_file = sys.argv[1]
     recorded_input_file = sys.argv[2]
@@ -153,9 +108,7 @@ if __name__ == '__main__':
 
     if not USE_NEAREST_BKG:
         print('Load bkg file and creating a bkg template')
-        bkg_data_dict = load_pickle_data_dict_file(bkg_input_file)
-        bkg_data_dict = process_raw_data_dict(bkg_data_dict,MaxDiff=MAXDIFF,maxtp=MAXTP,mintp=MINTP)
-        bkg_el, bkg_xel, avg_bkg_fpc_dict, fpc_updown = next(average_el_Xel_FPC_FPS(bkg_data_dict,window=len(bkg_data_dict['FPC 1'])))
+        avg_bkg_fpc_dict, fpc_updown = load_background_spectrum(bkg_input_file)
         plt.figure()
         up_scan_fpc = [fpc for fpc in avg_bkg_fpc_dict if fpc_updown[fpc]==1]
         down_scan_fpc = [fpc for fpc in avg_bkg_fpc_dict if fpc_updown[fpc]==0]
@@ -167,13 +120,34 @@ if __name__ == '__main__':
         plt.legend()
         plt.show(block=False)
     else:
-        avg_bkg_fpc_dict = {}
+        avg_bkg_fpc_dict = None  # Estimated from the nearest windows
+
+    # Keep the co-added map of the observation once the plot window is closed
+    sky_grid_filename = ('/mnt/tmp_fast/T100_live' if recorded_input_file == 'LIVE' else recorded_input_file.split(':')[0]) + '_skygrid.npz'
+    live_reader = None
+    cii_map = None
+    cii_worker = None
+    if COMPUTE_WORKER:
+        cii_worker = CIIMapWorker(recorded_input_file,avg_bkg_fpc_dict,gridded=GRIDDED_MAP,sky_grid_filename=sky_grid_filename)
+    else:
+        if recorded_input_file == 'LIVE':
+            live_reader = LiveFrameReader(LIVE_RING_BUFFER_FILE)
+        # Keeps the map of the windows processed so far, so that each refresh only processes the new frames
+        cii_map = StreamingCIIMap(avg_bkg_fpc_dict,n_good_signal_spectra=0 if GRIDDED_MAP else N_GOOD_SIGNAL_SPECTRA)
 
 
     print('Starting CII map generation..')
-    fig, ax1 = plt.subplots()
-    # fig = plt.figure()
-    # ax1 = fig.add_subplot(1,1,1)
+    fig = plt.figure()
+    map_axes, auto_views = (), ()  # Axes of the last drawing, and their views before any zoom or pan
     animate(0)
-    ani = animation.FuncAnimation(fig, animate, interval=REFRESH_RATE)
+    # Refresh by a timer instead of FuncAnimation, which would redraw the whole figure even when there is no new map
+    timer = fig.canvas.new_timer(interval=WORKER_REFRESH_RATE if COMPUTE_WORKER else REFRESH_RATE)
+    timer.add_callback(animate,0)
+    timer.start()
     plt.show()
+
+    if cii_worker is not None:
+        cii_worker.stop()
+    else:
+        cii_map.sky_grid.save(sky_grid_filename)
+        print('Saved the gridded map in {0} (load it with SkyGridMap.load)'.format(sky_grid_filename))
@@ -1,18 +1,38 @@
 #!/usr/bin/env python
 """ This script is to record the captured telmetry for a longer duration before it gets erased from the temperory FIFO file. Useful for extended duration observation anlaysis.
 
-Usage: Record_Captured_Telemetry.py RecordTelmetryFile.pkl [StartTime]
+Usage: Record_Captured_Telemetry.py RecordTelmetryFile.tlm [StartTime]
 
 StartTime is in the unit of day of the year. It is optional
+The new frames are received from the capture script as they arrive (see Telemetry_PubSub.py), and saved every SAVE_INTERVAL seconds.
+The recording is written in chunks of a fixed number of frames, which are synced to the disk as soon as they are full.
+The frames which do not yet fill a chunk are only written every TAIL_FLUSH_INTERVAL seconds (as a shorter chunk) and on Cntrl+C,
+so that at most the last TAIL_FLUSH_INTERVAL seconds are lost if the recorder is killed or the computer crashes.
+If the capture cannot be subscribed to, the FIFO ring buffer is polled every SAVE_INTERVAL seconds instead.
+The frames which the capture drops for the recorder when it does not keep up are read from the FIFO ring buffer,
+and are only lost if the FIFO has already overwritten them.
 
 Last updated: JPN 20221123
 
 """
 import sys
-import pickle
 import time
 import numpy as np
 import signal
+from Telemetry_Ring_Buffer import TelemetryRingBuffer
+from Telemetry_PubSub import TelemetrySubscriber, pubsub_socket_path
+from Telemetry_Recording_File import RecordingWriter
+from Telemetry_Recording_Pyramid import RecordingPyramidWriter
+from Telemetry_Derived_Channels import DerivedChannelWriter
+from Telemetry_Metrics import PipelineMetrics
+from Telemetry_Frame_Decoder import timestamp_ticks, day_of_year_to_ticks, TICKS_PER_DAY
+
+# Live FIFO ring buffer written by Capture_UDP_Telemetry_live.py
+fifo_filename = '/mnt/tmp_fast/T100_data_ring_buffer.ring'
+SAVE_INTERVAL = 2  # Seconds between the saves of the new frames
+TAIL_FLUSH_INTERVAL = 60  # Seconds between the writes of the frames which do not yet fill a chunk of the recording. Much longer than SAVE_INTERVAL, to keep the chunks full
+SUBSCRIBE_TO_CAPTURE = True  # Receive the new frames from the capture script instead of polling the FIFO
+RECORD_DERIVED_CHANNELS = True  # Also save the derived channels (see Telemetry_Derived_Channels.py), so that the plots need not compute them
 
 # First argument if the output filename
 output_filename = sys.argv[1]
@@ -29,35 +49,100 @@ print('Recording from {0} into {1}'.format(start_time,output_filename))
 #################### Function to cleanup and exit in the event of Cntrl+C interupt.
 def handler(signum, frame):
     """ Gets called when an interrupt signal is received """
-    print('Cntrl +C Recived. Saving file and stoping at time {0}.'.format(last_timestamp))
-    with open(output_filename,'wb') as odatafile:
-        pickle.dump(recorded_data_dict,odatafile)
+    print('Cntrl +C Recived. Saving file and stoping at time {0}.'.format(last_ticks/TICKS_PER_DAY))
+    if recording_writer is not None:
+        recording_writer.close()
+        recording_pyramid.close()
+        if derived_writer is not None:
+            derived_writer.close()
+    metrics.maybe_write(force=True)
     sys.exit(0)
 
 signal.signal(signal.SIGINT, handler)
 ####################
 
-recorded_data_dict = None
+recording_writer = None
+derived_writer = None
+last_tail_flush_time = time.time()
+last_ticks = day_of_year_to_ticks(start_time)  # Time ticks of the last recorded frame
+ring_buffer = TelemetryRingBuffer(fifo_filename)
+read_cursor = None  # Write cursor of the ring buffer upto which the frames are already recorded
+metrics = PipelineMetrics('recorder')
+subscriber = None
+if SUBSCRIBE_TO_CAPTURE:
+    # Subscribe before the first read of the FIFO, so that no frame is missed in between. The overlap is removed by the time stamps
+    try:
+        subscriber = TelemetrySubscriber(pubsub_socket_path(fifo_filename))
+    except OSError as e:
+        print('WARNING: Could not subscribe to the capture ({0}). Polling the FIFO instead'.format(e))
 
 while True:
-    read_data = open('/mnt/tmp_fast/T100_data_queue_dict.pkl','rb').read()
-    try:
-        data_queue_dict = pickle.loads(read_data)
-    except EOFError:
-        continue
-    if recorded_data_dict is None:
-        recorded_data_dict = {w_name:[] for w_name in data_queue_dict}
-        last_timestamp = start_time
+    if (subscriber is not None) and (read_cursor is not None):
+        try:
+            data_queue_dict, write_count = subscriber.collect(SAVE_INTERVAL)
+        except ConnectionError as e:
+            print('\nWARNING: {0}. Polling the FIFO instead'.format(e))
+            subscriber = None
+            continue
+        last_receive_time = subscriber.last_receive_time
+    else:
+        with metrics.timer('fifo_read_seconds'):
+            data_queue_dict, write_count = ring_buffer.read(since=read_cursor)
+        last_receive_time = ring_buffer.last_receive_time
+    if recording_writer is None:
+        # Only the new frames are appended to the file on every save
+        recording_writer = RecordingWriter(output_filename,ring_buffer.columns)
+        # Level of detail pyramid for browsing the recording with Plot_Captured_Telemetry_live.py
+        recording_pyramid = RecordingPyramidWriter(output_filename,ring_buffer.columns)
+        if RECORD_DERIVED_CHANNELS:
+            derived_writer = DerivedChannelWriter(output_filename)
+    else:
+        if (subscriber is not None) and (write_count - read_cursor > len(data_queue_dict['DAY'])):
+            # The capture dropped batches for the recorder, which are still in the FIFO unless it has overwritten them since.
+            # The frames received again are removed by the time stamps
+            print('\nWARNING: The capture dropped frames for the recorder. Reading them from the FIFO')
+            with metrics.timer('fifo_read_seconds'):
+                data_queue_dict, write_count = ring_buffer.read(since=read_cursor)
+        if write_count - read_cursor > len(data_queue_dict['DAY']):
+            print('\nWARNING: Recorder fell behind the FIFO. Lost {0} frames'.format(write_count - read_cursor - len(data_queue_dict['DAY'])))
+            metrics.count('frames_lost',write_count - read_cursor - len(data_queue_dict['DAY']))
+    read_cursor = write_count
 
     # Look for new entries in the dictionary since last recording
-    new_mask = (np.array(data_queue_dict['DAY'])+np.array(data_queue_dict['HH'])/24.+np.array(data_queue_dict['MM'])/(24*60.)+np.array(data_queue_dict['SEC'])/(24*60*60.)+np.array(data_queue_dict['MSEC'])/(24*60*60*10000.)) > last_timestamp
-    if np.sum(new_mask) > 0: # If new data exists
-        for w_name in recorded_data_dict:
-            recorded_data_dict[w_name].extend(np.array(data_queue_dict[w_name])[new_mask])
-        with open(output_filename,'wb') as odatafile:
-            pickle.dump(recorded_data_dict,odatafile)
+    time_ticks = timestamp_ticks(data_queue_dict)
+    if np.all(np.diff(time_ticks) >= 0):
+        # The frames arrive in time order, so the new ones are those after the last recorded frame (a slice, not a copy)
+        new = slice(int(np.searchsorted(time_ticks,last_ticks,side='right')),None)
+    else:
+        new = time_ticks > last_ticks  # A glitched time stamp. The mask does not depend on the order
+    new_time_ticks = time_ticks[new]
+    n_new = len(new_time_ticks)
+    if n_new > 0: # If new data exists
+        with metrics.timer('recording_write_seconds'):
+            new_data_dict = {w_name:data_queue_dict[w_name][new] for w_name in recording_writer.columns}
+            n_written = recording_writer.n_frames
+            recording_writer.append(new_data_dict,time_ticks=new_time_ticks)
+            if time.time() - last_tail_flush_time >= TAIL_FLUSH_INTERVAL:
+                recording_writer.flush()  # Also the frames which do not yet fill a chunk
+                last_tail_flush_time = time.time()
+            elif recording_writer.n_frames != n_written:
+                recording_writer.sync()  # Only the chunks which were filled
+        if recording_writer.n_pending == 0:
+            # Latency from the packet arrival at the capture to it being safe on the disk
+            metrics.observe('packet_to_disk_seconds',time.time()-last_receive_time)
+        with metrics.timer('pyramid_write_seconds'):
+            recording_pyramid.append(new_data_dict)
+            recording_pyramid.flush()
+        if derived_writer is not None:
+            with metrics.timer('derived_write_seconds'):
+                derived_writer.append(new_data_dict)
+                derived_writer.flush()
+        metrics.count('frames_recorded',n_new)
         print('.',end ='',flush=True)
         # Update last entry timestamp in the recorded data
-        last_timestamp = recorded_data_dict['DAY'][-1]+ recorded_data_dict['HH'][-1]/24.+ recorded_data_dict['MM'][-1]/(24*60.)+ recorded_data_dict['SEC'][-1]/(24*60*60.)+ recorded_data_dict['MSEC'][-1]/(24*60*60*10000.)
+        last_ticks = int(new_time_ticks[-1])
+    metrics.set_gauge('recorded_frames_total',recording_writer.n_frames)
+    metrics.maybe_write()
 
-    time.sleep(2) # Sleep for 2 seconds
+    if subscriber is None:
+        time.sleep(SAVE_INTERVAL)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+""" This script reduces whole recordings into one co-added CII map after the flight, without the live plot, on all the CPU cores
+
+Usage: Reduce_Recorded_CII_map.py OutputMap.npz Recorded_TelmetryFile.tlm:BkgStartTime:BkgEndTime Recorded_TelmetryFile.tlm[:StartTime:EndTime] [...]
+
+The background argument is as in Plot_Recorded_CII_map_live.py (or the keyword `NEAREST_BKG`), followed by any number of recordings with their optional time windows.
+Start and End times are in the unit of day of the year.
+
+The frames of each recording are split into chunks of CHUNK_FRAMES frames, which a pool of N_WORKERS processes reduce like the live map does.
+The chunk size follows from the WORKER_MEMORY each worker may take, at FRAME_MEMORY bytes per frame, and the number of workers is capped
+so that all of them together stay within MEMORY_BUDGET.
+Each chunk also reads the frames of the BKG_BUFFER_SIZE windows before it, which only fill the nearest background buffer,
+and the frames after it which its last windows need, so that its windows are the same as in a single pass over the recording.
+The FPC triangle waveform of a recording without the derived channels is fitted once to all its frames, before splitting it,
+and given to all the workers, instead of each worker fitting it to the frames of its own chunk.
+The windows of all the chunks are co-added into one SkyGridMap, which is saved into OutputMap.npz along with the el, xel and flux of every window.
+"""
+import sys
+import time
+import multiprocessing
+import numpy as np
+from Telemetry_Recording_File import read_recording_ticks, iterate_recording_file
+from Telemetry_Frame_Decoder import TICKS_PER_DAY
+from Telemetry_Processing import load_pickle_data_dict_file, estimate_FPC_triangle_waveform
+from Telemetry_Derived_Channels import has_derived_channels
+from Telemetry_CII_Map import StreamingCIIMap, SkyGridMap, load_background_spectrum, map_derived_channels, WINDOW_SMOOTH, BKG_BUFFER_SIZE, MAXDIFF, MAXTP, MINTP
+
+WORKER_MEMORY = 2**28  # Bytes of memory each worker process may take to reduce its chunk
+FRAME_MEMORY = 2048  # Bytes of worker memory per frame of a chunk (the frames read, their processed channels and the windows kept), measured on synthetic recordings
+MEMORY_BUDGET = 2**31  # Bytes of memory of all the worker processes together, which caps their number
+CHUNK_FRAMES = WORKER_MEMORY//FRAME_MEMORY  # Frames of the recording reduced by each task
+N_WORKERS = None  # Number of worker processes. None for the number of CPU cores, within MEMORY_BUDGET
+
+def parse_recorded_input_file(recorded_input_file):
+    """ Returns the (recording filename, start time, end time) of the recording with its optional :Start:End suffix (None for the missing times) """
+    recording_filename = recorded_input_file.split(':')[0]
+    try:
+        start_time = float(recorded_input_file.split(':')[1])
+    except (IndexError, ValueError):
+        start_time = None
+    try:
+        end_time = float(recorded_input_file.split(':')[2])
+    except (IndexError, ValueError):
+        end_time = None
+    return recording_filename, start_time, end_time
+
+
+def split_recording(recorded_input_file,chunk_frames=CHUNK_FRAMES,window=WINDOW_SMOOTH,warmup_windows=BKG_BUFFER_SIZE):
+    """ Returns the list of the (recording with the :Start:End time window of the frames to read, number of warmup windows) of each chunk
+    of the recording (with its optional :Start:End suffix). The chunks start at multiples of the window step from the first frame. """
+    recording_filename, start_time, end_time = parse_recorded_input_file(recorded_input_file)
+    time_ticks = read_recording_ticks(recording_filename,start_time=start_time,end_time=end_time)
+    time_ticks = time_ticks[time_ticks > 0]
+    step = window//3
+    chunk_frames = max(step,chunk_frames//step*step)
+    chunks = []
+    for first in range(0,len(time_ticks)-window+1,chunk_frames):
+        read_first = max(0,first-warmup_windows*step)
+        read_last = min(len(time_ticks),first+chunk_frames-step+window)
+        chunks.append(('{0}:{1!r}:{2!r}'.format(recording_filename,float(time_ticks[read_first]/TICKS_PER_DAY),float(time_ticks[read_last-1]/TICKS_PER_DAY)),
+                       (first-read_first)//step))
+    return chunks
+
+
+def worker_count(n_workers=N_WORKERS,chunk_frames=CHUNK_FRAMES,memory_budget=MEMORY_BUDGET):
+    """ Returns the number of worker processes reducing chunks of chunk_frames frames: n_workers (None for the number of CPU cores),
+    but no more than fit in the memory_budget, and at least one """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    return max(1,min(n_workers,memory_budget//(chunk_frames*FRAME_MEMORY)))
+
+
+def estimate_recording_waveform(recorded_input_file):
+    """ Returns the (MaxDiff, maxtp, mintp) of the FPC triangle waveform fitted to the FPC COUNTER of all the frames of the recording
+    (with its optional :Start:End suffix), like a single pass over it does. Returns None if the map reads the derived channels of the recording,
+    whose FPC values were interpolated as it was recorded, or if it has no frames. """
+    recording_filename, start_time, end_time = parse_recorded_input_file(recorded_input_file)
+    derived_channels = map_derived_channels()
+    if (derived_channels is not None) and has_derived_channels(recording_filename,derived_channels):
+        return None
+    # Only the FPC COUNTER of each chunk is kept (copied, so that the rest of the chunk is freed)
+    FPC3_arrays = [np.array(frames[columns.index('FPC COUNTER')]) for columns, _, frames in
+                   iterate_recording_file(recording_filename,start_time=start_time,end_time=end_time)]
+    if not FPC3_arrays:
+        return None
+    # As int64 like the loaded frames, so that the differences of the samples do not wrap around
+    return estimate_FPC_triangle_waveform(np.concatenate(FPC3_arrays).astype(np.int64),MaxDiff=MAXDIFF,maxtp=MAXTP,mintp=MINTP)
+
+
+def set_worker_background(avg_bkg_fpc_dict,waveforms):
+    """ Initialiser of the worker processes, which keeps the background spectrum (None for the nearest background),
+    and the list of the FPC triangle waveform of each recording from estimate_recording_waveform, for all their tasks """
+    global worker_avg_bkg_fpc_dict, worker_waveforms
+    worker_avg_bkg_fpc_dict = avg_bkg_fpc_dict
+    worker_waveforms = waveforms
+
+
+def reduce_chunk(chunk):
+    """ Returns the (el, xel, flux arrays, SkyGridMap) of the windows of the chunk, which is a chunk from split_recording followed by the number of its recording """
+    chunk_input_file, warmup_windows, recording_number = chunk
+    MaxDiff, maxtp, mintp = worker_waveforms[recording_number] or (MAXDIFF,MAXTP,MINTP)
+    cii_map = StreamingCIIMap(worker_avg_bkg_fpc_dict,warmup_windows=warmup_windows,MaxDiff=MaxDiff,maxtp=maxtp,mintp=mintp)
+    cii_map.update(load_pickle_data_dict_file(chunk_input_file,derived_channels=map_derived_channels()))
+    return np.array(cii_map.el_list), np.array(cii_map.xel_list), np.array(cii_map.flux_list), cii_map.sky_grid
+
+
+def reduce_recordings(recorded_input_files,avg_bkg_fpc_dict=None,n_workers=N_WORKERS,chunk_frames=CHUNK_FRAMES):
+    """ Reduces the recordings (with their optional :Start:End suffixes) on a pool of n_workers processes.
+    Returns the (co-added SkyGridMap, el, xel, flux arrays of all the windows in order) """
+    chunks = [chunk+(recording_number,) for recording_number,recorded_input_file in enumerate(recorded_input_files)
+              for chunk in split_recording(recorded_input_file,chunk_frames=chunk_frames)]
+    waveforms = [estimate_recording_waveform(recorded_input_file) for recorded_input_file in recorded_input_files]
+    sky_grid = SkyGridMap()
+    el_arrays, xel_arrays, flux_arrays = [], [], []
+    with multiprocessing.Pool(worker_count(n_workers,chunk_frames),initializer=set_worker_background,initargs=(avg_bkg_fpc_dict,waveforms)) as pool:
+        for i,(el,xel,flux,chunk_grid) in enumerate(pool.imap(reduce_chunk,chunks)):
+            sky_grid.merge(chunk_grid)
+            el_arrays.append(el)
+            xel_arrays.append(xel)
+            flux_arrays.append(flux)
+            print('Reduced chunk {0}/{1} ({2})'.format(i+1,len(chunks),chunks[i][0]),flush=True)
+    if not chunks:
+        return sky_grid, np.empty(0), np.empty(0), np.empty(0)
+    return sky_grid, np.concatenate(el_arrays), np.concatenate(xel_arrays), np.concatenate(flux_arrays)
+
+
+if __name__ == '__main__':
+    output_filename = sys.argv[1]
+    bkg_input_file = sys.argv[2]
+    recorded_input_files = sys.argv[3:]
+
+    if bkg_input_file == 'NEAREST_BKG':
+        avg_bkg_fpc_dict = None  # Estimated from the nearest windows
+    else:
+        print('Load bkg file and creating a bkg template')
+        avg_bkg_fpc_dict, _ = load_background_spectrum(bkg_input_file)
+
+    t0 = time.time()
+    sky_grid, el, xel, flux = reduce_recordings(recorded_input_files,avg_bkg_fpc_dict)
+    sky_grid.save(output_filename,el=el,xel=xel,flux=flux)
+    print('Reduced {0} windows in {1:.1f} s. Saved the map in {2} (load it with SkyGridMap.load)'.format(len(flux),time.time()-t0,output_filename))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+""" This script replays a recording from Record_Captured_Telemetry.py into the live pipeline, to rehearse flights and tune the live plots on past observations
+
+Usage: Replay_Recorded_Telemetry.py RecordedTelemetryFile.tlm[:StartTime:EndTime] [Speed] [udp|fifo] [Target]
+
+Speed is 1 for real time, N for N times faster, or 0 for as fast as possible. Default is 1.
+The frames are replayed with their original time gaps between them (divided by the Speed).
+Gaps longer than MAX_GAP_SECONDS (e.g. when the recorder was stopped) are shortened to it.
+
+udp  : Sends the frames as UDP packets in the original byte format to the Target IP:PORT (default 127.0.0.1:5000),
+       which is where Capture_UDP_Telemetry_live.py listens. This exercises the full capture path.
+fifo : Writes the frames directly into the FIFO ring buffer file Target (default /mnt/tmp_fast/T100_data_ring_buffer.ring).
+       Do not run it together with Capture_UDP_Telemetry_live.py, which writes to the same file.
+
+Start and End times are in the unit of day of the year. They are optional.
+"""
+import sys
+import time
+import socket
+import signal
+import numpy as np
+from Telemetry_Frame_Decoder import load_telemetry_word_file, build_frame_layout, encode_packet_array, words_to_extract
+from Telemetry_Recording_File import iterate_recording_file
+from Telemetry_Ring_Buffer import TelemetryRingBuffer
+
+MAX_GAP_SECONDS = 2.  # Longest gap between the replayed frames, in recorded time
+SEND_INTERVAL = 0.001  # Frames due within this many seconds are sent together
+FIFO_BUFFER_SIZE = 65536  # Same as the buffer_size of Capture_UDP_Telemetry_live.py
+
+def replay_schedule(time_ticks,speed,max_gap_seconds=MAX_GAP_SECONDS):
+    """ Returns the array of the seconds after the start of the replay at which each frame is due.
+    The gaps between the frames are divided by the speed, after shortening the gaps longer than max_gap_seconds. """
+    gaps = np.diff(np.asarray(time_ticks,dtype=np.int64),prepend=time_ticks[0])/10000.
+    gaps = np.clip(gaps,0,max_gap_seconds)
+    if speed == 0:
+        return np.zeros(len(gaps))
+    return np.cumsum(gaps)/speed
+
+class UDPFrameSender(object):
+    """ Sends the rows of frames as UDP packets in the original byte format """
+
+    def __init__(self,address,layout):
+        self.address = address
+        self.layout = layout
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)  # UDP
+
+    def send(self,rows):
+        """ Sends each row as a UDP packet """
+        for packet in encode_packet_array(rows,self.layout):
+            self.sock.sendto(packet.tobytes(),self.address)
+
+    def close(self):
+        """ Closes the socket """
+        self.sock.close()
+
+class FIFOFrameWriter(object):
+    """ Writes the rows of frames directly into the FIFO ring buffer file """
+
+    def __init__(self,filename,layout,buffer_size=FIFO_BUFFER_SIZE):
+        self.ring_buffer = TelemetryRingBuffer.create(filename,layout['columns'],buffer_size)
+
+    def send(self,rows):
+        """ Appends the rows to the ring buffer """
+        self.ring_buffer.append(rows,receive_time=time.time())
+
+    def close(self):
+        """ Closes the ring buffer file """
+        self.ring_buffer.close()
+
+def replay_recording(recorded_input_file,output,layout,speed=1.,start_time=None,end_time=None):
+    """ Replays the frames of the recording file into the output (UDPFrameSender or FIFOFrameWriter) at the speed.
+    The frames are given to the output as rows in the column order of the layout. Returns the number of frames replayed """
+    output_columns = None
+    n_replayed = 0
+    replay_start = time.perf_counter()
+    schedule_offset = 0.  # Seconds after the replay start at which the current chunk starts
+    last_ticks = None
+    for columns, time_ticks, frames in iterate_recording_file(recorded_input_file,start_time=start_time,end_time=end_time):
+        if output_columns is None:
+            output_columns = [columns.index(w_name) for w_name in layout['columns']]
+        rows = frames[output_columns].T
+        # Continue the schedule from the last frame of the previous chunk
+        chunk_ticks = time_ticks if last_ticks is None else np.r_[last_ticks,time_ticks]
+        due_times = schedule_offset + replay_schedule(chunk_ticks,speed)[-len(time_ticks):]
+        schedule_offset = due_times[-1]
+        last_ticks = time_ticks[-1]
+        start = 0
+        while start < len(rows):
+            now = time.perf_counter() - replay_start
+            if due_times[start] > now:
+                time.sleep(due_times[start] - now)
+                now = due_times[start]
+            end = max(start+1,int(np.searchsorted(due_times,now+SEND_INTERVAL,side='right')))
+            output.send(rows[start:end])
+            start = end
+        n_replayed += len(rows)
+        lag = time.perf_counter() - replay_start - schedule_offset
+        print('Replayed {0} frames upto DAY {1} {2}:{3}:{4} | Behind schedule by {5:.3f} s'.format(n_replayed,*rows[-1,-5:-1],max(lag,0.)),flush=True)
+    return n_replayed
+
+if __name__ == '__main__':
+    recorded_input_file = sys.argv[1].split(':')[0]
+    try:
+        start_time = float(sys.argv[1].split(':')[1])
+    except (IndexError, ValueError):
+        start_time = None
+    try:
+        end_time = float(sys.argv[1].split(':')[2])
+    except (IndexError, ValueError):
+        end_time = None
+    try:
+        speed = float(sys.argv[2])
+    except IndexError:
+        speed = 1.
+    try:
+        mode = sys.argv[3]
+    except IndexError:
+        mode = 'udp'
+
+    layout = build_frame_layout(load_telemetry_word_file(),words_to_extract)
+    if mode == 'udp':
+        try:
+            udp_ip, udp_port = sys.argv[4].split(':')
+        except IndexError:
+            udp_ip, udp_port = '127.0.0.1', 5000
+        output = UDPFrameSender((udp_ip,int(udp_port)),layout)
+        print('Replaying {0} at speed {1} as UDP packets to {2}:{3}'.format(recorded_input_file,speed or 'max',udp_ip,udp_port))
+    elif mode == 'fifo':
+        try:
+            fifo_filename = sys.argv[4]
+        except IndexError:
+            fifo_filename = '/mnt/tmp_fast/T100_data_ring_buffer.ring'
+        output = FIFOFrameWriter(fifo_filename,layout)
+        print('Replaying {0} at speed {1} into the FIFO {2}'.format(recorded_input_file,speed or 'max',fifo_filename))
+    else:
+        sys.exit('Unknown replay output {0}. Use udp or fifo'.format(mode))
+
+    def handler(signum, frame):
+        """ Gets called when an interrupt signal is received """
+        print('Cntrl +C Received. Stopping the replay.')
+        output.close()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, handler)
+
+    n_replayed = replay_recording(recorded_input_file,output,layout,speed=speed,start_time=start_time,end_time=end_time)
+    output.close()
+    print('Finished replaying {0} frames'.format(n_replayed))
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+""" This module holds the CII map computation shared by the live map and the batch reduction:
+averaging the frames in windows at each FPC value, the background spectra, and the co-added map on the el/Xel grid.
+
+It does not import matplotlib, so that the headless tools start quickly and run on machines without a display.
+"""
+import numpy as np
+from Telemetry_Processing import process_raw_data_dict, load_pickle_data_dict_file, IncrementalDataProcessor, strip_data_outside_timestamp, frame_count
+from Telemetry_Derived_Channels import derived_channel
+from Telemetry_Frame_Decoder import timestamp_ticks
+from collections import defaultdict, deque
+
+# Set the FPC scan parameters to None to esimtate automatically from the data
+MAXDIFF = None #520 # 
+MAXTP = None #2580 # None #
+MINTP = None #1020  # None #
+FPC_DTYPE = np.float64  # np.float32 halves the memory of the interpolated FPC values kept for the windows
+# Read only the channels of the map, computed by the recorder (see Telemetry_Derived_Channels.py), from the recordings which have them.
+# They are only used when the FPC scan parameters are estimated, like the recorder does.
+USE_DERIVED_CHANNELS = True
+MAP_CHANNELS = ['el','xel','Time HL','FPC Up/Down'] + ['FPC {0}'.format(f) for f in range(1,5)] + ['FPS {0} HL'.format(f) for f in range(1,5)] + ['UPSCAN {0}'.format(f) for f in range(1,5)]
+
+down_scan_offset_fpc = 580 # Adjusted by eye looking at the atmospheric line spectrum offsets
+WINDOW_SMOOTH = 18
+
+BKG_BUFFER_SIZE = 10
+LINE_FPC_W = (1750,2500) # Window inside to sum the flux for C II 158 icron line
+MAP_PIXEL_SIZE = 10  # el/Xel counts per pixel of the gridded map
+MAP_SPECTRUM_FPC_BIN = 8  # FPC counts per bin of the co-added spectra of the gridded map
+N_LATEST_SPECTRA = 20  # Latest up and down spectra kept for the map plot
+N_GOOD_SIGNAL_SPECTRA = 200  # Latest good signal spectra (flux above 40) kept for the scatter map plot, when asked for
+MAX_DEVIATION = 200  # Spectrum values deviating more than this from the background are left out of the flux and the co-added spectra
+DENSE_BLOCK_ELEMENTS = 2**20  # Window x FPC value elements of the dense window arrays made at once (see iterate_dense_window_blocks). Bounds the memory of long recordings
+MEDIAN_BLOCK_ELEMENTS = 2**22  # Values sorted at once by the batched rolling median background. Bounds its memory for long refreshes
+
+def average_el_Xel_FPC_FPS(data_dict,window=WINDOW_SMOOTH):
+    """ Generater which returns the average of FPS values in the `window` number of frames at el and Xel values for different FPC values.
+    Up/DOWN seperation logic assumes FPC values are not same for UP and DOWN scans"""
+
+    # ALERT: The Elevation is given by 'Fine Xelev. S. E.' and Xel by 'Fine Elev. S. E.' (see Telemetry_Derived_Channels.el_channel)
+    el_array = np.asarray(derived_channel(data_dict,'el'))
+    xel_array = np.asarray(derived_channel(data_dict,'xel'))
+    for i in range(0,len(data_dict['FPC 1']),window//3): #Sample only 3 ponts inside a window 
+        FPC_dict_t = defaultdict(list) # Temperory storage for averaging
+        FPC_dict_UDt = defaultdict(list) # UP/DOWN mask bit
+        for j in range(window):
+            if i+j < len(data_dict['FPC 1']):
+                for f in range(1,5):
+                    FPC_dict_t[data_dict['FPC {0}'.format(f)][i+j]].append(data_dict['FPS {0} HL'.format(f)][i+j])
+                    FPC_dict_UDt[data_dict['FPC {0}'.format(f)][i+j]].append(data_dict['UPSCAN {0}'.format(f)][i+j])
+
+        FPC_dict = {}
+        FPC_dict_UD = {}
+        for fpc in FPC_dict_t:
+            FPC_dict[fpc] = np.median(FPC_dict_t[fpc])  # Median combine for robustness
+            FPC_dict_UD[fpc] = np.median(FPC_dict_UDt[fpc])
+
+        mean_el = np.median(el_array[i:i+window])
+        mean_xel = np.median(xel_array[i:i+window]) 
+        # This is a python generator, hence yield
+        yield mean_el, mean_xel, FPC_dict, FPC_dict_UD
+        
+
+def window_start_indices(n_frames,window=WINDOW_SMOOTH):
+    """ Returns the first frame index of each averaging window. Same sampling as average_el_Xel_FPC_FPS """
+    return np.arange(0,n_frames,window//3)
+
+
+def grouped_sorted_medians(group_keys,values,n_groups):
+    """ Returns an array of the median of `values` in each of the n_groups integer `group_keys`, with NaN for empty groups.
+    Sorts once by (key,value) and picks the middle elements of each group, instead of calling np.median for each group."""
+    order = np.lexsort((values,group_keys))
+    sorted_keys = group_keys[order]
+    sorted_values = values[order].astype(np.float64)
+    group_starts = np.flatnonzero(np.r_[True,sorted_keys[1:] != sorted_keys[:-1]])
+    group_counts = np.diff(np.r_[group_starts,len(sorted_keys)])
+    medians = np.full(n_groups,np.nan)
+    # Mean of the two middle elements, which are the same element for odd counts
+    medians[sorted_keys[group_starts]] = (sorted_values[group_starts+(group_counts-1)//2] + sorted_values[group_starts+group_counts//2])/2
+    return medians
+
+
+def row_nanmedians(values):
+    """ Returns the array of the median of the non NaN values along the last axis of `values`, with NaN where there are none.
+    Sorts once (NaN values sort to the end) and picks the middle elements, instead of np.nanmedian which loops over the rows when the axis is long."""
+    sorted_values = np.sort(values,axis=-1)
+    counts = np.sum(~np.isnan(values),axis=-1)[...,np.newaxis]
+    lower = np.take_along_axis(sorted_values,np.maximum(counts-1,0)//2,axis=-1)[...,0]
+    upper = np.take_along_axis(sorted_values,np.minimum(counts//2,values.shape[-1]-1),axis=-1)[...,0]
+    return np.where(counts[...,0] > 0,(lower+upper)/2,np.nan)
+
+
+def subtract_background_and_flux(fpc_bins,fps_median,updown_median,bkg_median,line_fpc_w=LINE_FPC_W,max_deviation=MAX_DEVIATION):
+    """ Subtracts the background from the spectra of all the windows at once, and returns their line fluxes.
+    fpc_bins, fps_median and updown_median are the dense window arrays of average_el_Xel_FPC_FPS_dense, and bkg_median is the (n_windows,n_bins)
+    (or broadcastable) array of the background at each FPC value. The FPC values missing in a window or in its background are NaN, and are masked out.
+    Returns (spectra, up, down, good, flux) where
+    spectra : (n_windows,n_bins) array of the background subtracted spectra. NaN where the window or the background is missing.
+    up, down : (n_windows,n_bins) masks of the up scan and down scan values in spectra
+    good : (n_windows,n_bins) mask of the values deviating less than max_deviation from the background
+    flux : (n_windows,) array of the sum of the good values inside line_fpc_w (the down scan shifted by down_scan_offset_fpc) above the median of the spectrum,
+           averaged over the up and down scans which have more than one good value in it. NaN if none of them has.
+    """
+    spectra = fps_median - bkg_median
+    present = ~np.isnan(spectra)
+    up = present & (updown_median == 1)
+    down = present & (updown_median == 0)
+    good = present & (np.abs(np.where(present,spectra,0)) < max_deviation)
+    flux_sum = np.zeros(len(spectra))
+    n_scans = np.zeros(len(spectra))
+    for scan, scan_fpc in [(up,fpc_bins),(down,fpc_bins+down_scan_offset_fpc)]:
+        line_mask = good & scan & (scan_fpc > line_fpc_w[0]) & (scan_fpc < line_fpc_w[1])
+        n_line = np.sum(line_mask,axis=1)
+        # Flux is defined as the sum minus the median of the scan's spectrum
+        scan_flux = np.sum(np.where(line_mask,spectra,0),axis=1) - row_nanmedians(np.where(scan,spectra,np.nan))*n_line
+        has_line = n_line > 1
+        flux_sum[has_line] += scan_flux[has_line]
+        n_scans += has_line
+    flux = np.divide(flux_sum,n_scans,out=np.full(len(spectra),np.nan),where=n_scans > 0)
+    return spectra, up, down, good, flux
+
+
+def average_el_Xel_FPC_FPS_dense(data_dict,window=WINDOW_SMOOTH):
+    """ Vectorised version of the average_el_Xel_FPC_FPS generator, which returns the results of all the windows at once as dense arrays.
+    Returns (el, xel, fpc_bins, fps_median, updown_median) where
+    el, xel : (n_windows,) arrays of median el and xel in each window
+    fpc_bins : (n_bins,) sorted array of all the distinct FPC values
+    fps_median : (n_windows,n_bins) array of median FPS values at each FPC value in the window. NaN if the FPC value is not in the window.
+    updown_median : (n_windows,n_bins) array of median UPSCAN flags at each FPC value in the window. NaN if the FPC value is not in the window.
+    The memory taken grows as n_windows*n_bins, where n_bins can be thousands when the FPC values jitter.
+    Long data should be given block by block with iterate_dense_window_blocks instead.
+    """
+    el_array = np.asarray(derived_channel(data_dict,'el'))  # See average_el_Xel_FPC_FPS
+    xel_array = np.asarray(derived_channel(data_dict,'xel'))
+    n_frames = len(data_dict['FPC 1'])
+    window_starts = window_start_indices(n_frames,window)
+    n_windows = len(window_starts)
+
+    # Frame indices inside each window, flattened along with their window number. The last few windows are truncated at the end.
+    window_frames = window_starts[:,np.newaxis] + np.arange(window)[np.newaxis,:]
+    in_range = window_frames < n_frames
+    frame_index = window_frames[in_range]
+    window_index = np.repeat(np.arange(n_windows),in_range.sum(axis=1))
+
+    # Median el and xel of each window
+    el_median = grouped_sorted_medians(window_index,el_array[frame_index],n_windows)
+    xel_median = grouped_sorted_medians(window_index,xel_array[frame_index],n_windows)
+
+    # Quantise the FPC values of all the 4 FPS readouts into integer bins
+    all_FPC = np.stack([np.asarray(data_dict['FPC {0}'.format(f)]) for f in range(1,5)],axis=1)
+    fpc_bins, fpc_bin_index = np.unique(all_FPC,return_inverse=True)
+    fpc_bin_index = fpc_bin_index.reshape(all_FPC.shape)
+    n_bins = len(fpc_bins)
+    all_FPS = np.stack([np.asarray(data_dict['FPS {0} HL'.format(f)]) for f in range(1,5)],axis=1)
+    all_UPSCAN = np.stack([np.asarray(data_dict['UPSCAN {0}'.format(f)]) for f in range(1,5)],axis=1)
+
+    group_keys = (window_index[:,np.newaxis]*n_bins + fpc_bin_index[frame_index]).ravel()
+    fps_median = grouped_sorted_medians(group_keys,all_FPS[frame_index].ravel(),n_windows*n_bins).reshape(n_windows,n_bins)
+    updown_median = grouped_sorted_medians(group_keys,all_UPSCAN[frame_index].ravel(),n_windows*n_bins).reshape(n_windows,n_bins)
+    return el_median, xel_median, fpc_bins, fps_median, updown_median
+
+
+def iterate_dense_window_blocks(data_dict,window=WINDOW_SMOOTH,n_windows=None,max_elements=DENSE_BLOCK_ELEMENTS):
+    """ Generator which yields the dense window arrays of average_el_Xel_FPC_FPS_dense for consecutive blocks of the windows of the data,
+    of at most max_elements windows x FPC values each, so that the memory taken does not grow with the length of the data.
+    Only the first n_windows windows are yielded if it is given. Each block has its own fpc_bins. """
+    n_frames = len(data_dict['FPC 1'])
+    step = window//3
+    if n_windows is None:
+        n_windows = len(window_start_indices(n_frames,window))
+    # The FPC values of the whole data bound those of every block
+    n_bins = len(np.unique(np.stack([np.asarray(data_dict['FPC {0}'.format(f)]) for f in range(1,5)])))
+    block_windows = max(1,max_elements//max(1,n_bins))
+    for first in range(0,n_windows,block_windows):
+        n_block = min(block_windows,n_windows-first)
+        # Frames of the windows of the block. The windows at the end of the data are truncated there as in the whole data
+        block_dict = {w_name:data_dict[w_name][first*step:min(n_frames,(first+n_block-1)*step+window)] for w_name in data_dict}
+        el_median, xel_median, fpc_bins, fps_median, updown_median = average_el_Xel_FPC_FPS_dense(block_dict,window=window)
+        yield el_median[:n_block], xel_median[:n_block], fpc_bins, fps_median[:n_block], updown_median[:n_block]
+
+
+def map_derived_channels():
+    """ Returns the list of the derived channels to read from the recordings instead of the raw words, or None to process the raw words """
+    if USE_DERIVED_CHANNELS and (MAXDIFF is None) and (MAXTP is None) and (MINTP is None):
+        return MAP_CHANNELS
+    return None
+
+
+def load_background_spectrum(bkg_input_file):
+    """ Returns the (median FPS, median UPSCAN) dictionaries at each FPC value of all the frames of the background file (with its optional :Start:End) """
+    bkg_data_dict = load_pickle_data_dict_file(bkg_input_file,derived_channels=map_derived_channels())
+    bkg_data_dict = process_raw_data_dict(bkg_data_dict,MaxDiff=MAXDIFF,maxtp=MAXTP,mintp=MINTP)
+    bkg_el, bkg_xel, avg_bkg_fpc_dict, fpc_updown = next(iterate_dense_windows(*average_el_Xel_FPC_FPS_dense(bkg_data_dict,window=len(bkg_data_dict['FPC 1']))))
+    return avg_bkg_fpc_dict, fpc_updown
+
+
+def iterate_dense_windows(el_median,xel_median,fpc_bins,fps_median,updown_median):
+    """ Generator which yields the dense window arrays in the same (mean_el, mean_xel, FPC_dict, FPC_dict_UD) format as average_el_Xel_FPC_FPS """
+    for w in range(len(el_median)):
+        present = ~np.isnan(fps_median[w])
+        yield (el_median[w], xel_median[w],
+               dict(zip(fpc_bins[present],fps_median[w,present])),
+               dict(zip(fpc_bins[present],updown_median[w,present])))
+
+
+class RollingMedianBackground(object):
+    """ Rolling median background of the last buffer_size windows at each FPC value, for the NEAREST_BKG mode.
+    The window spectra are kept in a (buffer_size, n_FPC_bins) ring array, with NaN for the FPC values missing in a window.
+    Adding a window only writes one row, and the median is taken with a single np.nanmedian over the FPC columns asked for."""
+
+    def __init__(self,buffer_size=BKG_BUFFER_SIZE,initial_bins=1024):
+        self.buffer_size = buffer_size
+        self.fpc_slot = {}  # Column number of each FPC value in the ring array
+        self.ring = np.full((buffer_size,initial_bins),np.nan)
+        self.next_row = 0
+        self.n_rows = 0
+
+    def slots(self,fpc_values):
+        """ Returns the column numbers of the FPC values, adding new columns for the FPC values seen for the first time """
+        slots = np.empty(len(fpc_values),dtype=np.intp)
+        for i,fpc in enumerate(fpc_values):
+            try:
+                slots[i] = self.fpc_slot[fpc]
+            except KeyError:
+                slots[i] = self.fpc_slot[fpc] = len(self.fpc_slot)
+        if len(self.fpc_slot) > self.ring.shape[1]:
+            # Grow the ring array geometrically
+            new_ring = np.full((self.buffer_size,max(2*self.ring.shape[1],len(self.fpc_slot))),np.nan)
+            new_ring[:,:self.ring.shape[1]] = self.ring
+            self.ring = new_ring
+        return slots
+
+    def add(self,fpc_values,fps_values):
+        """ Adds a window spectrum of the fps_values at fpc_values into the ring, replacing the oldest one if the ring is full """
+        slots = self.slots(fpc_values)
+        self.ring[self.next_row,:] = np.nan
+        self.ring[self.next_row,slots] = fps_values
+        self.next_row = (self.next_row+1) % self.buffer_size
+        self.n_rows = min(self.n_rows+1,self.buffer_size)
+
+    def median(self,fpc_values):
+        """ Returns the array of median background at the fpc_values over the windows in the ring """
+        columns = self.ring[:self.n_rows,self.slots(fpc_values)]
+        return np.nanmedian(columns,axis=0)
+
+    def add_windows(self,fpc_bins,fps_values):
+        """ Adds the (n_windows,n_bins) window spectra at the fpc_bins (NaN where missing) in order, and returns the (n_windows,n_bins) array of
+        the median background of each window over itself and the buffer_size-1 windows before it, as add() followed by median() for each window would.
+        The medians of a block of windows are taken together on a sliding window view of the earlier and new spectra. """
+        slots = self.slots(fpc_bins)
+        n_windows = len(fps_values)
+        # Spectra of the earlier windows still in the ring, oldest first, padded with NaN to buffer_size-1 windows
+        n_earlier = min(self.n_rows,self.buffer_size-1)
+        earlier_rows = (self.next_row-n_earlier+np.arange(n_earlier)) % self.buffer_size
+        spectra = np.full((self.buffer_size-1+n_windows,len(fpc_bins)),np.nan)
+        spectra[self.buffer_size-1-n_earlier:self.buffer_size-1] = self.ring[np.ix_(earlier_rows,slots)]
+        spectra[self.buffer_size-1:] = fps_values
+        buffers = np.lib.stride_tricks.sliding_window_view(spectra,self.buffer_size,axis=0)  # (n_windows,n_bins,buffer_size)
+        medians = np.empty((n_windows,len(fpc_bins)))
+        block = max(1,MEDIAN_BLOCK_ELEMENTS//max(1,len(fpc_bins)*self.buffer_size))
+        for first in range(0,n_windows,block):
+            medians[first:first+block] = row_nanmedians(buffers[first:first+block])
+        # Keep the latest windows in the ring
+        n_kept = min(n_windows,self.buffer_size)
+        kept_rows = (self.next_row+np.arange(n_windows-n_kept,n_windows)) % self.buffer_size
+        self.ring[kept_rows,:] = np.nan
+        self.ring[np.ix_(kept_rows,slots)] = fps_values[n_windows-n_kept:]
+        self.next_row = (self.next_row+n_windows) % self.buffer_size
+        self.n_rows = min(self.n_rows+n_windows,self.buffer_size)
+        return medians
+
+
+class SkyGridMap(object):
+    """ Co-added CII map on a grid of el/Xel pixels of pixel_size, accumulated window by window.
+    Keeps the flux sum, weight and number of windows in each pixel, and the co-added spectrum of each pixel on the FPC axis
+    (the down scan spectra shifted by down_scan_offset_fpc) in bins of fpc_bin. The grid grows geometrically to cover the windows.
+    The spectra are only kept for the pixels with windows, as rows of spectrum_sum and spectrum_count indexed by spectrum_row (-1 for the
+    pixels without), so that a sparse raster over a wide el/Xel extent does not take n_el*n_Xel*n_fpc_bins of memory. """
+
+    def __init__(self,pixel_size=MAP_PIXEL_SIZE,fpc_bin=MAP_SPECTRUM_FPC_BIN,max_fpc=4096+down_scan_offset_fpc,initial_pixels=16):
+        self.pixel_size = pixel_size
+        self.fpc_bin = fpc_bin
+        self.n_fpc_bins = int(np.ceil(max_fpc/fpc_bin))
+        self.origin = None  # (el, Xel) pixel numbers of the first row and column of the arrays
+        self.flux_sum = np.zeros((initial_pixels,initial_pixels))
+        self.weight = np.zeros((initial_pixels,initial_pixels))
+        self.count = np.zeros((initial_pixels,initial_pixels),dtype=np.int64)
+        self.spectrum_row = np.full((initial_pixels,initial_pixels),-1,dtype=np.int64)
+        self.n_spectra = 0  # Rows of spectrum_sum and spectrum_count in use
+        self.spectrum_sum = np.zeros((initial_pixels,self.n_fpc_bins),dtype=np.float32)
+        self.spectrum_count = np.zeros((initial_pixels,self.n_fpc_bins),dtype=np.int32)
+
+    def _pixel_index(self,el,xel):
+        """ Returns the (row, column) of the pixel at el, xel in the arrays, growing them to cover it if needed """
+        pixel = (int(np.floor(el/self.pixel_size)),int(np.floor(xel/self.pixel_size)))
+        shape = self.flux_sum.shape[:2]
+        if self.origin is None:
+            self.origin = (pixel[0]-shape[0]//2,pixel[1]-shape[1]//2)
+        new_origin, new_shape = list(self.origin), list(shape)
+        for axis in range(2):
+            if pixel[axis] < self.origin[axis]:
+                new_shape[axis] = max(2*shape[axis],self.origin[axis]+shape[axis]-pixel[axis])
+                new_origin[axis] = self.origin[axis]+shape[axis]-new_shape[axis]
+            elif pixel[axis] >= self.origin[axis]+shape[axis]:
+                new_shape[axis] = max(2*shape[axis],pixel[axis]-self.origin[axis]+1)
+        if new_shape != list(shape):
+            offset = (self.origin[0]-new_origin[0],self.origin[1]-new_origin[1])
+            for name in ['flux_sum','weight','count','spectrum_row']:
+                array = getattr(self,name)
+                new_array = np.full(tuple(new_shape),-1 if name == 'spectrum_row' else 0,dtype=array.dtype)
+                new_array[offset[0]:offset[0]+shape[0],offset[1]:offset[1]+shape[1]] = array
+                setattr(self,name,new_array)
+            self.origin = tuple(new_origin)
+        return pixel[0]-self.origin[0], pixel[1]-self.origin[1]
+
+    def _spectrum_rows(self,rows,columns):
+        """ Returns the rows of spectrum_sum and spectrum_count of the pixels at the rows and columns of the arrays, adding rows for the
+        pixels which have none yet (growing the arrays geometrically) """
+        new_pixels = np.unique(np.ravel_multi_index((rows,columns),self.spectrum_row.shape)[self.spectrum_row[rows,columns] < 0])
+        if len(new_pixels) > 0:
+            n_spectra = self.n_spectra+len(new_pixels)
+            if n_spectra > len(self.spectrum_sum):
+                new_length = max(2*len(self.spectrum_sum),n_spectra)
+                for name in ['spectrum_sum','spectrum_count']:
+                    array = getattr(self,name)
+                    new_array = np.zeros((new_length,self.n_fpc_bins),dtype=array.dtype)
+                    new_array[:self.n_spectra] = array[:self.n_spectra]
+                    setattr(self,name,new_array)
+            self.spectrum_row.flat[new_pixels] = np.arange(self.n_spectra,n_spectra)
+            self.n_spectra = n_spectra
+        return self.spectrum_row[rows,columns]
+
+    def add(self,el,xel,flux,spectra,weight=1.):
+        """ Adds the flux of a window at el, xel with the weight, and its list of (FPC values, spectrum) to the pixel.
+        A NaN flux is not added. """
+        if np.isnan(flux):
+            return
+        i, j = self._pixel_index(el,xel)
+        self.flux_sum[i,j] += weight*flux
+        self.weight[i,j] += weight
+        self.count[i,j] += 1
+        row = self._spectrum_rows(np.array([i]),np.array([j]))[0]
+        for fpc, spectrum in spectra:
+            bins = np.clip(np.asarray(fpc)//self.fpc_bin,0,self.n_fpc_bins-1).astype(np.intp)
+            np.add.at(self.spectrum_sum[row],bins,spectrum)
+            np.add.at(self.spectrum_count[row],bins,1)
+
+    def add_windows(self,el,xel,flux,fpc,spectra,up,down,weight=1.):
+        """ Adds all the windows at once, like add() for each of them. el, xel and flux are (n_windows,) arrays, and spectra is the
+        (n_windows,n_bins) array at the fpc values, of which the up and down masks select the up scan values and the down scan values
+        (shifted by down_scan_offset_fpc) to add. The windows with a NaN flux are not added. """
+        added = ~np.isnan(flux)
+        if not np.any(added):
+            return
+        el, xel, flux, spectra, up, down = el[added], xel[added], flux[added], spectra[added], up[added], down[added]
+        # Grow the grid to cover all the windows first, centred on the first window like add()
+        self._pixel_index(el[0],xel[0])
+        self._pixel_index(np.min(el),np.min(xel))
+        self._pixel_index(np.max(el),np.max(xel))
+        rows = np.floor(el/self.pixel_size).astype(np.intp)-self.origin[0]
+        columns = np.floor(xel/self.pixel_size).astype(np.intp)-self.origin[1]
+        np.add.at(self.flux_sum,(rows,columns),weight*flux)
+        np.add.at(self.weight,(rows,columns),weight)
+        np.add.at(self.count,(rows,columns),1)
+        spectrum_rows = self._spectrum_rows(rows,columns)
+        for scan, fpc_offset in [(up,0),(down,down_scan_offset_fpc)]:
+            w, b = np.nonzero(scan)
+            bins = np.clip((fpc[b]+fpc_offset)//self.fpc_bin,0,self.n_fpc_bins-1).astype(np.intp)
+            np.add.at(self.spectrum_sum,(spectrum_rows[w],bins),spectra[w,b])
+            np.add.at(self.spectrum_count,(spectrum_rows[w],bins),1)
+
+    def flux_map(self):
+        """ Returns the (n_el, n_Xel) array of the weighted mean flux in each pixel, NaN where there is no window """
+        return np.divide(self.flux_sum,self.weight,out=np.full(self.weight.shape,np.nan),where=self.weight > 0)
+
+    def extent(self):
+        """ Returns the (el_min, el_max, Xel_min, Xel_max) edges of the grid """
+        origin = self.origin or (0,0)
+        return ((origin[0])*self.pixel_size,(origin[0]+self.flux_sum.shape[0])*self.pixel_size,
+                (origin[1])*self.pixel_size,(origin[1]+self.flux_sum.shape[1])*self.pixel_size)
+
+    def spectrum(self,i,j):
+        """ Returns the (FPC bin centres, co-added mean spectrum) of the pixel at row i and column j, only at the bins it has data in """
+        fpc = (np.arange(self.n_fpc_bins)+0.5)*self.fpc_bin
+        row = self.spectrum_row[i,j]
+        if row < 0:
+            return fpc[:0], np.zeros(0,dtype=self.spectrum_sum.dtype)
+        present = self.spectrum_count[row] > 0
+        return fpc[present], self.spectrum_sum[row,present]/self.spectrum_count[row,present]
+
+    def peak_pixel(self):
+        """ Returns the (row, column) of the pixel with the highest mean flux, or None if the map is empty """
+        flux_map = self.flux_map()
+        if np.all(np.isnan(flux_map)):
+            return None
+        return np.unravel_index(np.nanargmax(flux_map),flux_map.shape)
+
+    def merge(self,other):
+        """ Adds the pixels of the other grid (of the same pixel size and FPC bins) into this grid """
+        if other.origin is None:
+            return
+        # Grow the grid to cover the first and last pixels of the other grid
+        self._pixel_index(other.origin[0]*self.pixel_size,other.origin[1]*self.pixel_size)
+        self._pixel_index((other.origin[0]+other.flux_sum.shape[0]-1)*self.pixel_size,(other.origin[1]+other.flux_sum.shape[1]-1)*self.pixel_size)
+        i, j = other.origin[0]-self.origin[0], other.origin[1]-self.origin[1]
+        rows, columns = slice(i,i+other.flux_sum.shape[0]), slice(j,j+other.flux_sum.shape[1])
+        for name in ['flux_sum','weight','count']:
+            getattr(self,name)[rows,columns] += getattr(other,name)
+        other_i, other_j = np.nonzero(other.spectrum_row >= 0)
+        other_rows = other.spectrum_row[other_i,other_j]
+        spectrum_rows = self._spectrum_rows(other_i+i,other_j+j)
+        self.spectrum_sum[spectrum_rows] += other.spectrum_sum[other_rows]
+        self.spectrum_count[spectrum_rows] += other.spectrum_count[other_rows]
+
+    def save(self,filename,**arrays):
+        """ Saves the grid, and any other named arrays, into the compressed numpy .npz file """
+        np.savez_compressed(filename,pixel_size=self.pixel_size,fpc_bin=self.fpc_bin,origin=np.array(self.origin or (0,0)),
+                            flux_sum=self.flux_sum,weight=self.weight,count=self.count,
+                            spectrum_row=self.spectrum_row,spectrum_sum=self.spectrum_sum[:self.n_spectra],
+                            spectrum_count=self.spectrum_count[:self.n_spectra],**arrays)
+
+    @classmethod
+    def load(cls,filename):
+        """ Returns the grid saved in the .npz file """
+        with np.load(filename) as saved:
+            sky_grid = cls(pixel_size=float(saved['pixel_size']),fpc_bin=float(saved['fpc_bin']),
+                           max_fpc=saved['spectrum_sum'].shape[1]*float(saved['fpc_bin']))
+            sky_grid.origin = tuple(int(p) for p in saved['origin'])
+            for name in ['flux_sum','weight','count','spectrum_row','spectrum_sum','spectrum_count']:
+                setattr(sky_grid,name,saved[name])
+            sky_grid.n_spectra = len(sky_grid.spectrum_sum)
+        return sky_grid
+
+
+class StreamingCIIMap(object):
+    """ Accumulates the CII map results window by window as the recording grows, so that each refresh only processes the newly recorded frames.
+    Keeps the per window el, xel and flux of the earlier refreshes, the processed frames of the trailing incomplete windows,
+    and the nearest background buffer state. Only the latest n_latest_spectra up and down spectra and the latest n_good_signal_spectra
+    good signal spectra (none by default, since only the scatter map draws them) are kept, so that the memory does not grow with the spectra
+    of all the windows of a long session."""
+
+    def __init__(self,avg_bkg_fpc_dict=None,window=WINDOW_SMOOTH,bkg_buffer_size=BKG_BUFFER_SIZE,MaxDiff=MAXDIFF,maxtp=MAXTP,mintp=MINTP,warmup_windows=0,
+                 n_latest_spectra=N_LATEST_SPECTRA,n_good_signal_spectra=0):
+        self.window = window
+        self.warmup_windows = warmup_windows  # Windows at the start which only fill the nearest background buffer, and are left out of the map
+        self.use_nearest_bkg = avg_bkg_fpc_dict is None
+        self.avg_bkg_fpc_dict = {} if avg_bkg_fpc_dict is None else avg_bkg_fpc_dict
+        self.background = RollingMedianBackground(bkg_buffer_size)
+        self.sky_grid = SkyGridMap()
+        # Processed frames from the start of the next window onwards
+        self.processor = IncrementalDataProcessor(None,MaxDiff=MaxDiff,maxtp=maxtp,mintp=mintp,dtype=FPC_DTYPE)
+        self.first_frame = 0  # Frame number of the first frame in self.processor.data_dict
+        self.next_window_start = 0  # Frame number of the start of the next window to process
+        self.since_ticks = None  # Time ticks of the last frame read from the recording
+
+        self.el_list = []
+        self.xel_list = []
+        self.flux_list = []
+        self.up_spectrum_list = deque(maxlen=n_latest_spectra)
+        self.down_spectrum_list = deque(maxlen=n_latest_spectra)
+        self.good_signal_spectra_up = deque(maxlen=n_good_signal_spectra)
+        self.good_signal_spectra_down = deque(maxlen=n_good_signal_spectra)
+
+    def read_new_frames(self,recorded_input_file):
+        """ Reads the newly recorded frames from the recording file and processes them. Returns the number of new frames """
+        new_data_dict = load_pickle_data_dict_file(recorded_input_file,since_ticks=self.since_ticks,derived_channels=map_derived_channels())
+        if frame_count(new_data_dict) > 0:
+            self.since_ticks = int(new_data_dict['TIME TICKS'][-1] if 'TIME TICKS' in new_data_dict else timestamp_ticks(new_data_dict)[-1])
+        self.update(new_data_dict)
+        return frame_count(new_data_dict)
+
+    def read_live_frames(self,live_reader):
+        """ Processes the frames captured since the last refresh from the LiveFrameReader. Returns the number of new frames """
+        new_data_dict = strip_data_outside_timestamp(live_reader.read())
+        self.update(new_data_dict)
+        return frame_count(new_data_dict)
+
+    def update(self,new_data_dict):
+        """ Processes the new raw frames, and adds the results of all the windows which are now complete """
+        data_dict = self.processor.update(new_data_dict)
+        if data_dict is None:
+            return
+        step = self.window//3
+        n_frames = self.first_frame + frame_count(data_dict)
+        n_complete = (n_frames - self.window - self.next_window_start)//step + 1
+        if n_complete <= 0:
+            return
+        # Frames of all the complete windows
+        window_data_dict = {w_name:data_dict[w_name][self.next_window_start-self.first_frame:
+                                                     self.next_window_start-self.first_frame+(n_complete-1)*step+self.window] for w_name in data_dict}
+        # In blocks of windows, so that the first refresh on a long recording does not take the memory of all its windows at once
+        for el_median, xel_median, fpc_bins, fps_median, updown_median in iterate_dense_window_blocks(window_data_dict,window=self.window,n_windows=n_complete):
+            self.add_windows(el_median,xel_median,fpc_bins,fps_median,updown_median)
+        self.next_window_start += n_complete*step
+        self.first_frame += self.processor.drop_frames(self.next_window_start-self.first_frame)
+
+    def add_windows(self,el,xel,fpc_bins,fps_median,updown_median):
+        """ Subtracts the background from the spectra of the windows, given as the dense window arrays of average_el_Xel_FPC_FPS_dense,
+        and adds their fluxes and spectra to the map, all at once (see subtract_background_and_flux) """
+        if self.use_nearest_bkg:
+            bkg_median = self.background.add_windows(fpc_bins,fps_median)
+        else:
+            bkg_median = np.array([self.avg_bkg_fpc_dict.get(fpc,np.nan) for fpc in fpc_bins])  # NaN for the FPC values missing in the background
+        # The warmup windows only fill the nearest background buffer
+        n_warmup = min(self.warmup_windows,len(el))
+        self.warmup_windows -= n_warmup
+        if self.use_nearest_bkg:
+            bkg_median = bkg_median[n_warmup:]
+        el, xel, fps_median, updown_median = el[n_warmup:], xel[n_warmup:], fps_median[n_warmup:], updown_median[n_warmup:]
+        spectra, up, down, good, flux = subtract_background_and_flux(fpc_bins,fps_median,updown_median,bkg_median)
+
+        self.el_list.extend(el)
+        self.xel_list.extend(xel)
+        self.flux_list.extend(flux)
+        self.sky_grid.add_windows(el,xel,flux,fpc_bins,spectra,good & up,good & down)
+
+        # Only the spectra of the windows which the bounded lists keep
+        for w in range(max(0,len(el)-self.up_spectrum_list.maxlen),len(el)):
+            self.up_spectrum_list.append((fpc_bins[up[w]],spectra[w,up[w]]))
+            self.down_spectrum_list.append((fpc_bins[down[w]],spectra[w,down[w]]))
+        good_signal_windows = np.flatnonzero(flux > 40)
+        for w in good_signal_windows[max(0,len(good_signal_windows)-self.good_signal_spectra_up.maxlen):]:
+            self.good_signal_spectra_up.append((fpc_bins[up[w]],spectra[w,up[w]]))
+            self.good_signal_spectra_down.append((fpc_bins[down[w]],spectra[w,down[w]]))
+
+    def snapshot(self,gridded=True):
+        """ Returns a dictionary of what the map plot draws of the windows processed so far, which is small enough to send to the plot process
+        on every refresh: the number of windows, the latest up and down spectra, and with gridded, the co-added flux map,
+        its extent and the spectrum of its peak pixel (None while empty), or otherwise the el, xel and flux of all the windows and the good signal spectra. """
+        snapshot = {'n_windows':len(self.flux_list),
+                    'up_spectra':list(self.up_spectrum_list),
+                    'down_spectra':list(self.down_spectrum_list)}
+        if gridded:
+            peak_pixel = self.sky_grid.peak_pixel()
+            snapshot.update(flux_map=self.sky_grid.flux_map(),extent=self.sky_grid.extent(),
+                            peak_spectrum=None if peak_pixel is None else self.sky_grid.spectrum(*peak_pixel))
+        else:
+            snapshot.update(el=np.array(self.el_list),xel=np.array(self.xel_list),flux=np.array(self.flux_list),
+                            good_spectra_up=list(self.good_signal_spectra_up),good_spectra_down=list(self.good_signal_spectra_down))
+        return snapshot
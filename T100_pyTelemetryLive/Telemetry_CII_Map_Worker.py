@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+""" This module runs the CII map computation (StreamingCIIMap) in a separate worker process, so that the map plot never freezes.
+
+The worker reads and processes the new frames of the recording (or of the live capture) as fast as they come, and after each update
+sends a snapshot of the map (see StreamingCIIMap.snapshot) to the plot process through a pipe.
+Only the latest snapshot waits to be sent: while the plot process is busy, a newer snapshot replaces the waiting one (latest wins),
+and the worker never waits for the plot. The plot process takes the newest snapshot which has arrived with CIIMapWorker.latest_snapshot().
+"""
+import threading
+import multiprocessing
+from Telemetry_CII_Map import StreamingCIIMap, N_GOOD_SIGNAL_SPECTRA
+from Telemetry_PubSub import LiveFrameReader
+from Telemetry_Metrics import PipelineMetrics
+
+WORKER_IDLE_SECONDS = 0.5  # Wait before reading the recording again, when there were no new frames
+LIVE_RING_BUFFER_FILE = '/mnt/tmp_fast/T100_data_ring_buffer.ring'  # FIFO ring buffer of the capture, mapped for the input file `LIVE`
+STOP_REQUEST = 'stop'
+# The worker is started fresh instead of forked, so that it does not inherit the GUI state of the plot process
+WORKER_START_METHOD = 'spawn'
+
+class LatestSnapshotSender(object):
+    """ Sends the snapshots through the connection from its own thread, so that the worker keeps processing while the plot process is busy.
+    A snapshot put while the previous one is still waiting to be sent replaces it. """
+
+    def __init__(self,connection):
+        self.connection = connection
+        self.snapshot = None  # Snapshot waiting to be sent
+        self.n_replaced = 0  # Snapshots replaced by a newer one before they were sent
+        self.closed = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self._send_snapshots,name='cii_map_sender',daemon=True).start()
+
+    def put(self,snapshot):
+        """ Makes the snapshot the next one to send, replacing any snapshot still waiting """
+        with self.condition:
+            if self.snapshot is not None:
+                self.n_replaced += 1
+            self.snapshot = snapshot
+            self.condition.notify()
+
+    def _send_snapshots(self):
+        """ Sender thread: sends the waiting snapshot, blocking till the plot process has taken it, until closed """
+        while True:
+            with self.condition:
+                while (self.snapshot is None) and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                snapshot, self.snapshot = self.snapshot, None
+            try:
+                self.connection.send(snapshot)
+            except OSError:  # The plot process has closed the pipe
+                return
+
+    def close(self):
+        """ Stops the sending. A snapshot still waiting is not sent """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+def run_cii_map_worker(connection,recorded_input_file,avg_bkg_fpc_dict=None,gridded=True,sky_grid_filename=None):
+    """ Main function of the worker process. Maps the recording (with its optional :Start:End suffix, or `LIVE` for the live capture)
+    and sends the snapshots through the connection, until the plot process sends the stop request or closes the pipe.
+    The co-added map is then saved into sky_grid_filename (see SkyGridMap.save). """
+    metrics = PipelineMetrics('cii_map')
+    live_reader = LiveFrameReader(LIVE_RING_BUFFER_FILE) if recorded_input_file == 'LIVE' else None
+    cii_map = StreamingCIIMap(avg_bkg_fpc_dict,n_good_signal_spectra=0 if gridded else N_GOOD_SIGNAL_SPECTRA)
+    sender = LatestSnapshotSender(connection)
+    n_snapshot_windows = None  # Number of windows in the last snapshot
+    n_new_frames = 0
+    # Wait for the stop request only while there are no new frames to process
+    while not connection.poll(0 if n_new_frames > 0 else WORKER_IDLE_SECONDS):
+        n_windows = len(cii_map.flux_list)
+        try:
+            with metrics.timer('processing_seconds'):
+                if live_reader is not None:
+                    n_new_frames = cii_map.read_live_frames(live_reader)
+                else:
+                    n_new_frames = cii_map.read_new_frames(recorded_input_file)
+        except EOFError:
+            n_new_frames = 0  # The recording is being written. Read it again later
+        metrics.count('frames_processed',n_new_frames)
+        metrics.count('windows_processed',len(cii_map.flux_list)-n_windows)
+        if len(cii_map.flux_list) != n_snapshot_windows:
+            with metrics.timer('snapshot_seconds'):
+                sender.put(cii_map.snapshot(gridded))
+            n_snapshot_windows = len(cii_map.flux_list)
+        metrics.set_gauge('snapshots_replaced',sender.n_replaced)
+        metrics.maybe_write()
+    sender.close()
+    if live_reader is not None:
+        live_reader.close()
+    if sky_grid_filename is not None:
+        cii_map.sky_grid.save(sky_grid_filename)
+        print('Saved the gridded map in {0} (load it with SkyGridMap.load)'.format(sky_grid_filename))
+
+
+class CIIMapWorker(object):
+    """ Starts the worker process mapping the recording (see run_cii_map_worker), and takes its snapshots in the plot process """
+
+    def __init__(self,recorded_input_file,avg_bkg_fpc_dict=None,gridded=True,sky_grid_filename=None):
+        context = multiprocessing.get_context(WORKER_START_METHOD)
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=run_cii_map_worker,name='cii_map_worker',daemon=True,
+                                               args=(worker_connection,recorded_input_file,avg_bkg_fpc_dict,gridded,sky_grid_filename))
+        self.process.start()
+        worker_connection.close()
+
+    def latest_snapshot(self):
+        """ Returns the newest snapshot which has arrived since the last call, or None if there is none. Does not wait for the worker """
+        snapshot = None
+        try:
+            while self.connection.poll():
+                snapshot = self.connection.recv()
+        except (EOFError, OSError):
+            pass  # The worker has stopped
+        return snapshot
+
+    def stop(self,timeout=60.):
+        """ Asks the worker to stop and save the map, and waits up to timeout seconds for it to finish """
+        try:
+            self.connection.send(STOP_REQUEST)
+        except OSError:
+            pass  # The worker has already stopped
+        self.process.join(timeout)
+        self.connection.close()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+""" This module implements the derived channels of the recordings, which are computed once from the raw words as the frames are recorded,
+instead of by every plot on every refresh.
+
+Usage: Telemetry_Derived_Channels.py RecordedTelemetryFile.tlm
+       (Re)computes the derived channels of an existing recording, e.g. an old or converted recording, or one whose recorder crashed.
+
+The derived channels are declared in the DERIVED_CHANNELS registry with register_derived_channel(), along with their dtype and the raw words they need.
+The FPC 1-4 and UPSCAN 1-4 channels come from interpolate_FPC_values, which DerivedChannelWriter runs on the frames before the other channels,
+since it needs the FPC triangle waveform of the recording and the neighbouring frames.
+The day of the year time axis is the 'TIME TICKS' channel divided by TICKS_PER_DAY.
+
+Record_Captured_Telemetry.py computes the derived channels incrementally as it appends to the recording.
+Each channel is kept in its own append only file in the directory beside the recording (recording filename + '.derived'),
+with one value per frame, in the same frame order as the 'TIME TICKS' channel:
+    File header (all little endian):
+        0   8s  Magic 'T100DRV1'
+        8   u4  Layout version
+        12  u4  Length of the numpy dtype string of the values
+        16  u4  Length of the UTF-8 channel name
+        20  u4  Unused
+        24  The dtype string and the channel name, followed by the values
+"""
+import os
+import sys
+import glob
+import numpy as np
+from Telemetry_Frame_Decoder import timestamp_ticks, day_of_year_to_ticks
+from Telemetry_Recording_File import iterate_recording_file
+
+DERIVED_MAGIC = b'T100DRV1'
+DERIVED_VERSION = 1
+DERIVED_HEADER_SIZE = 24
+TIME_CHANNEL = 'TIME TICKS'  # Channel of the int64 time ticks of the frames, to which all the other channels are aligned
+
+DERIVED_CHANNELS = {}  # Name -> (numpy dtype, raw words needed, function returning the channel array from the data dict of the frames)
+
+def register_derived_channel(name,dtype,inputs):
+    """ Decorator which registers the function(data_dict) as the derived channel name of the dtype, computed from the inputs raw words """
+    def register(function):
+        DERIVED_CHANNELS[name] = (np.dtype(dtype),tuple(inputs),function)
+        return function
+    return register
+
+register_derived_channel(TIME_CHANNEL,'<i8',['DAY','HH','MM','SEC','MSEC'])(timestamp_ticks)
+
+@register_derived_channel('Time HL','<u4',['Time H','Time L'])
+def time_HL(data_dict):
+    """ Combines the H and L Time counter words """
+    return np.asarray(data_dict['Time H'],dtype=np.int64)*4096 + np.asarray(data_dict['Time L'],dtype=np.int64)
+
+def fps_HL(data_dict,k):
+    """ FPS k values, combining the H and L words after shifting them right by 4 bits (divide by 16).
+    They reach 4095*16+4095//16 = 65775 for the 12 bit words, which does not fit in 16 bits """
+    return np.asarray(data_dict['FPS {0} H'.format(k)],dtype=np.int64)*256//16 + np.asarray(data_dict['FPS {0} L'.format(k)],dtype=np.int64)//16
+
+for k in range(1,5):
+    register_derived_channel('FPS {0} HL'.format(k),'<u4',['FPS {0} H'.format(k),'FPS {0} L'.format(k)])(lambda data_dict,k=k: fps_HL(data_dict,k))
+
+@register_derived_channel('FPC Up/Down','u1',['FPS SCAN STATUS'])
+def fpc_up_down(data_dict):
+    """ Up/Down scan bit (bit 2) of the FPS SCAN STATUS word.
+    Same as int(format(sbit,'b')[-3]) if (len(format(sbit,'b')) > 3) else 0 , i.e. the bit is only read if the status word is 4 bits or longer """
+    scan_status = np.asarray(data_dict['FPS SCAN STATUS'],dtype=np.int64)
+    return np.where(scan_status >= 8,(scan_status >> 2) & 1,0)
+
+# ALERT: For unknow reason, testing on 2018 Oct W3 data shows, the Elevation is given by 'Fine Xelev. S. E.' and Xel by 'Fine Elev. S. E.'. Reason Unknown!!!!!!
+@register_derived_channel('el','<f8',['Fine Xelev. S. E.','S.T. Elev. Error'])
+def el_channel(data_dict):
+    """ Elevation of the pointing from the fine sun sensor and star tracker words """
+    return np.array(data_dict['Fine Xelev. S. E.']) + (np.array(data_dict['S.T. Elev. Error'])-2048)*-0.02188  # 0.022 is Approximate scaling value fom SKG's code # Ignoring corss talk
+
+@register_derived_channel('xel','<f8',['Fine Elev. S. E.','S.T. Xelev. Error'])
+def xel_channel(data_dict):
+    """ Cross elevation of the pointing from the fine sun sensor and star tracker words """
+    return np.array(data_dict['Fine Elev. S. E.']) + (np.array(data_dict['S.T. Xelev. Error'])-2048)*-0.02217
+
+# Computed by interpolate_FPC_values before the other channels (see DerivedChannelWriter)
+for name,dtype in [('FPC 1','<f8'),('FPC 2','<f8'),('FPC 3','<u2'),('FPC 4','<f8')] + [('UPSCAN {0}'.format(k),'u1') for k in range(1,5)]:
+    register_derived_channel(name,dtype,['FPC COUNTER','FPS SCAN STATUS'])(lambda data_dict,name=name: data_dict[name])
+
+
+def derived_channel(data_dict,name):
+    """ Returns the derived channel of the frames, from the data dict if it already has it (e.g. read from the recording), else computed from the raw words """
+    if name in data_dict:
+        return data_dict[name]
+    return DERIVED_CHANNELS[name][2](data_dict)
+
+def derived_directory(recording_filename):
+    """ Returns the directory of the derived channels of the recording """
+    return recording_filename + '.derived'
+
+def channel_filename(recording_filename,index):
+    """ Returns the file name of the derived channel with the index in the channels of the writer """
+    return os.path.join(derived_directory(recording_filename),'channel_{0:03d}.drv'.format(index))
+
+
+class DerivedChannelWriter(object):
+    """ Writes the derived channels of a new recording. The frames given to append() should be the same as those appended to the recording.
+    The frames are only written once the FPC triangle waveform is estimated, and the latest frame is kept till the next append(),
+    since its UPSCAN 4 needs the FPC of the next frame. The channels of all the written frames are final. """
+
+    def __init__(self,recording_filename,channels=None):
+        # Imported here, since Telemetry_Processing imports this module
+        from Telemetry_Processing import FPCTriangleWaveform, interpolate_FPC_values
+        self._interpolate_FPC_values = interpolate_FPC_values
+        self.waveform = FPCTriangleWaveform()
+        self.recording_filename = recording_filename
+        self.channels = [TIME_CHANNEL] + [name for name in (channels or DERIVED_CHANNELS) if name != TIME_CHANNEL]
+        self.inputs = sorted(set(['FPC COUNTER','FPS SCAN STATUS']+[w_name for name in self.channels for w_name in DERIVED_CHANNELS[name][1]]))
+        os.makedirs(derived_directory(recording_filename),exist_ok=True)
+        for old_filename in glob.glob(os.path.join(derived_directory(recording_filename),'channel_*.drv')):
+            os.remove(old_filename)  # Left over from an earlier recording with the same name
+        self._files = []
+        for index,name in enumerate(self.channels):
+            dtype_string, name_bytes = DERIVED_CHANNELS[name][0].str.encode('ascii'), name.encode('utf-8')
+            channelfile = open(channel_filename(recording_filename,index),'wb')
+            channelfile.write(DERIVED_MAGIC)
+            channelfile.write(np.array([DERIVED_VERSION,len(dtype_string),len(name_bytes),0],dtype='<u4').tobytes())
+            channelfile.write(dtype_string + name_bytes)
+            self._files.append(channelfile)
+        self._context = None  # Last written frame, whose FPC 4 the UPSCAN 1 of the next frame needs
+        self._pending = {w_name:np.empty(0,dtype=np.int64) for w_name in self.inputs}  # Frames not yet written
+        self.n_frames = 0  # Number of frames written
+
+    def append(self,data_dict):
+        """ Appends the frames in the data dictionary of equal length column arrays, in increasing time order """
+        new_data_dict = {w_name:np.asarray(data_dict[w_name],dtype=np.int64) for w_name in self.inputs}
+        self._pending = {w_name:np.concatenate((self._pending[w_name],new_data_dict[w_name])) for w_name in self.inputs}
+        if self.waveform.update(new_data_dict['FPC COUNTER']):
+            self._write_pending(final=False)
+
+    def _write_pending(self,final):
+        """ Computes and writes the channels of the pending frames, except the latest one unless final """
+        n_context = 0 if self._context is None else 1
+        batch_dict = self._pending if self._context is None else \
+                     {w_name:np.concatenate((self._context[w_name],self._pending[w_name])) for w_name in self.inputs}
+        n_batch = len(batch_dict['FPC COUNTER'])
+        end = n_batch if final else n_batch-1
+        if end <= n_context:
+            return
+        batch_dict = dict(batch_dict)
+        batch_dict['FPC Up/Down'] = fpc_up_down(batch_dict)
+        batch_dict = self._interpolate_FPC_values(batch_dict,*self.waveform.parameters())
+        for name,channelfile in zip(self.channels,self._files):
+            dtype, _, function = DERIVED_CHANNELS[name]
+            channelfile.write(np.asarray(function(batch_dict)[n_context:end]).astype(dtype).tobytes())
+        self.n_frames += end - n_context
+        self._context = {w_name:batch_dict[w_name][end-1:end] for w_name in self.inputs}
+        self._pending = {w_name:batch_dict[w_name][end:] for w_name in self.inputs}
+
+    def flush(self):
+        """ Writes out the channels to the files """
+        for channelfile in self._files:
+            channelfile.flush()
+
+    def close(self):
+        """ Writes the latest frame and closes the files. The frames recorded before the FPC triangle waveform could be estimated are left out """
+        if self._files and self.waveform.estimated:
+            self._write_pending(final=True)
+        for channelfile in self._files:
+            channelfile.close()
+        self._files = []
+
+
+def build_derived_channels(recording_filename):
+    """ Computes the derived channels of the existing recording file. Returns the number of frames written """
+    writer = DerivedChannelWriter(recording_filename)
+    for columns, time_ticks, frames in iterate_recording_file(recording_filename):
+        writer.append({w_name:frames[i] for i,w_name in enumerate(columns)})
+    writer.close()
+    return writer.n_frames
+
+
+def read_channel_header(channelfile):
+    """ Reads the header of the open derived channel file. Returns the (channel name, dtype, offset of the values) """
+    if channelfile.read(len(DERIVED_MAGIC)) != DERIVED_MAGIC:
+        raise ValueError('{0} is not a derived channel file'.format(channelfile.name))
+    version, dtype_length, name_length, _ = np.frombuffer(channelfile.read(16),dtype='<u4')
+    if version != DERIVED_VERSION:
+        raise ValueError('Unsupported derived channel version {0} in {1}'.format(version,channelfile.name))
+    dtype = np.dtype(channelfile.read(int(dtype_length)).decode('ascii'))
+    name = channelfile.read(int(name_length)).decode('utf-8')
+    return name, dtype, DERIVED_HEADER_SIZE + int(dtype_length) + int(name_length)
+
+
+def derived_channel_files(recording_filename):
+    """ Returns the dictionary of the file name of each derived channel of the recording (empty if it has none) """
+    channel_files = {}
+    for filename in sorted(glob.glob(os.path.join(derived_directory(recording_filename),'channel_*.drv'))):
+        with open(filename,'rb') as channelfile:
+            name, _, _ = read_channel_header(channelfile)
+        channel_files[name] = filename
+    return channel_files
+
+
+def has_derived_channels(recording_filename,names):
+    """ Returns True if the recording has all the derived channel names """
+    channel_files = derived_channel_files(recording_filename)
+    return all(name in channel_files for name in names)
+
+
+def read_channel_file(filename):
+    """ Returns the (channel name, memory mapped array of the values) of the derived channel file """
+    with open(filename,'rb') as channelfile:
+        name, dtype, offset = read_channel_header(channelfile)
+        n_values = (os.fstat(channelfile.fileno()).st_size - offset)//dtype.itemsize
+    if n_values <= 0:
+        return name, np.empty(0,dtype=dtype)
+    return name, np.memmap(filename,dtype=dtype,mode='r',offset=offset,shape=(n_values,))
+
+
+def read_derived_channels(recording_filename,names,start_time=None,end_time=None,since_ticks=None):
+    """ Returns the data dictionary of the derived channel names (and 'TIME TICKS') of the frames inside the optional time window,
+    or None if the recording does not have all of them. Only the files of these channels are read.
+    The start_time, end_time and since_ticks are as in Telemetry_Recording_File.read_recording_file """
+    channel_files = derived_channel_files(recording_filename)
+    names = [TIME_CHANNEL] + [name for name in names if name != TIME_CHANNEL]
+    if any(name not in channel_files for name in names):
+        return None
+    channel_arrays = dict(read_channel_file(channel_files[name]) for name in names)
+    # The channels written by the recorder so far can differ in length by the last write
+    n_frames = min(len(values) for values in channel_arrays.values())
+    time_ticks = channel_arrays[TIME_CHANNEL][:n_frames]
+    start_ticks = day_of_year_to_ticks(start_time) if start_time is not None else None
+    if since_ticks is not None:
+        start_ticks = since_ticks+1 if start_ticks is None else max(start_ticks,since_ticks+1)
+    first = np.searchsorted(time_ticks,start_ticks,side='left') if start_ticks is not None else 0
+    last = np.searchsorted(time_ticks,day_of_year_to_ticks(end_time),side='right') if end_time is not None else n_frames
+    return {name:np.array(values[first:max(first,last)]) for name,values in channel_arrays.items()}
+
+if __name__ == '__main__':
+    n_frames = build_derived_channels(sys.argv[1])
+    print('Computed the derived channels of {0} frames of {1} in {2}'.format(n_frames,sys.argv[1],derived_directory(sys.argv[1])))
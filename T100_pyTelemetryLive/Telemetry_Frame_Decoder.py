@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+""" This module decodes the raw UDP telemetry packets into rows of word values.
+
+The frame layout is built once from TelemetryFrameWords.txt, after which a packet (or a batch of packets)
+is decoded into a uint16 row with a single numpy operation, instead of the per word hex string round trip.
+The rows can also be encoded back into packets, to replay recordings or send synthetic telemetry.
+"""
+import os
+import numpy as np
+
+# Only the following selected words are extracted from the frame and saved into the FIFO file
+words_to_extract = ['SYNC 0','SYNC 1','SYNC 2']+\
+                   ['MAG - I','MAG - II','Coarse Elev. S. E.']+\
+                   ['PDA No. {0}'.format(i+1) for i in range(8)]+\
+                   ['DC PDA {0}'.format(i+1) for i in range(8)]+\
+                   ['S.T. Elev. Error','S.T. Xelev. Error']+\
+                   ['Fine Elev. S. E.','Fine Xelev. S. E.']+\
+                   ['Time H','Time L','Command Address','Command Data','Frame Number']+\
+                   ['FPC COUNTER','DET SIGNAL','FPS SCAN STATUS']+\
+                   ['FPS {0} L'.format(i+1) for i in range(4)]+\
+                   ['FPS {0} H'.format(i+1) for i in range(4)]
+
+# Time stamp prefix sent along with each UDP packet
+extra_frameprefix_keywords = ['DAY','HH','MM','SEC','MSEC']
+
+FRAME_WORD_OFFSET = 11  # Byte offset in the UDP packet where the telemetry word 0 starts (5 words + 1 byte prefix)
+TIMESTAMP_PREFIX_SLICE = slice(4,11) # Bytes of the BCD time stamp prefix: DAY(2) HH(1) MM(1) SEC(1) MSEC(2)
+# Telemetry definition file beside this module, so that the scripts can be run from any folder
+TELEMETRY_WORD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'TelemetryFrameWords.txt')
+
+
+def load_telemetry_word_file(word_filename=TELEMETRY_WORD_FILE):
+    """ Returns a dictionary of the words and the position number in a frame from the Telemetry definition file TelemetryFrameWords.txt"""
+    word_dict = {}
+    with open(word_filename,'r') as framewordfile:
+        for line in framewordfile:
+            line = line.rstrip()
+            if len(line.split()) > 1:
+                word_dict[' '.join(line.split()[1:])] = int(line.split()[0])
+    return word_dict
+
+
+def build_frame_layout(word_dict,words=words_to_extract):
+    """ Returns the frame layout dictionary used by the decode functions.
+    The layout stores the column names of the decoded row (`words` followed by the time stamp prefix keywords),
+    the word positions to pick from the frame, and the minimum packet length needed to decode them."""
+    word_index = np.array([word_dict[w_name] for w_name in words],dtype=np.intp)
+    n_frame_words = int(word_index.max()) + 1
+    return {'columns': list(words) + extra_frameprefix_keywords,
+            'word_index': word_index,
+            'n_frame_words': n_frame_words,
+            'packet_length': FRAME_WORD_OFFSET + 2*n_frame_words}
+
+
+# Decimal value of each BCD byte, which holds two decimal digits, one in each nibble
+BCD_BYTE_VALUE = np.array([(b >> 4)*10 + (b & 0x0F) for b in range(256)],dtype=np.uint16)
+
+def decode_bcd_timestamps(prefix_bytes):
+    """ Decodes an (N,7) uint8 array of the BCD time stamp prefix bytes into an (N,5) uint16 array of DAY,HH,MM,SEC,MSEC"""
+    two_digits = BCD_BYTE_VALUE[np.asarray(prefix_bytes,dtype=np.uint8)]
+    timestamps = np.empty((two_digits.shape[0],5),dtype=np.uint16)
+    timestamps[:,0] = two_digits[:,0]*100 + two_digits[:,1]  # DAY
+    timestamps[:,1:4] = two_digits[:,2:5]  # HH MM SEC
+    timestamps[:,4] = two_digits[:,5]*100 + two_digits[:,6]  # MSEC
+    return timestamps
+
+
+def decode_packets(messages,layout):
+    """ Decodes a list of UDP packets (bytes) of same length into an (N,ncolumns) uint16 array in the column order of layout['columns'] """
+    packet_length = layout['packet_length']
+    raw = np.frombuffer(b''.join(message[:packet_length] for message in messages),dtype=np.uint8).reshape(len(messages),packet_length)
+    return decode_packet_array(raw,layout)
+
+
+def decode_packet_array(raw,layout):
+    """ Decodes an (N,packet_length) uint8 array of UDP packets into an (N,ncolumns) uint16 array """
+    n_words = len(layout['word_index'])
+    rows = np.empty((raw.shape[0],n_words+len(extra_frameprefix_keywords)),dtype=np.uint16)
+    # Words are sent LSB first, so reading them as little endian uint16 swaps the bytes into place
+    frame_words = raw[:,FRAME_WORD_OFFSET:layout['packet_length']].copy().view('<u2')
+    # Shift one parity bit out
+    rows[:,:n_words] = frame_words[:,layout['word_index']] >> 1
+    rows[:,n_words:] = decode_bcd_timestamps(raw[:,TIMESTAMP_PREFIX_SLICE])
+    return rows
+
+
+def encode_bcd(values,n_bytes):
+    """ Returns the (N,n_bytes) uint8 array of the BCD encoded (two decimal digits per byte) values, most significant byte first """
+    values = np.asarray(values,dtype=np.int64)
+    bcd = np.empty((len(values),n_bytes),dtype=np.uint8)
+    for b in range(n_bytes-1,-1,-1):
+        two_digits = values % 100
+        bcd[:,b] = (two_digits//10)*16 + two_digits % 10
+        values = values//100
+    return bcd
+
+
+def encode_packet_array(rows,layout):
+    """ Encodes an (N,ncolumns) array of rows in the column order of layout['columns'] into an (N,packet_length) uint8 array of UDP packets.
+    This is the inverse of decode_packet_array. The packet header and the words not in the layout are zero."""
+    rows = np.asarray(rows)
+    n_words = len(layout['word_index'])
+    raw = np.zeros((rows.shape[0],layout['packet_length']),dtype=np.uint8)
+    frame_words = np.zeros((rows.shape[0],layout['n_frame_words']),dtype='<u2')
+    frame_words[:,layout['word_index']] = rows[:,:n_words].astype(np.uint16) << 1  # Zero parity bit
+    raw[:,FRAME_WORD_OFFSET:] = frame_words.view(np.uint8)
+    day, hh, mm, sec, msec = rows[:,n_words:n_words+5].T
+    raw[:,TIMESTAMP_PREFIX_SLICE] = np.concatenate([encode_bcd(day,2),encode_bcd(hh,1),encode_bcd(mm,1),
+                                                    encode_bcd(sec,1),encode_bcd(msec,2)],axis=1)
+    return raw
+
+
+def decode_packet(message,layout):
+    """ Decodes a single UDP packet (bytes) into a uint16 row in the column order of layout['columns'] """
+    n_words = len(layout['word_index'])
+    row = np.empty(n_words+len(extra_frameprefix_keywords),dtype=np.uint16)
+    row[:n_words] = np.frombuffer(message,dtype='<u2',count=layout['n_frame_words'],offset=FRAME_WORD_OFFSET)[layout['word_index']]
+    row[:n_words] >>= 1  # Shift one parity bit out
+    two_digits = BCD_BYTE_VALUE[np.frombuffer(message,dtype=np.uint8,count=7,offset=TIMESTAMP_PREFIX_SLICE.start)]
+    row[n_words] = two_digits[0]*100 + two_digits[1]  # DAY
+    row[n_words+1:n_words+4] = two_digits[2:5]  # HH MM SEC
+    row[n_words+4] = two_digits[5]*100 + two_digits[6]  # MSEC
+    return row
+
+
+TICKS_PER_DAY = 24*60*60*10000  # Integer time ticks are in the units of MSEC field (0.1 milli second)
+
+def timestamp_ticks(data_dict):
+    """ Returns the int64 time ticks (0.1 ms units since the start of the year) of the frames from the DAY,HH,MM,SEC,MSEC columns """
+    return (((np.asarray(data_dict['DAY'],dtype=np.int64)*24 + np.asarray(data_dict['HH'],dtype=np.int64))*60 +
+             np.asarray(data_dict['MM'],dtype=np.int64))*60 + np.asarray(data_dict['SEC'],dtype=np.int64))*10000 +\
+            np.asarray(data_dict['MSEC'],dtype=np.int64)
+
+def day_of_year_to_ticks(day_of_year):
+    """ Converts the float day of the year time into int64 time ticks """
+    return int(round(day_of_year*TICKS_PER_DAY))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+""" This module is a lightweight metrics layer for the capture, recorder and plot scripts.
+
+Each script keeps its counters, gauges and latency histograms in a PipelineMetrics object,
+which is written out periodically as a small JSON stats file on the tmpfs RAM disk
+(/mnt/tmp_fast/T100_metrics_<name>.json). Watch_Pipeline_Metrics.py prints all of them live.
+Optionally, 1 in N calls of a stage can be run under cProfile, and the accumulated profile is saved beside the stats file.
+"""
+import os
+import json
+import time
+import cProfile
+import pstats
+from contextlib import contextmanager
+import numpy as np
+
+METRICS_DIRECTORY = '/mnt/tmp_fast'
+METRICS_FILE_PREFIX = 'T100_metrics_'
+
+# Histogram bucket upper edges in seconds. Log spaced from 1 micro second to 100 seconds
+HISTOGRAM_EDGES = np.logspace(-6,2,33)
+
+def metrics_filename(name,directory=METRICS_DIRECTORY):
+    """ Returns the stats file name of the metrics `name` """
+    return os.path.join(directory,'{0}{1}.json'.format(METRICS_FILE_PREFIX,name))
+
+
+class LatencyHistogram(object):
+    """ Histogram of latencies in seconds, with log spaced buckets """
+
+    def __init__(self):
+        self.bucket_counts = np.zeros(len(HISTOGRAM_EDGES)+1,dtype=np.int64)
+        self.count = 0
+        self.total = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def observe(self,seconds):
+        """ Adds a latency measurement """
+        self.bucket_counts[np.searchsorted(HISTOGRAM_EDGES,seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min,seconds)
+        self.max = max(self.max,seconds)
+
+    def quantile(self,q):
+        """ Returns the upper edge of the bucket containing the q quantile """
+        if self.count == 0:
+            return None
+        bucket = int(np.searchsorted(np.cumsum(self.bucket_counts),q*self.count))
+        return float(HISTOGRAM_EDGES[min(bucket,len(HISTOGRAM_EDGES)-1)])
+
+    def summary(self):
+        """ Returns a dictionary summary of the histogram """
+        if self.count == 0:
+            return {'count':0}
+        return {'count':self.count,'mean':self.total/self.count,'min':self.min,'max':self.max,
+                'p50':self.quantile(0.5),'p90':self.quantile(0.9),'p99':self.quantile(0.99)}
+
+
+class PipelineMetrics(object):
+    """ Counters, gauges and latency histograms of one pipeline script, written to its stats file every write_interval seconds.
+    If profile_every is not None, 1 in profile_every calls of each profiled() stage is run under cProfile. """
+
+    def __init__(self,name,directory=METRICS_DIRECTORY,write_interval=1.,profile_every=None):
+        self.name = name
+        self.filename = metrics_filename(name,directory)
+        self.write_interval = write_interval
+        self.profile_every = profile_every
+        self.start_time = time.time()
+        self.last_write_time = 0.
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._profile_calls = {}
+        self._profile_stats = None
+
+    def count(self,counter_name,n=1):
+        """ Increments the counter by n """
+        self.counters[counter_name] = self.counters.get(counter_name,0) + n
+
+    def set_gauge(self,gauge_name,value):
+        """ Sets the gauge to its latest value """
+        self.gauges[gauge_name] = value
+
+    def observe(self,histogram_name,seconds):
+        """ Adds a latency measurement in seconds into the histogram """
+        try:
+            self.histograms[histogram_name].observe(seconds)
+        except KeyError:
+            self.histograms[histogram_name] = LatencyHistogram()
+            self.histograms[histogram_name].observe(seconds)
+
+    @contextmanager
+    def timer(self,histogram_name):
+        """ Context manager which adds the time spent inside it into the histogram """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(histogram_name,time.perf_counter()-t0)
+
+    @contextmanager
+    def profiled(self,stage_name):
+        """ Context manager which times the stage into the histogram stage_name, and runs 1 in profile_every calls under cProfile """
+        n_calls = self._profile_calls.get(stage_name,0)
+        self._profile_calls[stage_name] = n_calls + 1
+        if (self.profile_every is None) or (n_calls % self.profile_every != 0):
+            with self.timer(stage_name):
+                yield
+            return
+        profiler = cProfile.Profile()
+        t0 = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.observe(stage_name,time.perf_counter()-t0)
+            if self._profile_stats is None:
+                self._profile_stats = pstats.Stats(profiler)
+            else:
+                self._profile_stats.add(profiler)
+
+    def summary(self):
+        """ Returns a dictionary of all the metrics """
+        now = time.time()
+        return {'name':self.name,'pid':os.getpid(),'time':now,'uptime':now-self.start_time,
+                'counters':self.counters,'gauges':self.gauges,
+                'histograms':{h_name:histogram.summary() for h_name,histogram in self.histograms.items()}}
+
+    def write(self):
+        """ Writes the stats file (and the cProfile stats if any) atomically """
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename,'w') as statsfile:
+            json.dump(self.summary(),statsfile)
+        os.replace(tmp_filename,self.filename)
+        if self._profile_stats is not None:
+            self._profile_stats.dump_stats(self.filename.replace('.json','.pstats'))
+        self.last_write_time = time.time()
+
+    def maybe_write(self,force=False):
+        """ Writes the stats file if write_interval seconds have passed since the last write (or always if force is True).
+        If the file cannot be written, the writing is disabled after a warning. """
+        if (self.filename is not None) and (force or (time.time() - self.last_write_time >= self.write_interval)):
+            try:
+                self.write()
+            except OSError as e:
+                print('WARNING: Could not write metrics file {0}: {1}. Metrics are disabled.'.format(self.filename,e))
+                self.filename = None
+
+
+def read_all_metrics(directory=METRICS_DIRECTORY):
+    """ Returns a list of the summary dictionaries in all the stats files in the directory """
+    all_metrics = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith(METRICS_FILE_PREFIX) and filename.endswith('.json'):
+            try:
+                with open(os.path.join(directory,filename),'r') as statsfile:
+                    all_metrics.append(json.load(statsfile))
+            except (OSError, ValueError):
+                continue
+    return all_metrics
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+""" This module holds the numeric processing of the telemetry frames shared by the plot, map and batch scripts:
+loading the recordings and the live FIFO ring buffer, the time axis, and the FPC triangle waveform interpolation.
+
+It does not import matplotlib, so that the headless tools start quickly and run on machines without a display.
+"""
+import pickle
+import numpy as np
+from Telemetry_Ring_Buffer import is_ring_buffer_file, read_ring_buffer_file
+from Telemetry_Recording_File import is_recording_file, read_recording_file
+from Telemetry_Frame_Decoder import TICKS_PER_DAY, timestamp_ticks
+from Telemetry_Derived_Channels import derived_channel, has_derived_channels, read_derived_channels
+
+FPC_DRIFT_TOLERANCE = 10  # FPC counts by which the FPC COUNTER samples can deviate from the estimated triangle waveform before it is re-estimated
+
+def load_pickle_data_dict_file(raw_data_dict_file,n_live_frames=None,since_ticks=None,derived_channels=None):
+    """ Loads pickled dictionary file inside the optional time interval defined by :Start:End suffix
+    If the file is the live FIFO ring buffer, only the latest n_live_frames (default: all) frames are loaded.
+    If since_ticks is given, only the frames with time ticks after it are loaded (see Telemetry_Frame_Decoder.timestamp_ticks).
+    If the list of derived_channels is given and the file is a recording which has them (see Telemetry_Derived_Channels.py),
+    only these channels and the 'TIME TICKS' are loaded instead of the raw words."""
+    try:
+        start_time = float(raw_data_dict_file.split(':')[1])
+    except (IndexError, ValueError):
+        start_time = ''
+    try:
+        end_time = float(raw_data_dict_file.split(':')[2])
+    except (IndexError, ValueError):
+        end_time = ''
+    data_dict_file = raw_data_dict_file.split(':')[0]
+
+    if is_ring_buffer_file(data_dict_file):
+        full_data_dict = read_ring_buffer_file(data_dict_file,n_frames=n_live_frames)
+    elif (derived_channels is not None) and is_recording_file(data_dict_file) and has_derived_channels(data_dict_file,derived_channels):
+        full_data_dict = read_derived_channels(data_dict_file,derived_channels,
+                                               start_time=start_time if start_time != '' else None,
+                                               end_time=end_time if end_time != '' else None,
+                                               since_ticks=since_ticks)
+    elif is_recording_file(data_dict_file):
+        # Only the chunks overlapping the time window are read, using the time index of the recording
+        full_data_dict = read_recording_file(data_dict_file,
+                                             start_time=start_time if start_time != '' else None,
+                                             end_time=end_time if end_time != '' else None,
+                                             since_ticks=since_ticks)
+    else:
+        # Read the pickled file first and ask pickle to deserialise to python dictionay object
+        read_data = open(data_dict_file,'rb').read()
+        full_data_dict = pickle.loads(read_data)
+    if (since_ticks is not None) and not is_recording_file(data_dict_file):
+        since_mask = timestamp_ticks(full_data_dict) > since_ticks
+        full_data_dict = {w_name:np.array(full_data_dict[w_name])[since_mask] for w_name in full_data_dict}
+
+    # Strip out any data which is outside the optional Start and End time.
+    data_dict = strip_data_outside_timestamp(full_data_dict,start_t=start_time,end_t=end_time)
+
+    return data_dict
+
+def strip_data_outside_timestamp(data_dict,start_t='',end_t=''):
+    """ Strips out the data before start_1 and after end_t """
+    if 'TIME TICKS' in data_dict: # Recordings already have the integer time stamps
+        time_axis = np.asarray(data_dict['TIME TICKS'])/TICKS_PER_DAY
+    else:
+        time_axis = np.array(data_dict['DAY'])+np.array(data_dict['HH'])/24.+\
+                    np.array(data_dict['MM'])/(24*60.)+np.array(data_dict['SEC'])/(24*60*60.)+\
+                    np.array(data_dict['MSEC'])/(24*60*60*10000.)
+    mask = time_axis > 0 # Initialise mask for all positive time data
+    if start_t is not '':
+        mask[time_axis<start_t] = False
+    if end_t is not '':
+        mask[time_axis>end_t] = False
+    new_dict = {}
+    for w_name in data_dict:
+        new_dict[w_name] = np.array(data_dict[w_name])[mask]
+        if new_dict[w_name].dtype.kind == 'u': # Unsigned words would wrap around in the arithmetic of the processing
+            new_dict[w_name] = new_dict[w_name].astype(np.int64)
+    return new_dict
+
+
+def process_raw_data_dict(data_queue_dict,MaxDiff=None,maxtp=None,mintp=None,dtype=np.float64):
+    """ This function does all the processing of the raw data dict frames for display.
+    The interpolated FPC values are of the dtype (np.float32 halves their memory).
+    Channels which the data dict already has (e.g. the derived channels read from the recording) are not computed again."""
+    # Combine the H and L Time counter in telmetry to a new keyword Time HL
+    data_queue_dict['Time HL'] = derived_channel(data_queue_dict,'Time HL')
+    # Calculate 16bit FPS values by combining the H and L words after shifting to right by 4 bits (divide by 16)
+    for i in range(4):
+        data_queue_dict['FPS {0} HL'.format(i+1)] = derived_channel(data_queue_dict,'FPS {0} HL'.format(i+1))
+
+    # Extract the Up/DOWN scan bit (bit 2) from the FPS SCAN STATUS word and save it to 'FPC Up/Down'
+    data_queue_dict['FPC Up/Down'] = derived_channel(data_queue_dict,'FPC Up/Down')
+
+    # Calculate FPC values for the 4 FPS values inside each frame
+    if 'UPSCAN 4' not in data_queue_dict:
+        data_queue_dict = interpolate_FPC_values(data_queue_dict,
+                                                 MaxDiff=MaxDiff,maxtp=maxtp,mintp=mintp,dtype=dtype)
+
+    return data_queue_dict
+
+def estimate_FPC_triangle_waveform(FPC3_array,MaxDiff=None,maxtp=None,mintp=None):
+    """ Returns the (MaxDiff, maxtp, mintp) of the FPC triangle waveform. Values which are None are estimated from the FPC3_array """
+    # If turning points maxtp and mintp are not provided, we shall estimate them from data.
+    if MaxDiff is None: # This is almost always 520 in fast scan
+        # We take the most frequent difference between the point sas the actuall difference between rows
+        MaxDiff = np.argmax(np.bincount(np.abs(np.diff(FPC3_array))))
+        #----
+        # The command below is slower, but will work for non-integer FPC values also. If ever needed!!
+        # from scipy.stats import mode  # Add this in begining of code.
+        # MaxDiff = mode(np.abs(DataT['rawTele_FPC'][1:]-DataT['rawTele_FPC'][:-1]))[0][0]
+        #----
+    if (maxtp is None) or (mintp is None):
+        # The max turning point can be calculated as (sum of the top most points + Distance between them )/ 2
+        maxtp = np.max((FPC3_array[1:]+FPC3_array[:-1] +MaxDiff)/2)
+        # Similarly, min is the (sum of the bottom most points - Distance between them )/ 2
+        mintp = np.min((FPC3_array[1:]+FPC3_array[:-1] -MaxDiff)/2)
+
+        print('Estimated FPC Triangle Waveform.')
+        print('SampleGap= {0}, MaxTurningPoint= {1}, MinTurningPoint= {2}'.format(MaxDiff,maxtp,mintp))
+
+    return MaxDiff, maxtp, mintp
+
+def FPC_triangle_waveform_drifted(FPC3_array,MaxDiff,maxtp,mintp,tolerance=FPC_DRIFT_TOLERANCE):
+    """ Returns True if the FPC3_array samples do not fit the (MaxDiff, maxtp, mintp) triangle waveform within the tolerance.
+    i.e. if the samples go beyond the turning points, or (checked only if the samples cover two periods of the triangle)
+    if the turning points moved inwards or most of the differences between the samples are not MaxDiff."""
+    if len(FPC3_array) < 2:
+        return False
+    pair_sum = FPC3_array[1:] + FPC3_array[:-1]
+    top = (pair_sum.max() + MaxDiff)/2
+    bottom = (pair_sum.min() - MaxDiff)/2
+    if (top > maxtp + tolerance) or (bottom < mintp - tolerance):
+        return True
+    period = 2*(maxtp-mintp)/max(MaxDiff,1)  # In number of frames
+    if len(FPC3_array) <= 2*period + 2:
+        return False  # Too few samples to check the rest
+    if (top < maxtp - tolerance) or (bottom > mintp + tolerance):
+        return True
+    steps = np.abs(np.diff(FPC3_array))
+    return np.count_nonzero(np.abs(steps - MaxDiff) > tolerance) > len(steps)//2
+
+class FPCTriangleWaveform(object):
+    """ Caches the estimate of the FPC triangle waveform (MaxDiff, maxtp, mintp), and re-estimates it only when the new FPC COUNTER samples drift away from it.
+    The parameters which are given (not None) are never estimated. The first estimate and the re-estimates need min_estimate_frames samples."""
+
+    def __init__(self,MaxDiff=None,maxtp=None,mintp=None,min_estimate_frames=100,tolerance=FPC_DRIFT_TOLERANCE):
+        self.given = (MaxDiff, maxtp, mintp)
+        self.MaxDiff, self.maxtp, self.mintp = MaxDiff, maxtp, mintp
+        self.min_estimate_frames = min_estimate_frames
+        self.tolerance = tolerance
+        self._pending = []  # FPC COUNTER samples waiting for the (re)estimate
+        self._last_sample = np.empty(0,dtype=np.int64)
+
+    @property
+    def estimated(self):
+        """ True if all the waveform parameters are available """
+        return (self.MaxDiff is not None) and (self.maxtp is not None) and (self.mintp is not None)
+
+    def parameters(self):
+        """ Returns the (MaxDiff, maxtp, mintp) """
+        return self.MaxDiff, self.maxtp, self.mintp
+
+    def update(self,FPC3_array):
+        """ Checks the new FPC COUNTER samples against the waveform, and (re)estimates it when needed.
+        Returns True if the waveform parameters are available. Till enough samples after a drift arrive, the old parameters are kept."""
+        FPC3_array = np.asarray(FPC3_array)
+        if len(FPC3_array) == 0 or all(p is not None for p in self.given):
+            return self.estimated
+        if self.estimated and not self._pending:
+            drifted = FPC_triangle_waveform_drifted(np.concatenate((self._last_sample,FPC3_array)),
+                                                    self.MaxDiff,self.maxtp,self.mintp,tolerance=self.tolerance)
+            self._last_sample = FPC3_array[-1:]
+            if not drifted:
+                return True
+            print('FPC Triangle Waveform drifted. Re-estimating it.')
+        self._pending.append(FPC3_array)
+        samples = np.concatenate(self._pending)
+        self._last_sample = samples[-1:]
+        if len(samples) >= self.min_estimate_frames:
+            self.MaxDiff, self.maxtp, self.mintp = estimate_FPC_triangle_waveform(samples,*self.given)
+            self._pending = []
+        return self.estimated
+
+def interpolate_FPC_values(data_queue_dict,MaxDiff=None,maxtp=None,mintp=None,dtype=np.float64):
+    """
+    Returns the Data dict after interpolating the 4 FPC values in each frame (FPC1,FPC2,FPC3,FPC4), 
+    based on the measured 'FPC COUNTER', which corresponds to FPS3 readout.
+    Assumption is that, the FPC is sampled from a neat triangular waveform.
+    If turning points (maxtp and mintp) are not inputed. It will try to estimate the turning points.
+    But, this needs atleast two points of the measured FPC to be on same ramp of triangle.
+    The interpolated FPC 1, 2 and 4 values are of the dtype.
+    """
+
+    FPC3_array = np.asarray(data_queue_dict['FPC COUNTER'])
+
+    # If turning points maxtp and mintp are not provided, we shall estimate them from data.
+    MaxDiff, maxtp, mintp = estimate_FPC_triangle_waveform(FPC3_array,MaxDiff=MaxDiff,maxtp=maxtp,mintp=mintp)
+
+    # Offsets of the FPS 1, 2 and 4 readouts from FPC3 in the up scan. They are the other way round in the down scan.
+    up_mask = np.asarray(data_queue_dict['FPC Up/Down']) != 0
+    step = np.where(up_mask,dtype(1),dtype(-1))
+    # Twice the turning point towards which a negative (in the up scan) offset moves, and the same for a positive offset
+    folding_point_negative = np.where(up_mask,dtype(2*mintp),dtype(2*maxtp))
+    folding_point_positive = np.where(up_mask,dtype(2*maxtp),dtype(2*mintp))
+    FPC3_values = FPC3_array.astype(dtype)
+    FPC_arrays = {}
+    for f,offset in ((1,-MaxDiff*2/4.),(2,-MaxDiff/4.),(4,MaxDiff/4.)):
+        FPC_array = FPC3_values + step*dtype(offset)
+        # Fold the values which overshoot the turning point they were moving towards, back into the triangular wave
+        towards_min = up_mask if offset < 0 else ~up_mask
+        overshoot = np.where(towards_min,FPC_array < mintp,FPC_array > maxtp)
+        folding_point = folding_point_negative if offset < 0 else folding_point_positive
+        np.subtract(folding_point,FPC_array,out=FPC_array,where=overshoot)
+        FPC_arrays[f] = FPC_array
+
+    #######################################
+    #Same as above,but slow. Kept here since this is more easier to understand the logic of the above steps.
+    #######################################
+    # for i,row in enumerate(DataT):
+    #     fpc3 = row['FPC COUNTER']
+
+    #     if int(row['FPC Up/Down']) == 1:  # Scan waveform is going UP
+    #         # Now we should fold the values into the triangular wave if they overshoot turning points
+    #         fpc1 = fpc3 - MaxDiff*2/4. if (fpc3 - MaxDiff*2/4.) > mintp else 2*mintp - (fpc3 - MaxDiff*2/4.)
+    #         fpc2 = fpc3 - MaxDiff/4. if (fpc3 - MaxDiff/4.) > mintp else 2*mintp - (fpc3 - MaxDiff/4.)
+    #         fpc4 = fpc3 + MaxDiff/4. if (fpc3 + MaxDiff/4.) < maxtp else 2*maxtp - (fpc3 + MaxDiff/4.)
+            
+    #     else: # Scan waveform is going DOWN
+    #         fpc1 = fpc3 + MaxDiff*2/4. if (fpc3 + MaxDiff*2/4.) < maxtp else 2*maxtp - (fpc3 + MaxDiff*2/4.)
+    #         fpc2 = fpc3 + MaxDiff/4. if (fpc3 + MaxDiff/4.) < maxtp else 2*maxtp - (fpc3 + MaxDiff/4.)
+    #         fpc4 = fpc3 - MaxDiff/4. if (fpc3 - MaxDiff/4.) > mintp else 2*mintp - (fpc3 - MaxDiff/4.)
+
+    #     # Update the table
+    #     DataT['FPC1'][i] = fpc1
+    #     DataT['FPC2'][i] = fpc2
+    #     DataT['FPC3'][i] = fpc3
+    #     DataT['FPC4'][i] = fpc4
+    #######################################
+
+    data_queue_dict['FPC 1'] = FPC_arrays[1]
+    data_queue_dict['FPC 2'] = FPC_arrays[2]
+    data_queue_dict['FPC 3'] = FPC3_array
+    data_queue_dict['FPC 4'] = FPC_arrays[4]
+
+    # Also add UPSCAN X arrays to identify up and down scans, from the sign of the gradient along the FPC values in the readout order
+    # FPC1[0],FPC2[0],FPC3[0],FPC4[0],FPC1[1],...  Same as np.gradient(np.dstack([FPC1,FPC2,FPC3,FPC4]).flatten()) > 0 ,
+    # where the central difference of each value is the difference of its next and previous values in the readout order.
+    FPC1_array, FPC2_array, FPC4_array = FPC_arrays[1], FPC_arrays[2], FPC_arrays[4]
+    n_frames = len(FPC3_array)
+    upscan = np.zeros((4,n_frames),dtype=bool)
+    if n_frames > 0:
+        upscan[0,1:] = FPC2_array[1:] > FPC4_array[:-1]
+        upscan[0,0] = FPC2_array[0] > FPC1_array[0]  # One sided difference at the first value
+        upscan[1] = FPC3_array > FPC1_array
+        upscan[2] = FPC4_array > FPC2_array
+        upscan[3,:-1] = FPC1_array[1:] > FPC3_array[:-1]
+        upscan[3,-1] = FPC4_array[-1] > FPC3_array[-1]  # One sided difference at the last value
+
+    # 1 is UP and 0 is DOWN as usuall
+    for f in range(4):
+        data_queue_dict['UPSCAN {0}'.format(f+1)] = upscan[f].astype(int)
+
+    return data_queue_dict
+
+
+def frame_count(data_dict):
+    """ Returns the number of frames in the data dict of equal length column arrays """
+    return len(next(iter(data_dict.values()))) if data_dict else 0
+
+
+class IncrementalDataProcessor(object):
+    """ Keeps the processed data dict of the latest max_frames frames between the refreshes of the live plot,
+    and runs process_raw_data_dict only on the frames which arrived since the last update.
+    If max_frames is None, all the frames are kept till they are removed by drop_frames().
+    The FPC triangle waveform parameters are estimated once (when min_estimate_frames are available) and reused afterwards,
+    till the FPC COUNTER drifts away from them (see FPCTriangleWaveform). The interpolated FPC values are of the dtype."""
+
+    def __init__(self,max_frames,MaxDiff=None,maxtp=None,mintp=None,min_estimate_frames=100,dtype=np.float64):
+        self.max_frames = max_frames
+        self.waveform = FPCTriangleWaveform(MaxDiff=MaxDiff,maxtp=maxtp,mintp=mintp,min_estimate_frames=min_estimate_frames)
+        self.dtype = dtype
+        self.raw_columns = None
+        self.data_dict = None
+        self._processed = False  # False while data_dict only has the raw frames waiting for the waveform estimate
+
+    def update(self,new_data_dict):
+        """ Processes the new raw frames and returns the processed data dict of the latest max_frames frames.
+        Returns None till there are enough frames to estimate the FPC triangle waveform.
+        Frames which are already processed (the derived channels read from a recording) are only appended."""
+        if frame_count(new_data_dict) == 0:
+            return self.data_dict if self._processed else None
+        if 'UPSCAN 4' in new_data_dict:
+            if self.data_dict is not None:
+                new_data_dict = {w_name:self._keep_latest(np.concatenate((self.data_dict[w_name],new_data_dict[w_name]))) for w_name in self.data_dict}
+            self.data_dict = new_data_dict
+            self._processed = True
+            return self.data_dict
+        if self.raw_columns is None:
+            self.raw_columns = list(new_data_dict.keys())
+        waveform_available = self.waveform.update(np.asarray(new_data_dict['FPC COUNTER']))
+
+        if not self._processed:
+            # Till the triangle waveform is estimated, process the full window of raw frames
+            if self.data_dict is not None:
+                new_data_dict = {w_name:self._keep_latest(np.concatenate((self.data_dict[w_name],new_data_dict[w_name]))) for w_name in self.raw_columns}
+            if not waveform_available:
+                self.data_dict = new_data_dict  # Keep only the raw frames till there are enough of them
+                return None
+            self.data_dict = process_raw_data_dict(new_data_dict,*self.waveform.parameters(),dtype=self.dtype)
+            self._processed = True
+            return self.data_dict
+
+        # Also reprocess the last old frame, whose UPSCAN 4 was computed without its next frame.
+        # The frame before it is processed again too (and dropped), so that the UPSCAN 1 of the last old frame sees its previous frame.
+        n_overlap = min(2,frame_count(self.data_dict))
+        batch_dict = {w_name:np.concatenate((self.data_dict[w_name][-n_overlap:],new_data_dict[w_name])) for w_name in self.raw_columns}
+        batch_dict = process_raw_data_dict(batch_dict,*self.waveform.parameters(),dtype=self.dtype)
+        self.data_dict = {w_name:self._keep_latest(np.concatenate((self.data_dict[w_name][:-1],batch_dict[w_name][n_overlap-1:]))) for w_name in batch_dict}
+        return self.data_dict
+
+    def _keep_latest(self,array):
+        """ Returns the latest max_frames elements of the array """
+        return array if self.max_frames is None else array[-self.max_frames:]
+
+    def drop_frames(self,n_frames):
+        """ Removes the oldest n_frames frames which are no longer needed, and returns the number of frames removed.
+        The latest frame is always kept. """
+        if self.data_dict is None:
+            return 0
+        n_frames = min(n_frames,frame_count(self.data_dict)-1)
+        self.data_dict = {w_name:self.data_dict[w_name][n_frames:] for w_name in self.data_dict}
+        return n_frames
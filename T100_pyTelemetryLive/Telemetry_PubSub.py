@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+""" This module implements the local publish/subscribe channel of the decoded telemetry frames.
+
+The capture script publishes every batch of decoded frames on a Unix domain socket beside the FIFO ring buffer file
+(see pubsub_socket_path), and any number of subscribers (recorder, plots) can attach to it.
+The subscribers receive only the new frames, as soon as they are captured, instead of polling and re-reading the ring buffer.
+
+Each subscriber has its own queue of batches in the publisher, sent by its own thread (backpressure).
+If a subscriber does not keep up and its queue holds MAX_QUEUED_FRAMES frames, the new batches are dropped for that subscriber only,
+which it sees as a gap between the write count of the first frame of a batch and the write count after the previous batch
+(like the ring buffer read cursor). A subscriber which does not take any data for SEND_TIMEOUT seconds is disconnected.
+
+Messages (all little endian):
+    Hello, sent once on connecting:
+        0   4s  Marker 'HELO'
+        4   u4  Length of the JSON encoded list of column names, which follows
+    Batch of frames:
+        0   4s  Marker 'BTCH'
+        4   u4  Number of frames N
+        8   u8  Write count of the first frame of the batch. Total number of frames captured before the batch
+        16  u8  Write count after the batch. Total number of frames captured so far (same as the ring buffer write cursor)
+        24  f8  Unix time at which the capture received the batch
+        32  (ncolumns,N) uint16 array of the frames. Each column is contiguous.
+"""
+import os
+import json
+import time
+import select
+import socket
+import threading
+from collections import deque
+import numpy as np
+from Telemetry_Ring_Buffer import TelemetryRingBuffer
+
+HELLO_MARKER = b'HELO'
+BATCH_MARKER = b'BTCH'
+BATCH_HEADER_SIZE = 32
+MAX_QUEUED_FRAMES = 65536  # Frames waiting to be sent to each subscriber (same as the ring buffer). New batches are dropped for it while full
+SEND_TIMEOUT = 10.  # Seconds after which a subscriber which is not receiving is disconnected
+
+def pubsub_socket_path(ring_buffer_filename):
+    """ Returns the path of the publish/subscribe socket of the capture writing the ring buffer file """
+    return os.path.splitext(ring_buffer_filename)[0] + '.sock'
+
+
+class Subscription(object):
+    """ Connection to one subscriber in the publisher, and the queue of the batch messages waiting to be sent to it """
+
+    def __init__(self,connection):
+        self.connection = connection
+        self.messages = deque()
+        self.n_queued_frames = 0
+        self.n_dropped = 0  # Batches dropped because the queue was full
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self,n_frames,message,max_queued_frames):
+        """ Queues the message of n_frames frames. Returns False if it was dropped because the queue is full """
+        with self.condition:
+            if self.n_queued_frames + n_frames > max_queued_frames:
+                self.n_dropped += 1
+                return False
+            self.messages.append((n_frames,message))
+            self.n_queued_frames += n_frames
+            self.condition.notify()
+        return True
+
+    def get(self):
+        """ Returns the next message to send, waiting for one if needed, or None once the subscription is closed """
+        with self.condition:
+            while not (self.messages or self.closed):
+                self.condition.wait()
+            if self.closed:
+                return None
+            n_frames, message = self.messages.popleft()
+            self.n_queued_frames -= n_frames
+        return message
+
+    def close(self):
+        """ Stops the sending to the subscriber """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class TelemetryPublisher(object):
+    """ Publishes the batches of frames to all the subscribers connected to the Unix domain socket at socket_path """
+
+    def __init__(self,socket_path,columns,max_queued_frames=MAX_QUEUED_FRAMES,send_timeout=SEND_TIMEOUT):
+        self.socket_path = socket_path
+        self.columns = list(columns)
+        self.max_queued_frames = max_queued_frames
+        self.send_timeout = send_timeout
+        self.n_dropped = 0  # Batches dropped for the slow subscribers, summed over all of them
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # Left over from an earlier capture
+        self._server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._server.bind(socket_path)
+        self._server.listen()
+        self._closed = False
+        threading.Thread(target=self._accept_subscribers,name='pubsub_accept',daemon=True).start()
+
+    @property
+    def n_subscribers(self):
+        """ Number of subscribers currently connected """
+        return len(self._subscriptions)
+
+    def _accept_subscribers(self):
+        """ Accept thread: sends the hello message to each new subscriber and starts its sender thread """
+        columns_json = json.dumps(self.columns).encode('utf-8')
+        while not self._closed:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return  # Server socket closed
+            connection.settimeout(self.send_timeout)
+            try:
+                connection.sendall(HELLO_MARKER + np.array([len(columns_json)],dtype='<u4').tobytes() + columns_json)
+            except OSError:
+                connection.close()
+                continue
+            subscription = Subscription(connection)
+            with self._lock:
+                self._subscriptions.append(subscription)
+            threading.Thread(target=self._send_batches,args=(subscription,),name='pubsub_sender',daemon=True).start()
+
+    def _send_batches(self,subscription):
+        """ Sender thread of one subscriber: sends its queued batches till it disconnects or stops receiving """
+        while True:
+            message = subscription.get()
+            if message is None:
+                break
+            try:
+                subscription.connection.sendall(message)
+            except OSError:  # Disconnected, or not receiving for send_timeout seconds
+                break
+        with self._lock:
+            self._subscriptions.remove(subscription)
+        subscription.connection.close()
+
+    def publish(self,rows,write_count,receive_time):
+        """ Queues the (N,ncolumns) array of frame rows to all the subscribers.
+        write_count is the total number of frames captured including these, and receive_time the unix time they were received. """
+        if not self._subscriptions:
+            return
+        rows = np.atleast_2d(rows)
+        message = BATCH_MARKER + np.array([rows.shape[0]],dtype='<u4').tobytes() + np.array([write_count-rows.shape[0],write_count],dtype='<u8').tobytes() +\
+                  np.array([receive_time],dtype='<f8').tobytes() + np.ascontiguousarray(rows.T,dtype='<u2').tobytes()
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if not subscription.put(rows.shape[0],message,self.max_queued_frames):
+                self.n_dropped += 1
+
+    def close(self):
+        """ Disconnects all the subscribers and removes the socket """
+        self._closed = True
+        self._server.close()
+        with self._lock:
+            for subscription in self._subscriptions:
+                subscription.close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+class TelemetrySubscriber(object):
+    """ Subscriber to the frames published by the capture script at socket_path.
+    read() returns the new frames like TelemetryRingBuffer.read(since=...), so that it can be used in its place. """
+
+    def __init__(self,socket_path,timeout=5.):
+        self.socket_path = socket_path
+        self._sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(socket_path)
+        if self._recv_exact(4) != HELLO_MARKER:
+            raise ValueError('{0} is not a telemetry publisher socket'.format(socket_path))
+        columns_json_length = int(np.frombuffer(self._recv_exact(4),dtype='<u4')[0])
+        self.columns = json.loads(self._recv_exact(columns_json_length).decode('utf-8'))
+        self.write_count = 0  # Write count after the latest frame received
+        self.last_receive_time = 0.  # Unix time at which the capture received the latest frame received
+        self._sock.settimeout(None)
+
+    def _recv_exact(self,n_bytes):
+        """ Returns the next n_bytes bytes from the socket. Raises ConnectionError if the publisher has closed it """
+        data = bytearray(n_bytes)
+        view = memoryview(data)
+        while view:
+            n_received = self._sock.recv_into(view)
+            if n_received == 0:
+                raise ConnectionError('Telemetry publisher at {0} closed the connection'.format(self.socket_path))
+            view = view[n_received:]
+        return data
+
+    def fileno(self):
+        """ File descriptor of the socket, which becomes readable when new frames arrive (e.g. for select) """
+        return self._sock.fileno()
+
+    def _receive_batch(self):
+        """ Returns the (write count of the first frame, (ncolumns,N) uint16 frames array) of the next batch """
+        header = self._recv_exact(BATCH_HEADER_SIZE)
+        if header[:4] != BATCH_MARKER:
+            raise ValueError('Corrupted message from the telemetry publisher at {0}'.format(self.socket_path))
+        n_frames = int(np.frombuffer(header,dtype='<u4',count=1,offset=4)[0])
+        first_write_count, self.write_count = (int(count) for count in np.frombuffer(header,dtype='<u8',count=2,offset=8))
+        self.last_receive_time = float(np.frombuffer(header,dtype='<f8',count=1,offset=24)[0])
+        return first_write_count, np.frombuffer(self._recv_exact(2*len(self.columns)*n_frames),dtype='<u2').reshape(len(self.columns),n_frames)
+
+    def read_batches(self,timeout=0.,max_frames=None):
+        """ Returns the list of the (write count of the first frame, (ncolumns,N) uint16 frames array) of the batches received since the last read.
+        Waits up to timeout seconds (None: forever) for the first new batch, and then takes all the batches which have already arrived,
+        up to max_frames frames. Frames dropped by the publisher show up as a batch starting after the end of the previous one.
+        Raises ConnectionError if the capture has stopped. """
+        batches = []
+        n_frames = 0
+        wait = timeout
+        while (max_frames is None) or (n_frames < max_frames):
+            readable, _, _ = select.select([self._sock],[],[],wait)
+            if not readable:
+                break
+            batches.append(self._receive_batch())
+            n_frames += batches[-1][1].shape[1]
+            wait = 0.
+        return batches
+
+    def read(self,timeout=0.,max_frames=None):
+        """ Returns (data_dict, write_count) of all the frames received since the last read. data_dict has a uint16 numpy array for each column.
+        Waits and takes the batches like read_batches(). Frames dropped by the publisher show up as write_count increasing by more than the frames returned.
+        Raises ConnectionError if the capture has stopped. """
+        batches = self.read_batches(timeout,max_frames)
+        if batches:
+            block = np.concatenate([frames for _, frames in batches],axis=1)
+        else:
+            block = np.empty((len(self.columns),0),dtype=np.uint16)
+        return {w_name:block[i] for i,w_name in enumerate(self.columns)}, self.write_count
+
+    def collect(self,duration):
+        """ Returns (data_dict, write_count) of all the frames received during the next duration seconds, like read() """
+        end_time = time.time() + duration
+        blocks = []
+        while True:
+            data_dict, write_count = self.read(timeout=max(0.,end_time-time.time()))
+            blocks.append(data_dict)
+            if time.time() >= end_time:
+                break
+        return {w_name:np.concatenate([block[w_name] for block in blocks]) for w_name in self.columns}, write_count
+
+    def close(self):
+        """ Disconnects from the publisher """
+        self._sock.close()
+
+
+class LiveFrameReader(object):
+    """ Reader of the new frames of the live capture for the plots. The first read() takes the frames already in the FIFO ring buffer,
+    and the later reads take the frames received from the capture as a subscriber since then.
+    If the capture cannot be subscribed to (or stops publishing), the FIFO ring buffer is read since the previous read instead.
+    When the publisher has dropped batches for this subscriber, the frames since the previous read are read from the FIFO ring buffer,
+    which still has them unless the reader fell behind by more than its size. """
+
+    def __init__(self,ring_buffer_filename,subscribe=True):
+        self.ring_buffer = TelemetryRingBuffer(ring_buffer_filename)
+        self.subscriber = None
+        if subscribe:
+            # Subscribe before the first read of the FIFO, so that no frame is missed in between
+            try:
+                self.subscriber = TelemetrySubscriber(pubsub_socket_path(ring_buffer_filename))
+            except OSError as e:
+                print('WARNING: Could not subscribe to the capture ({0}). Polling the FIFO instead'.format(e))
+        self.read_cursor = None  # Write count upto which the frames were read
+
+    @property
+    def last_receive_time(self):
+        """ Unix time at which the capture received the latest frame read """
+        return self.ring_buffer.last_receive_time if self.subscriber is None else self.subscriber.last_receive_time
+
+    def read(self,n_frames=None):
+        """ Returns the data dictionary of the frames captured since the previous read (only the latest n_frames if given) """
+        if (self.subscriber is not None) and (self.read_cursor is not None):
+            try:
+                batches = self.subscriber.read_batches()
+            except ConnectionError as e:
+                print('WARNING: {0}. Polling the FIFO instead'.format(e))
+                self.subscriber.close()
+                self.subscriber = None
+                return self.read(n_frames)
+            # Drop the frames which were already read (from the FIFO by the first read or after a gap), and look for dropped batches
+            blocks = [np.empty((len(self.subscriber.columns),0),dtype=np.uint16)]
+            write_count = self.read_cursor
+            gap = False
+            for first_write_count, frames in batches:
+                if first_write_count > write_count:
+                    gap = True
+                    break
+                blocks.append(frames[:,write_count-first_write_count:])
+                write_count = max(write_count,first_write_count+frames.shape[1])
+            if gap:
+                print('WARNING: The capture dropped frames for this reader. Reading them from the FIFO')
+                data_dict, write_count = self.ring_buffer.read(n_frames=n_frames,since=self.read_cursor)
+            else:
+                block = np.concatenate(blocks,axis=1)
+                first = 0 if n_frames is None else max(0,block.shape[1]-n_frames)
+                data_dict = {w_name:block[i,first:] for i,w_name in enumerate(self.subscriber.columns)}
+        else:
+            data_dict, write_count = self.ring_buffer.read(n_frames=n_frames,since=self.read_cursor)
+        self.read_cursor = max(write_count,self.read_cursor or 0)
+        return data_dict
+
+    def close(self):
+        """ Unsubscribes and closes the FIFO ring buffer """
+        if self.subscriber is not None:
+            self.subscriber.close()
+        self.ring_buffer.close()
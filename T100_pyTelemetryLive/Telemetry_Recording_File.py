@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+""" This module implements the append only chunked binary file format of the recorded telemetry.
+
+Each save of the recorder only appends the new frames to the end of the file, instead of pickling the whole recording again.
+If the recorder crashes, the file is still readable up to the last complete chunk.
+
+File layout (all little endian):
+    File header:
+        0   8s  Magic 'T100REC1'
+        8   u4  Layout version
+        12  u4  Number of columns
+        16  u4  Maximum number of frames in a chunk
+        20  u4  Length of the JSON encoded list of column names, which follows the header
+    Followed by any number of chunks, each of them:
+        0   4s  Chunk marker 'CHNK'
+        4   u4  Number of frames N in the chunk
+        8   u4  CRC32 of the chunk data
+        12  u4  Reserved
+        16  i8  Time ticks of the first frame in the chunk
+        24  i8  Time ticks of the last frame in the chunk
+        32  (N,) int64 monotonic time ticks column of the frames (see Telemetry_Frame_Decoder.timestamp_ticks)
+        32+8N  (ncolumns,N) uint16 array of the frames. Each column is contiguous.
+
+Beside the recording, the writer also keeps a time index file (recording filename + '.idx'),
+which has one (chunk data offset, N, first time ticks, last time ticks) int64 record per chunk.
+It lets the readers binary search the chunks overlapping a time window, without reading the rest of the file.
+If the index file is missing or behind the recording, the chunk headers are scanned instead.
+"""
+import os
+import json
+import zlib
+import numpy as np
+from Telemetry_Frame_Decoder import timestamp_ticks, day_of_year_to_ticks
+
+RECORDING_MAGIC = b'T100REC1'
+RECORDING_VERSION = 2
+CHUNK_MARKER = b'CHNK'
+FILE_HEADER_SIZE = 24
+CHUNK_HEADER_SIZE = 32
+DEFAULT_CHUNK_FRAMES = 4096
+
+INDEX_MAGIC = b'T100IDX1'
+INDEX_RECORD_DTYPE = np.dtype([('offset','<i8'),('n_frames','<i8'),('t_first','<i8'),('t_last','<i8')])
+
+def is_recording_file(filename):
+    """ Returns True if the file is a chunked telemetry recording file """
+    with open(filename,'rb') as recfile:
+        return recfile.read(len(RECORDING_MAGIC)) == RECORDING_MAGIC
+
+
+class RecordingWriter(object):
+    """ Writes the telemetry frames into a new chunked recording file and its time index file.
+    Frames given to append() are written out in chunks of chunk_frames, and the remaining frames are written by flush().
+    Each flush() before the file is closed adds a short chunk and an index record, so they should be rare (see Record_Captured_Telemetry.TAIL_FLUSH_INTERVAL).
+    The frames should be appended in the increasing order of their time stamps."""
+
+    def __init__(self,filename,columns,chunk_frames=DEFAULT_CHUNK_FRAMES):
+        self.filename = filename
+        self.columns = list(columns)
+        self.chunk_frames = chunk_frames
+        self._pending = np.empty((len(self.columns),chunk_frames),dtype='<u2')
+        self._pending_ticks = np.empty(chunk_frames,dtype='<i8')
+        self._n_pending = 0
+        self.n_frames = 0  # Number of frames written to the file so far
+        columns_json = json.dumps(self.columns).encode('utf-8')
+        self._file = open(filename,'wb')
+        self._file.write(RECORDING_MAGIC)
+        self._file.write(np.array([RECORDING_VERSION,len(self.columns),chunk_frames,len(columns_json)],dtype='<u4').tobytes())
+        self._file.write(columns_json)
+        self._file.flush()
+        self._index_file = open(filename+'.idx','wb')
+        self._index_file.write(INDEX_MAGIC)
+        self._index_file.flush()
+
+    def append(self,data_dict,time_ticks=None):
+        """ Appends the frames in the data dictionary of equal length column arrays.
+        The time ticks of the frames are computed from their time stamp columns, unless they are given. """
+        n_new = len(data_dict[self.columns[0]])
+        if time_ticks is None:
+            time_ticks = timestamp_ticks(data_dict)
+        start = 0
+        while start < n_new:
+            n_copy = min(n_new-start,self.chunk_frames-self._n_pending)
+            for i,w_name in enumerate(self.columns):
+                self._pending[i,self._n_pending:self._n_pending+n_copy] = data_dict[w_name][start:start+n_copy]
+            self._pending_ticks[self._n_pending:self._n_pending+n_copy] = time_ticks[start:start+n_copy]
+            self._n_pending += n_copy
+            start += n_copy
+            if self._n_pending == self.chunk_frames:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        """ Writes the pending frames as one chunk at the end of the file, and its record in the index file """
+        if self._n_pending == 0:
+            return
+        frames = self._pending[:,:self._n_pending]
+        time_ticks = self._pending_ticks[:self._n_pending]
+        chunk_data = time_ticks.tobytes() + np.ascontiguousarray(frames).tobytes()
+        chunk_offset = self._file.tell() + CHUNK_HEADER_SIZE
+        self._file.write(CHUNK_MARKER)
+        self._file.write(np.array([self._n_pending,zlib.crc32(chunk_data),0],dtype='<u4').tobytes())
+        self._file.write(np.array([time_ticks[0],time_ticks[-1]],dtype='<i8').tobytes())
+        self._file.write(chunk_data)
+        self._index_file.write(np.array([(chunk_offset,self._n_pending,time_ticks[0],time_ticks[-1])],dtype=INDEX_RECORD_DTYPE).tobytes())
+        self.n_frames += self._n_pending
+        self._n_pending = 0
+
+    @property
+    def n_pending(self):
+        """ Number of frames appended which do not yet fill a chunk, and are not in the file yet """
+        return self._n_pending
+
+    def sync(self):
+        """ Makes the complete chunks written so far safe on the disk. The pending frames are kept till they fill a chunk """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._index_file.flush()
+
+    def flush(self):
+        """ Writes out all the pending frames to the file, as a chunk shorter than chunk_frames, and makes them safe on the disk """
+        self._write_chunk()
+        self.sync()
+
+    def close(self):
+        """ Writes out all the pending frames and closes the file """
+        self.flush()
+        self._file.close()
+        self._index_file.close()
+
+
+def chunk_data_size(n_columns,n_frames):
+    """ Returns the number of bytes of the time ticks and frames data in a chunk """
+    return 8*n_frames + 2*n_columns*n_frames
+
+
+def read_recording_header(recfile):
+    """ Returns (columns, chunk_frames) after reading the header of the open recording file """
+    if recfile.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+        raise ValueError('{0} is not a telemetry recording file'.format(recfile.name))
+    version, n_columns, chunk_frames, columns_json_length = np.frombuffer(recfile.read(16),dtype='<u4')
+    if version != RECORDING_VERSION:
+        raise ValueError('Unsupported recording version {0} in {1}'.format(version,recfile.name))
+    columns = json.loads(recfile.read(int(columns_json_length)).decode('utf-8'))
+    return columns, int(chunk_frames)
+
+
+def scan_recording_chunks(recfile,n_columns,offset=None):
+    """ Returns a list of (chunk data offset, number of frames, first time ticks, last time ticks) of all the complete chunks,
+    starting from the offset (default: current position) in the open recording file. Stops at the first incomplete chunk."""
+    chunks = []
+    file_size = os.fstat(recfile.fileno()).st_size
+    if offset is None:
+        offset = recfile.tell()
+    while offset + CHUNK_HEADER_SIZE <= file_size:
+        recfile.seek(offset)
+        chunk_header = recfile.read(CHUNK_HEADER_SIZE)
+        if chunk_header[:4] != CHUNK_MARKER:
+            print('WARNING: Corrupted chunk at byte {0} in {1}. Ignoring rest of the file'.format(offset,recfile.name))
+            break
+        n_frames = int(np.frombuffer(chunk_header,dtype='<u4',count=1,offset=4)[0])
+        t_first, t_last = np.frombuffer(chunk_header,dtype='<i8',count=2,offset=16)
+        data_size = chunk_data_size(n_columns,n_frames)
+        if offset + CHUNK_HEADER_SIZE + data_size > file_size:
+            break  # Last chunk was not completely written
+        chunks.append((offset+CHUNK_HEADER_SIZE,n_frames,int(t_first),int(t_last)))
+        offset += CHUNK_HEADER_SIZE + data_size
+    return chunks
+
+
+def load_recording_index(recfile,n_columns):
+    """ Returns the INDEX_RECORD_DTYPE array of all the complete chunks in the open recording file.
+    The records are taken from the index file beside the recording, and any chunks written after the last indexed chunk are scanned."""
+    file_size = os.fstat(recfile.fileno()).st_size
+    first_chunk_offset = recfile.tell()
+    try:
+        with open(recfile.name+'.idx','rb') as indexfile:
+            if indexfile.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError
+            index_data = indexfile.read()
+        index = np.frombuffer(index_data[:len(index_data)//INDEX_RECORD_DTYPE.itemsize*INDEX_RECORD_DTYPE.itemsize],dtype=INDEX_RECORD_DTYPE)
+    except (FileNotFoundError, ValueError):
+        index = np.empty(0,dtype=INDEX_RECORD_DTYPE)
+    # Drop index records of chunks not (completely) in this recording file
+    chunk_ends = index['offset'] + chunk_data_size(n_columns,index['n_frames'])
+    index = index[chunk_ends <= file_size]
+    next_offset = int(chunk_ends[len(index)-1]) if len(index) else first_chunk_offset
+    remaining_chunks = scan_recording_chunks(recfile,n_columns,offset=next_offset)
+    if remaining_chunks:
+        index = np.concatenate([index,np.array(remaining_chunks,dtype=INDEX_RECORD_DTYPE)])
+    return index
+
+
+def read_recording_chunk(recfile,chunk_offset,n_frames,n_columns,check_crc=True):
+    """ Returns the (time ticks array, (ncolumns,n_frames) uint16 frames array) of the chunk at chunk_offset,
+    or None if its CRC does not match """
+    recfile.seek(chunk_offset-CHUNK_HEADER_SIZE+8)
+    crc = int(np.frombuffer(recfile.read(4),dtype='<u4')[0])
+    recfile.seek(chunk_offset)
+    chunk_data = recfile.read(chunk_data_size(n_columns,n_frames))
+    if check_crc and (zlib.crc32(chunk_data) != crc):
+        print('WARNING: CRC mismatch in the chunk at byte {0} in {1}. Ignoring it'.format(chunk_offset,recfile.name))
+        return None
+    time_ticks = np.frombuffer(chunk_data,dtype='<i8',count=n_frames)
+    frames = np.frombuffer(chunk_data,dtype='<u2',offset=8*n_frames).reshape(n_columns,n_frames)
+    return time_ticks, frames
+
+
+def iterate_recording_file(filename,start_time=None,end_time=None,since_ticks=None):
+    """ Generator which yields the (columns, time ticks array, (ncolumns,N) uint16 frames array) of each chunk of the recording file in turn,
+    without loading the whole recording into the memory. The start_time, end_time and since_ticks are as in read_recording_file."""
+    with open(filename,'rb') as recfile:
+        columns, _ = read_recording_header(recfile)
+        index = load_recording_index(recfile,len(columns))
+        start_ticks = day_of_year_to_ticks(start_time) if start_time is not None else None
+        if since_ticks is not None:
+            start_ticks = since_ticks+1 if start_ticks is None else max(start_ticks,since_ticks+1)
+        end_ticks = day_of_year_to_ticks(end_time) if end_time is not None else None
+        # Binary search the chunks overlapping the time window
+        first_chunk = np.searchsorted(index['t_last'],start_ticks,side='left') if start_ticks is not None else 0
+        last_chunk = np.searchsorted(index['t_first'],end_ticks,side='right') if end_ticks is not None else len(index)
+        for chunk_offset, n_frames, _, _ in index[first_chunk:last_chunk]:
+            chunk = read_recording_chunk(recfile,int(chunk_offset),int(n_frames),len(columns))
+            if chunk is None:
+                continue
+            time_ticks, frames = chunk
+            # Trim the frames of the first and last chunks which are outside the window
+            first = np.searchsorted(time_ticks,start_ticks,side='left') if start_ticks is not None else 0
+            last = np.searchsorted(time_ticks,end_ticks,side='right') if end_ticks is not None else len(time_ticks)
+            if last > first:
+                yield columns, time_ticks[first:last], frames[:,first:last]
+
+
+def read_recording_ticks(filename,start_time=None,end_time=None):
+    """ Returns the int64 time ticks of the frames of the recording file inside the optional time window (as in read_recording_file).
+    Only the time ticks column of each chunk is read, without checking the CRC of the chunk. """
+    with open(filename,'rb') as recfile:
+        columns, _ = read_recording_header(recfile)
+        index = load_recording_index(recfile,len(columns))
+        tick_arrays = []
+        for chunk_offset, n_frames, _, _ in index:
+            recfile.seek(int(chunk_offset))
+            tick_arrays.append(np.frombuffer(recfile.read(8*int(n_frames)),dtype='<i8'))
+    time_ticks = np.concatenate(tick_arrays) if tick_arrays else np.empty(0,dtype='<i8')
+    first = np.searchsorted(time_ticks,day_of_year_to_ticks(start_time),side='left') if start_time is not None else 0
+    last = np.searchsorted(time_ticks,day_of_year_to_ticks(end_time),side='right') if end_time is not None else len(time_ticks)
+    return time_ticks[first:max(first,last)]
+
+
+def read_recording_file(filename,start_time=None,end_time=None,since_ticks=None):
+    """ Returns the data dictionary of the frames in the recording file, with a uint16 numpy array for each column.
+    If start_time and/or end_time (in day of the year) are given, only the chunks overlapping that time window are read,
+    and the frames outside the window are dropped. The int64 time ticks of the frames are returned in 'TIME TICKS'.
+    If since_ticks is given, only the frames with time ticks after it are returned. Useful to read only the newly recorded frames."""
+    chunks = list(iterate_recording_file(filename,start_time=start_time,end_time=end_time,since_ticks=since_ticks))
+    if chunks:
+        columns = chunks[0][0]
+        time_ticks = np.concatenate([chunk[1] for chunk in chunks])
+        data = np.concatenate([chunk[2] for chunk in chunks],axis=1)
+    else:
+        with open(filename,'rb') as recfile:
+            columns, _ = read_recording_header(recfile)
+        time_ticks = np.empty(0,dtype='<i8')
+        data = np.empty((len(columns),0),dtype='<u2')
+    data_dict = {w_name:data[i] for i,w_name in enumerate(columns)}
+    data_dict['TIME TICKS'] = time_ticks
+    return data_dict
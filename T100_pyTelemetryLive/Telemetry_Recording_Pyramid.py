@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+""" This module implements the level of detail pyramid of the recordings, for browsing multi-hour recordings quickly.
+
+Usage: Telemetry_Recording_Pyramid.py RecordedTelemetryFile.tlm
+       (Re)builds the pyramid of an existing recording, e.g. an old or converted recording, or one whose recorder crashed.
+
+The pyramid holds, for every column, the min, max and mean of tiles of consecutive frames, at power of two decimation levels.
+A tile of level k summarises 2**k frames. The tiles of the lowest level LOD_BASE_LEVEL are computed from the frames,
+and each tile of the next level is combined from two tiles of the level below it.
+Record_Captured_Telemetry.py builds the pyramid incrementally as it appends to the recording.
+
+Each level is kept in its own append only file in the directory beside the recording (recording filename + '.lod'):
+    File header (all little endian):
+        0   8s  Magic 'T100LOD1'
+        8   u4  Layout version
+        12  u4  Level k
+        16  u4  Number of columns
+        20  u4  Length of the JSON encoded list of column names, which follows the header
+    Followed by the tile records of tile_dtype(number of columns)
+
+The frames after the last tile of a level (not yet a complete tile) are taken from the levels below it, and finally from the recording.
+"""
+import os
+import sys
+import json
+import glob
+from bisect import bisect_left, bisect_right
+import numpy as np
+from Telemetry_Frame_Decoder import timestamp_ticks, TICKS_PER_DAY
+from Telemetry_Recording_File import iterate_recording_file, read_recording_header, load_recording_index
+
+PYRAMID_MAGIC = b'T100LOD1'
+PYRAMID_VERSION = 1
+PYRAMID_HEADER_SIZE = 24
+LOD_BASE_LEVEL = 6  # Lowest level has tiles of 64 frames. Views with fewer frames per pixel are read from the recording
+LOD_MAX_LEVEL = 26  # Highest level has tiles of 2**26 frames (18 hours at 1000 frames/s)
+RAW_LEVEL = 0  # Level returned by RecordingPyramid.query() when the frames are read from the recording itself
+
+def tile_dtype(n_columns):
+    """ Returns the numpy dtype of the tile records with n_columns columns """
+    return np.dtype([('t_first','<i8'),('t_last','<i8'),
+                     ('min','<u2',(n_columns,)),('max','<u2',(n_columns,)),('mean','<f4',(n_columns,))])
+
+def pyramid_directory(recording_filename):
+    """ Returns the directory of the pyramid of the recording """
+    return recording_filename + '.lod'
+
+def level_filename(recording_filename,level):
+    """ Returns the file name of the tiles of the level """
+    return os.path.join(pyramid_directory(recording_filename),'level_{0:02d}.lod'.format(level))
+
+
+class RecordingPyramidWriter(object):
+    """ Writes the pyramid of a new recording. The frames given to append() should be the same as those appended to the recording.
+    Frames which do not yet fill a tile are kept until the next append(). They are still read from the recording itself. """
+
+    def __init__(self,recording_filename,columns):
+        self.recording_filename = recording_filename
+        self.columns = list(columns)
+        self.dtype = tile_dtype(len(self.columns))
+        os.makedirs(pyramid_directory(recording_filename),exist_ok=True)
+        for old_filename in glob.glob(os.path.join(pyramid_directory(recording_filename),'level_*.lod')):
+            os.remove(old_filename)  # Left over from an earlier recording with the same name
+        self._files = {}
+        self._pending_ticks = np.empty(0,dtype=np.int64)
+        self._pending_frames = np.empty((len(self.columns),0),dtype='<u2')
+        self._pending_tiles = {}  # Last tile of each level waiting for its pair to make a tile of the next level
+        self.n_frames = 0  # Number of frames in the written tiles of the base level
+
+    def append(self,data_dict):
+        """ Appends the frames in the data dictionary of equal length column arrays, in increasing time order """
+        ticks = np.concatenate([self._pending_ticks,timestamp_ticks(data_dict)])
+        frames = np.concatenate([self._pending_frames,np.array([data_dict[w_name] for w_name in self.columns],dtype='<u2')],axis=1)
+        tile_frames = 2**LOD_BASE_LEVEL
+        n_tiles = len(ticks)//tile_frames
+        n_used = n_tiles*tile_frames
+        if n_tiles > 0:
+            blocks = frames[:,:n_used].reshape(len(self.columns),n_tiles,tile_frames)
+            tiles = np.empty(n_tiles,dtype=self.dtype)
+            tiles['t_first'] = ticks[:n_used:tile_frames]
+            tiles['t_last'] = ticks[tile_frames-1:n_used:tile_frames]
+            tiles['min'] = blocks.min(axis=2).T
+            tiles['max'] = blocks.max(axis=2).T
+            tiles['mean'] = blocks.mean(axis=2).T
+            self._add_tiles(LOD_BASE_LEVEL,tiles)
+            self.n_frames += n_used
+        self._pending_ticks = ticks[n_used:]
+        self._pending_frames = frames[:,n_used:]
+
+    def _add_tiles(self,level,tiles):
+        """ Writes the tiles of the level, and combines them in pairs into the tiles of the levels above """
+        while True:
+            self._write_tiles(level,tiles)
+            if level == LOD_MAX_LEVEL:
+                return
+            if level in self._pending_tiles:
+                tiles = np.concatenate([self._pending_tiles.pop(level),tiles])
+            n_pairs = len(tiles)//2
+            if len(tiles) % 2:
+                self._pending_tiles[level] = tiles[-1:]
+            if n_pairs == 0:
+                return
+            first, second = tiles[0:2*n_pairs:2], tiles[1:2*n_pairs:2]
+            tiles = np.empty(n_pairs,dtype=self.dtype)
+            tiles['t_first'] = first['t_first']
+            tiles['t_last'] = second['t_last']
+            tiles['min'] = np.minimum(first['min'],second['min'])
+            tiles['max'] = np.maximum(first['max'],second['max'])
+            tiles['mean'] = (first['mean'] + second['mean'])/2
+            level += 1
+
+    def _write_tiles(self,level,tiles):
+        """ Appends the tiles to the file of the level, creating it with its header if needed """
+        if level not in self._files:
+            columns_json = json.dumps(self.columns).encode('utf-8')
+            self._files[level] = open(level_filename(self.recording_filename,level),'wb')
+            self._files[level].write(PYRAMID_MAGIC)
+            self._files[level].write(np.array([PYRAMID_VERSION,level,len(self.columns),len(columns_json)],dtype='<u4').tobytes())
+            self._files[level].write(columns_json)
+        self._files[level].write(tiles.tobytes())
+
+    def flush(self):
+        """ Writes out the tiles to the files """
+        for levelfile in self._files.values():
+            levelfile.flush()
+
+    def close(self):
+        """ Closes the files. The frames not yet in a complete tile are only in the recording """
+        for levelfile in self._files.values():
+            levelfile.close()
+        self._files = {}
+
+
+def build_recording_pyramid(recording_filename):
+    """ Builds the pyramid of the existing recording file. Returns the number of frames in its base level tiles """
+    writer = None
+    for columns, time_ticks, frames in iterate_recording_file(recording_filename):
+        if writer is None:
+            writer = RecordingPyramidWriter(recording_filename,columns)
+        writer.append({w_name:frames[i] for i,w_name in enumerate(columns)})
+    if writer is None:
+        with open(recording_filename,'rb') as recfile:
+            columns, _ = read_recording_header(recfile)
+        writer = RecordingPyramidWriter(recording_filename,columns)
+    writer.close()
+    return writer.n_frames
+
+
+def read_level_tiles(recording_filename,level):
+    """ Returns the (columns, memory mapped array of the complete tiles) of the level, or (None, empty array) if it has no file yet """
+    try:
+        levelfile = open(level_filename(recording_filename,level),'rb')
+    except FileNotFoundError:
+        return None, np.empty(0,dtype=tile_dtype(0))
+    with levelfile:
+        if levelfile.read(len(PYRAMID_MAGIC)) != PYRAMID_MAGIC:
+            raise ValueError('{0} is not a recording pyramid file'.format(levelfile.name))
+        version, _, n_columns, columns_json_length = np.frombuffer(levelfile.read(16),dtype='<u4')
+        if version != PYRAMID_VERSION:
+            raise ValueError('Unsupported pyramid version {0} in {1}'.format(version,levelfile.name))
+        columns = json.loads(levelfile.read(int(columns_json_length)).decode('utf-8'))
+        dtype = tile_dtype(int(n_columns))
+        offset = PYRAMID_HEADER_SIZE + int(columns_json_length)
+        n_tiles = (os.fstat(levelfile.fileno()).st_size - offset)//dtype.itemsize
+    if n_tiles <= 0:
+        return columns, np.empty(0,dtype=dtype)
+    return columns, np.memmap(levelfile.name,dtype=dtype,mode='r',offset=offset,shape=(n_tiles,))
+
+
+def is_recording_pyramid_current(recording_filename):
+    """ Returns True if the pyramid of the recording exists and was built from this recording """
+    _, tiles = read_level_tiles(recording_filename,LOD_BASE_LEVEL)
+    with open(recording_filename,'rb') as recfile:
+        columns, _ = read_recording_header(recfile)
+        index = load_recording_index(recfile,len(columns))
+    if not os.path.isdir(pyramid_directory(recording_filename)):
+        return False
+    if len(index) == 0:
+        return False  # No chunk recorded yet, so nothing to check the pyramid against
+    # The pyramid can be ahead of the recording, whose frames which do not yet fill a chunk are written later (see RecordingWriter.flush)
+    if len(tiles) and (tiles['t_first'][0] != index['t_first'][0]):
+        return False  # Pyramid of an earlier recording with the same name
+    # The recorder puts every frame into the pyramid, except the frames of the last chunk which do not yet fill a tile
+    return index['n_frames'][:-1].sum() < (len(tiles)+1)*2**LOD_BASE_LEVEL
+
+
+class RecordingPyramid(object):
+    """ Reader of the pyramid of a recording, which may still be growing.
+    query() returns the min, max and mean of the words over a time range at the level of detail of the number of points asked. """
+
+    def __init__(self,recording_filename):
+        self.recording_filename = recording_filename
+        with open(recording_filename,'rb') as recfile:
+            self.columns, _ = read_recording_header(recfile)
+
+    def time_range(self):
+        """ Returns the (first, last) time ticks of the recording """
+        with open(self.recording_filename,'rb') as recfile:
+            read_recording_header(recfile)
+            index = load_recording_index(recfile,len(self.columns))
+        if len(index) == 0:
+            return None
+        return int(index['t_first'][0]), int(index['t_last'][-1])
+
+    def size(self):
+        """ Returns the (number of frames in the recording, number of tiles of the base level), which grow as the recording is recorded """
+        with open(self.recording_filename,'rb') as recfile:
+            read_recording_header(recfile)
+            index = load_recording_index(recfile,len(self.columns))
+        _, tiles = read_level_tiles(self.recording_filename,LOD_BASE_LEVEL)
+        return int(index['n_frames'].sum()), len(tiles)
+
+    def choose_level(self,start_ticks,end_ticks,n_points):
+        """ Returns the highest level which still has at least n_points tiles between the start and end time ticks,
+        or RAW_LEVEL if the frames should be read from the recording """
+        _, tiles = read_level_tiles(self.recording_filename,LOD_BASE_LEVEL)
+        n_tiles = bisect_right(tiles['t_first'],end_ticks) - bisect_left(tiles['t_last'],start_ticks)
+        if n_tiles < n_points:
+            return RAW_LEVEL
+        return int(min(LOD_MAX_LEVEL,LOD_BASE_LEVEL + np.log2(n_tiles/n_points)))
+
+    def query(self,words,start_ticks,end_ticks,n_points):
+        """ Returns (level, time ticks, min, max, mean) of the words between the start and end time ticks, with about n_points to 2*n_points points.
+        The min, max and mean are dictionaries of an array for each word. The time ticks are the middle of the tiles. """
+        level = self.choose_level(start_ticks,end_ticks,n_points)
+        columns = [self.columns.index(w_name) for w_name in words]
+        parts = self._query_level(level,columns,start_ticks,end_ticks)
+        time_ticks = np.concatenate([part[0] for part in parts])
+        minimum, maximum, mean = [{w_name:np.concatenate([part[k][:,i] for part in parts]) for i,w_name in enumerate(words)} for k in (1,2,3)]
+        if (level == RAW_LEVEL) and (len(time_ticks) >= 2*n_points):
+            # Fewer frames than a base level tile per point, which are reduced into tiles here
+            level = int(np.log2(len(time_ticks)/n_points))
+            starts = np.arange(0,len(time_ticks),2**level)
+            ends = np.minimum(starts+2**level,len(time_ticks))
+            time_ticks = (time_ticks[starts] + time_ticks[ends-1])//2
+            minimum = {w_name:np.minimum.reduceat(minimum[w_name],starts) for w_name in words}
+            maximum = {w_name:np.maximum.reduceat(maximum[w_name],starts) for w_name in words}
+            mean = {w_name:np.add.reduceat(mean[w_name],starts,dtype=np.float64)/(ends-starts) for w_name in words}
+        return level, time_ticks, minimum, maximum, mean
+
+    def _query_level(self,level,columns,start_ticks,end_ticks):
+        """ Returns the list of (time ticks, min, max, mean) parts between the start and end time ticks from the level.
+        The part after the last tile of the level is taken from the levels below it. """
+        if level < LOD_BASE_LEVEL:
+            parts = []
+            for _, time_ticks, frames in iterate_recording_file(self.recording_filename,end_time=end_ticks/TICKS_PER_DAY,since_ticks=start_ticks-1):
+                values = frames[columns].T
+                parts.append((time_ticks,values,values,values))
+            return parts or [(np.empty(0,dtype=np.int64),)+(np.empty((0,len(columns)),dtype='<u2'),)*3]
+        lower_level = level-1 if level > LOD_BASE_LEVEL else RAW_LEVEL
+        _, tiles = read_level_tiles(self.recording_filename,level)
+        if len(tiles) == 0:
+            return self._query_level(lower_level,columns,start_ticks,end_ticks)
+        first = bisect_left(tiles['t_last'],start_ticks)
+        last = bisect_right(tiles['t_first'],end_ticks)
+        selected = np.array(tiles[first:last])
+        parts = [((selected['t_first'] + selected['t_last'])//2,selected['min'][:,columns],selected['max'][:,columns],selected['mean'][:,columns])]
+        level_end = int(tiles['t_last'][-1])
+        if end_ticks > level_end:
+            parts.extend(self._query_level(lower_level,columns,max(start_ticks,level_end+1),end_ticks))
+        return parts
+
+
+if __name__ == '__main__':
+    n_frames = build_recording_pyramid(sys.argv[1])
+    print('Built the level of detail pyramid of {0} frames of {1} in {2}'.format(n_frames,sys.argv[1],pyramid_directory(sys.argv[1])))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+""" This module implements the fixed layout shared memory FIFO ring buffer of the decoded telemetry frames.
+
+The capture script writes each decoded frame into a memory mapped file on the tmpfs RAM disk,
+and the recorder and plot scripts map the same file to read the latest frames without any pickling.
+
+File layout (all little endian):
+    0   8s  Magic 'T100RING'
+    8   u4  Layout version
+    12  u4  Number of columns
+    16  u8  Capacity (number of frames in the ring)
+    24  u8  Sequence counter. Odd while the writer is updating the ring (seqlock)
+    32  u8  Write cursor. Total number of frames written so far
+    40  u4  Length of the JSON encoded list of column names, which starts at byte 64
+    48  f8  Unix time at which the capture received the latest frame in the ring
+    HEADER_SIZE onwards: (ncolumns,capacity) uint16 array. Each column is contiguous in memory.
+
+A reader copies the frames it wants and then checks the sequence counter did not change during the copy,
+otherwise it retries. Hence a half written frame is never visible to the readers.
+"""
+import os
+import json
+import time
+import mmap
+import numpy as np
+
+RING_BUFFER_MAGIC = b'T100RING'
+RING_BUFFER_VERSION = 2
+HEADER_SIZE = 4096
+
+def is_ring_buffer_file(filename):
+    """ Returns True if the file is a telemetry ring buffer file """
+    with open(filename,'rb') as ringfile:
+        return ringfile.read(len(RING_BUFFER_MAGIC)) == RING_BUFFER_MAGIC
+
+
+class TelemetryRingBuffer(object):
+    """ Memory mapped FIFO ring buffer of uint16 telemetry frames.
+    Use TelemetryRingBuffer.create() in the writer, and TelemetryRingBuffer(filename) in the readers."""
+
+    def __init__(self,filename):
+        self.filename = filename
+        self._open()
+
+    @classmethod
+    def create(cls,filename,columns,capacity):
+        """ Creates a new empty ring buffer file for `columns` holding the last `capacity` frames and returns it opened """
+        columns_json = json.dumps(list(columns)).encode('utf-8')
+        if 64 + len(columns_json) > HEADER_SIZE:
+            raise ValueError('Too many columns to fit in the ring buffer header')
+        header = bytearray(HEADER_SIZE)
+        header[0:8] = RING_BUFFER_MAGIC
+        header[8:16] = np.array([RING_BUFFER_VERSION,len(columns)],dtype='<u4').tobytes()
+        header[16:40] = np.array([capacity,0,0],dtype='<u8').tobytes()
+        header[40:44] = np.array([len(columns_json)],dtype='<u4').tobytes()
+        header[64:64+len(columns_json)] = columns_json
+        # Write to a temporary file and move it into place, so that readers of an older ring buffer
+        # keep their mapping of the old file instead of seeing it get truncated under them.
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename,'wb') as ringfile:
+            ringfile.write(header)
+            ringfile.truncate(HEADER_SIZE + 2*len(columns)*capacity)
+        os.replace(tmp_filename,filename)
+        return cls(filename)
+
+    def _open(self):
+        """ Memory maps the ring buffer file and sets up the numpy views on it """
+        with open(self.filename,'r+b') as ringfile:
+            self._inode = os.fstat(ringfile.fileno()).st_ino
+            self._mmap = mmap.mmap(ringfile.fileno(),0)
+        if self._mmap[0:8] != RING_BUFFER_MAGIC:
+            raise ValueError('{0} is not a telemetry ring buffer file'.format(self.filename))
+        version, n_columns = np.frombuffer(self._mmap,dtype='<u4',count=2,offset=8)
+        if version != RING_BUFFER_VERSION:
+            raise ValueError('Unsupported ring buffer version {0} in {1}'.format(version,self.filename))
+        self.capacity = int(np.frombuffer(self._mmap,dtype='<u8',count=1,offset=16)[0])
+        columns_json_length = int(np.frombuffer(self._mmap,dtype='<u4',count=1,offset=40)[0])
+        self.columns = json.loads(self._mmap[64:64+columns_json_length].decode('utf-8'))
+        # Sequence counter and write cursor
+        self._state = np.ndarray((2,),dtype='<u8',buffer=self._mmap,offset=24)
+        self._receive_time = np.ndarray((1,),dtype='<f8',buffer=self._mmap,offset=48)
+        self._data = np.ndarray((int(n_columns),self.capacity),dtype='<u2',buffer=self._mmap,offset=HEADER_SIZE)
+
+    def _reopen_if_replaced(self):
+        """ Maps the file again if the capture script has created a new ring buffer in its place """
+        try:
+            inode = os.stat(self.filename).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self._inode:
+            self._open()
+
+    @property
+    def write_count(self):
+        """ Total number of frames written into the ring buffer so far """
+        return int(self._state[1])
+
+    @property
+    def last_receive_time(self):
+        """ Unix time at which the capture received the latest frame in the ring buffer """
+        return float(self._receive_time[0])
+
+    def append(self,rows,receive_time=None):
+        """ Appends a frame row, or an (N,ncolumns) array of frame rows, into the ring buffer.
+        receive_time is the unix time at which the frames were received (default: now) """
+        rows = np.atleast_2d(rows)
+        write_count = int(self._state[1])
+        if rows.shape[0] > self.capacity:  # Only the last capacity rows will survive anyway
+            write_count += rows.shape[0] - self.capacity
+            rows = rows[-self.capacity:]
+        start = write_count % self.capacity
+        first_part = min(rows.shape[0],self.capacity-start)
+        self._state[0] += 1  # Odd sequence number: writing in progress
+        self._data[:,start:start+first_part] = rows[:first_part].T
+        self._data[:,:rows.shape[0]-first_part] = rows[first_part:].T
+        self._state[1] = write_count + rows.shape[0]
+        self._receive_time[0] = time.time() if receive_time is None else receive_time
+        self._state[0] += 1  # Even sequence number: ring is consistent again
+
+    def read(self,n_frames=None,since=None):
+        """ Returns (data_dict, write_count) of a consistent snapshot of the frames in the ring buffer.
+        data_dict has a uint16 numpy array for each column, in the order the frames were written.
+        n_frames : Return only the latest n_frames frames.
+        since : Return only the frames after the write cursor `since`, which is the write_count returned by a previous read.
+        If more than capacity frames were written since then, only the oldest frames still in the ring are returned.
+        If `since` is beyond the write cursor, the ring buffer was recreated by a new capture, and all its frames are returned.
+        The column arrays are views into a single copy of the frames taken under the sequence lock."""
+        self._reopen_if_replaced()
+        while True:
+            seq = self._state[0]
+            if seq & 1:  # Writer is in the middle of an update
+                time.sleep(0)
+                continue
+            write_count = int(self._state[1])
+            first = max(0,write_count-self.capacity)
+            if (since is not None) and (since <= write_count):
+                first = max(first,min(since,write_count))
+            if n_frames is not None:
+                first = max(first,write_count-n_frames)
+            start = first % self.capacity
+            n_read = write_count - first
+            first_part = min(n_read,self.capacity-start)
+            block = np.empty((len(self.columns),n_read),dtype=np.uint16)
+            block[:,:first_part] = self._data[:,start:start+first_part]
+            block[:,first_part:] = self._data[:,:n_read-first_part]
+            if self._state[0] == seq:
+                break
+        return {w_name:block[i] for i,w_name in enumerate(self.columns)}, write_count
+
+    def close(self):
+        """ Closes the memory map of the file """
+        del self._state, self._receive_time, self._data
+        self._mmap.close()
+
+
+def read_ring_buffer_file(filename,n_frames=None):
+    """ Returns the data dictionary of the latest n_frames (default: all) frames in the ring buffer file """
+    ring_buffer = TelemetryRingBuffer(filename)
+    data_dict, _ = ring_buffer.read(n_frames=n_frames)
+    ring_buffer.close()
+    return data_dict
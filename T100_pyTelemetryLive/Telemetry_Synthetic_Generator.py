@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+""" This script generates synthetic telemetry frames and broadcasts them as UDP packets, to exercise the pipeline without the control room.
+
+Usage: Telemetry_Synthetic_Generator.py [FramesPerSecond] [UDP_IP:UDP_PORT]
+
+The frames follow the layout in TelemetryFrameWords.txt, with fixed SYNC words, BCD time stamps, the triangular FPC scan
+with its Up/Down bit in FPS SCAN STATUS, FPS readouts of a spectrum with a C II line from a source on the sky,
+a raster scan in el and Xel, and continuous Frame Number and Time H L counters.
+The SyntheticTelemetryGenerator class is also used by the Benchmark_Pipeline.py benchmark suite.
+"""
+import sys
+import time
+import socket
+import numpy as np
+from Telemetry_Frame_Decoder import load_telemetry_word_file, build_frame_layout, words_to_extract, TELEMETRY_WORD_FILE
+from Telemetry_Frame_Decoder import encode_packet_array, TICKS_PER_DAY
+
+DEFAULT_FRAME_RATE = 1000  # Nominal frames per second, which sets the time stamps of the frames
+SYNC_WORD_VALUES = {'SYNC 0':0x0FAF, 'SYNC 1':0x0320, 'SYNC 2':0x0CDF}
+
+# FPC triangle scan of the fast scan mode (see MAXDIFF, MAXTP, MINTP in Telemetry_CII_Map.py)
+FPC_SAMPLE_GAP = 520
+FPC_MAX_TURNING_POINT = 2580
+FPC_MIN_TURNING_POINT = 1020
+FPC_PHASE = 200  # Unfolded position of the first FPC COUNTER sample along the triangle
+
+# Spectrum seen by the FPS readouts, in 16 bit FPS HL counts
+FPS_CONTINUUM = 20000
+FPS_NOISE = 30
+ATMOSPHERIC_LINE = (1400, 80, -1500)  # (FPC centre, FPC width, amplitude)
+CII_LINE = (2150, 60, 800)  # C II line of the source at the raster centre
+SOURCE_SIZE = 60  # Gaussian width of the source in el/Xel counts
+DOWN_SCAN_OFFSET_FPC = 580  # Down scan spectra are shifted by this (see down_scan_offset_fpc in Telemetry_CII_Map.py)
+
+# Raster scan of the pointing
+RASTER_ROW_FRAMES = 2000  # Frames in each Xel sweep
+RASTER_SIZE = 400  # Peak to peak size of the raster in el/Xel counts
+RASTER_ROWS = 20
+
+TIME_COUNTER_STEP = 10  # Time H L counter ticks per frame
+
+
+class SyntheticTelemetryGenerator(object):
+    """ Generates consecutive synthetic telemetry frames. Each call continues the time stamps, counters and scans from the previous call.
+    The random numbers are seeded, so that the same calls always return the same frames. """
+
+    def __init__(self,frame_rate=DEFAULT_FRAME_RATE,start_day=300.5,seed=0,word_filename=TELEMETRY_WORD_FILE):
+        self.frame_rate = frame_rate
+        self.layout = build_frame_layout(load_telemetry_word_file(word_filename),words_to_extract)
+        self.start_ticks = int(round(start_day*TICKS_PER_DAY))
+        self.rng = np.random.default_rng(seed)
+        self.n_frames = 0  # Frames generated so far
+
+    def frames(self,n_frames):
+        """ Returns the data dictionary of the next n_frames frames, with a uint16 array for each column of the layout """
+        f = np.arange(self.n_frames,self.n_frames+n_frames,dtype=np.int64)
+        self.n_frames += n_frames
+        rng = self.rng
+        data_dict = {}
+        for w_name in self.layout['columns']:
+            data_dict[w_name] = 2048 + rng.normal(0,20,n_frames)  # Default: noisy mid scale value
+        for w_name,value in SYNC_WORD_VALUES.items():
+            data_dict[w_name] = np.full(n_frames,value)
+
+        # BCD time stamps
+        ticks = self.start_ticks + (f*10000)//self.frame_rate
+        data_dict['DAY'] = ticks//TICKS_PER_DAY
+        data_dict['HH'] = ticks//(60*60*10000) % 24
+        data_dict['MM'] = ticks//(60*10000) % 60
+        data_dict['SEC'] = ticks//10000 % 60
+        data_dict['MSEC'] = ticks % 10000
+        data_dict['Frame Number'] = f % 4096
+        time_counter = (f*TIME_COUNTER_STEP) % (4096*4096)
+        data_dict['Time H'] = time_counter//4096
+        data_dict['Time L'] = time_counter % 4096
+        data_dict['Command Address'] = np.full(n_frames,0o1234)
+        data_dict['Command Data'] = np.full(n_frames,0o4321)
+
+        # Raster scan in el and Xel, sweeping Xel back and forth in each row
+        row = (f//RASTER_ROW_FRAMES) % RASTER_ROWS
+        sweep = (f % RASTER_ROW_FRAMES)/RASTER_ROW_FRAMES
+        sweep = np.where(row % 2 == 0,sweep,1-sweep)
+        el = (row/(RASTER_ROWS-1) - 0.5)*RASTER_SIZE
+        xel = (sweep - 0.5)*RASTER_SIZE
+        # el and Xel are swapped in the fine sun sensor words (see average_el_Xel_FPC_FPS)
+        data_dict['Fine Xelev. S. E.'] = 2048 + el + rng.normal(0,2,n_frames)
+        data_dict['Fine Elev. S. E.'] = 2048 + xel + rng.normal(0,2,n_frames)
+        data_dict['S.T. Elev. Error'] = 2048 + rng.normal(0,20,n_frames)
+        data_dict['S.T. Xelev. Error'] = 2048 + rng.normal(0,20,n_frames)
+        source_gain = np.exp(-(el**2 + xel**2)/(2*SOURCE_SIZE**2))
+
+        # Triangular FPC scan. FPS k is read out (k-3)/4 of a frame after the FPC COUNTER sample of FPS 3
+        period = 2*(FPC_MAX_TURNING_POINT-FPC_MIN_TURNING_POINT)
+        for k in range(1,5):
+            unfolded = (FPC_PHASE + (f + (k-3)/4.)*FPC_SAMPLE_GAP) % period
+            up = unfolded < period/2
+            fpc = FPC_MIN_TURNING_POINT + np.where(up,unfolded,period-unfolded)
+            if k == 3:
+                data_dict['FPC COUNTER'] = fpc
+                data_dict['FPS SCAN STATUS'] = np.where(up,0b1100,0b1000)  # Bit 2 is the Up/Down scan bit
+            spectral_fpc = np.where(up,fpc,fpc+DOWN_SCAN_OFFSET_FPC)
+            fps = FPS_CONTINUUM + rng.normal(0,FPS_NOISE,n_frames)
+            centre, width, amplitude = ATMOSPHERIC_LINE
+            fps += amplitude*np.exp(-(spectral_fpc-centre)**2/(2*width**2))
+            centre, width, amplitude = CII_LINE
+            fps += source_gain*amplitude*np.exp(-(spectral_fpc-centre)**2/(2*width**2))
+            fps = np.clip(np.rint(fps),0,65535).astype(np.int64)
+            data_dict['FPS {0} H'.format(k)] = fps//16
+            data_dict['FPS {0} L'.format(k)] = (fps % 16)*16
+        data_dict['DET SIGNAL'] = data_dict['FPS 3 H']//16
+
+        return {w_name:np.clip(np.rint(data_dict[w_name]),0,32767).astype(np.uint16) for w_name in self.layout['columns']}
+
+    def rows(self,n_frames):
+        """ Returns the next n_frames frames as an (n_frames,ncolumns) uint16 array in the column order of the layout """
+        data_dict = self.frames(n_frames)
+        return np.stack([data_dict[w_name] for w_name in self.layout['columns']],axis=1)
+
+    def packets(self,n_frames):
+        """ Returns the next n_frames frames as a list of UDP packets (bytes) """
+        return [packet.tobytes() for packet in encode_packet_array(self.rows(n_frames),self.layout)]
+
+
+def send_packets(sock,packets,address,packets_per_second=None):
+    """ Sends the packets to the address at the packets_per_second rate (as fast as possible if None).
+    Returns the seconds taken to send them """
+    burst = 1 if packets_per_second is None else max(1,int(packets_per_second)//1000)  # Pace the packets about every milli second
+    t0 = time.perf_counter()
+    for i,packet in enumerate(packets):
+        if (packets_per_second is not None) and (i % burst == 0):
+            wait = t0 + i/packets_per_second - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        sock.sendto(packet,address)
+    return time.perf_counter()-t0
+
+if __name__ == '__main__':
+    try:
+        frames_per_second = float(sys.argv[1])
+    except IndexError:
+        frames_per_second = DEFAULT_FRAME_RATE
+    try:
+        udp_ip, udp_port = sys.argv[2].split(':')
+    except IndexError:
+        udp_ip, udp_port = '127.0.0.1', 5000
+    address = (udp_ip,int(udp_port))
+
+    generator = SyntheticTelemetryGenerator(frame_rate=frames_per_second)
+    sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)  # UDP
+    print('Sending synthetic telemetry at {0} frames/s to {1}:{2}. Press Cntrl+C to stop'.format(frames_per_second,*address))
+    n_block = max(1,int(frames_per_second))  # Generate one second of frames at a time
+    try:
+        while True:
+            send_time = send_packets(sock,generator.packets(n_block),address,packets_per_second=frames_per_second)
+            print('Sent {0} frames | {1:.0f} frames/s'.format(generator.n_frames,n_block/send_time),flush=True)
+    except KeyboardInterrupt:
+        print('Stopped')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+""" This module has the UDP receive side of the telemetry capture.
+
+Packets are drained from the socket in batches, so that the socket receive buffer is emptied as fast as possible,
+and the lost frames are counted from the jumps in the 'Frame Number' and the 'Time H' 'Time L' counter words.
+"""
+import socket
+import numpy as np
+
+DEFAULT_RECEIVE_BUFFER_BYTES = 8*1024*1024  # Socket receive buffer (SO_RCVBUF) to survive stalls of the python process
+MAX_PACKET_SIZE = 4096
+
+def open_udp_socket(udp_ip,udp_port,receive_buffer_bytes=DEFAULT_RECEIVE_BUFFER_BYTES,timeout=0.5):
+    """ Returns the UDP socket bound to (udp_ip,udp_port) with the requested receive buffer size.
+    The timeout (seconds) of the blocking receive lets the receiver loop check for a stop request. """
+    sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)  # UDP
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,receive_buffer_bytes)
+    actual_buffer_bytes = sock.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF)
+    if actual_buffer_bytes < receive_buffer_bytes:
+        # Linux caps it at net.core.rmem_max
+        print('WARNING: Socket receive buffer is only {0} bytes. Increase it by: sudo sysctl -w net.core.rmem_max={1}'.format(actual_buffer_bytes,
+                                                                                                                             receive_buffer_bytes))
+    sock.settimeout(timeout)
+    sock.bind((udp_ip,udp_port))
+    return sock
+
+
+def receive_packet_batch(sock,max_batch=256):
+    """ Returns a list of the packets waiting in the socket, up to max_batch packets.
+    Blocks (till the socket timeout) only for the first packet, and then drains the socket without blocking.
+    Returns an empty list if nothing arrived before the timeout."""
+    try:
+        packets = [sock.recv(MAX_PACKET_SIZE)]
+    except socket.timeout:
+        return []
+    while len(packets) < max_batch:
+        try:
+            packets.append(sock.recv(MAX_PACKET_SIZE,socket.MSG_DONTWAIT))
+        except (BlockingIOError, socket.timeout):
+            break
+    return packets
+
+
+class FrameGapDetector(object):
+    """ Counts the frames lost between the received frames, from the jumps in the 'Frame Number' word.
+    The 'Time H' 'Time L' counter is used to count the frames lost in gaps longer than one cycle of the Frame Number."""
+
+    def __init__(self,frame_number_modulus=4096,time_counter_modulus=4096*4096):
+        self.frame_number_modulus = frame_number_modulus
+        self.time_counter_modulus = time_counter_modulus
+        self.time_step = None  # Time counter ticks between consecutive frames, measured from the data
+        self.last_frame_number = None
+        self.last_time_counter = None
+        self.n_frames = 0  # Total frames received
+        self.n_lost = 0  # Total frames lost
+        self.n_gaps = 0  # Number of gaps
+
+    def update(self,frame_number,time_h,time_l):
+        """ Updates the counters with the arrays of the words of new frames. Returns the number of frames lost before and inside them """
+        frame_number = np.asarray(frame_number,dtype=np.int64)
+        time_counter = np.asarray(time_h,dtype=np.int64)*4096 + np.asarray(time_l,dtype=np.int64)
+        n_new = len(frame_number)
+        if n_new == 0:
+            return 0
+        if self.last_frame_number is not None:
+            frame_number = np.r_[self.last_frame_number,frame_number]
+            time_counter = np.r_[self.last_time_counter,time_counter]
+        frame_jump = np.diff(frame_number) % self.frame_number_modulus
+        time_jump = np.diff(time_counter) % self.time_counter_modulus
+        # Learn the time counter step of consecutive frames
+        consecutive = frame_jump == 1
+        if np.any(consecutive):
+            self.time_step = max(1,int(np.median(time_jump[consecutive])))
+        lost = np.where(frame_jump > 0,frame_jump-1,0)
+        if self.time_step is not None:
+            # Frame number jumps wrap around in long gaps, the time counter tells how many cycles were missed
+            lost_from_time = np.rint(time_jump/self.time_step).astype(np.int64) - 1
+            lost = np.where(lost_from_time >= self.frame_number_modulus,lost_from_time,lost)
+        self.last_frame_number = int(frame_number[-1])
+        self.last_time_counter = int(time_counter[-1])
+        n_new_lost = int(np.sum(lost))
+        self.n_frames += n_new
+        self.n_lost += n_new_lost
+        self.n_gaps += int(np.count_nonzero(lost))
+        return n_new_lost
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+""" This script prints the live metrics of the capture, recorder and plot scripts, to check the control room computer is keeping up
+
+Usage: Watch_Pipeline_Metrics.py [RefreshSeconds]
+
+Profiles of the scripts started with profiling enabled are saved as /mnt/tmp_fast/T100_metrics_<name>.pstats
+They can be inspected with: python -m pstats /mnt/tmp_fast/T100_metrics_<name>.pstats
+"""
+import sys
+import time
+from Telemetry_Metrics import read_all_metrics
+
+def format_metrics(metrics):
+    """ Returns the printable lines of one script's metrics summary """
+    age = time.time() - metrics['time']
+    lines = ['== {0} (pid {1}) up {2:.0f} s, updated {3:.1f} s ago'.format(metrics['name'],metrics['pid'],metrics['uptime'],age)]
+    for c_name,value in sorted(metrics['counters'].items()):
+        rate = value/metrics['uptime'] if metrics['uptime'] > 0 else 0
+        lines.append('   {0:<32s} {1:>12d}  ({2:.1f}/s)'.format(c_name,value,rate))
+    for g_name,value in sorted(metrics['gauges'].items()):
+        lines.append('   {0:<32s} {1:>12.6g}'.format(g_name,value))
+    for h_name,summary in sorted(metrics['histograms'].items()):
+        if summary['count'] == 0:
+            continue
+        lines.append('   {0:<32s} n={1:<8d} mean={2:8.2f} ms  p50<{3:8.2f} ms  p99<{4:8.2f} ms  max={5:8.2f} ms'.format(h_name,summary['count'],
+                                                                                                                    summary['mean']*1e3,summary['p50']*1e3,
+                                                                                                                    summary['p99']*1e3,summary['max']*1e3))
+    return lines
+
+if __name__ == '__main__':
+    try:
+        refresh_seconds = float(sys.argv[1])
+    except IndexError:
+        refresh_seconds = 1.
+    while True:
+        lines = []
+        for metrics in read_all_metrics():
+            lines.extend(format_metrics(metrics))
+        print('\033[2J\033[H' + '\n'.join(lines),flush=True)  # Clear the terminal and print
+        time.sleep(refresh_seconds)
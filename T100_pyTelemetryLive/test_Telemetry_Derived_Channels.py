@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" Tests of the derived channels written beside a recording against the processing of its raw words
+
+Usage: python -m pytest test_Telemetry_Derived_Channels.py
+"""
+import numpy as np
+from Telemetry_Synthetic_Generator import SyntheticTelemetryGenerator
+from Telemetry_Recording_File import RecordingWriter, read_recording_file
+from Telemetry_Derived_Channels import DerivedChannelWriter, read_derived_channels, build_derived_channels, DERIVED_CHANNELS, TIME_CHANNEL
+from Telemetry_Processing import process_raw_data_dict
+from Telemetry_Frame_Decoder import timestamp_ticks
+
+CHUNK_FRAMES = 100
+
+def write_recording(filename,batch_sizes):
+    """ Writes the synthetic frames appended in batches of batch_sizes into the recording and its derived channels, like the recorder does.
+    The FPS 1 words of some frames are at their maximum, where the FPS 1 HL values no longer fit in 16 bits.
+    Returns the (FPC triangle waveform parameters of the derived channels, data dictionary of all the frames written) """
+    generator = SyntheticTelemetryGenerator(seed=0)
+    batches = [generator.frames(n_frames) for n_frames in batch_sizes]
+    for batch in batches:
+        batch['FPS 1 H'] = batch['FPS 1 H'].copy()
+        batch['FPS 1 L'] = batch['FPS 1 L'].copy()
+        batch['FPS 1 H'][::7] = 4095
+        batch['FPS 1 L'][::7] = 4095
+    writer = RecordingWriter(filename,generator.layout['columns'],chunk_frames=CHUNK_FRAMES)
+    derived_writer = DerivedChannelWriter(filename)
+    for batch in batches:
+        writer.append(batch)
+        derived_writer.append(batch)
+    writer.close()
+    derived_writer.close()
+    return derived_writer.waveform.parameters(), {w_name:np.concatenate([batch[w_name] for batch in batches]) for w_name in writer.columns}
+
+
+def expected_channels(data_dict,waveform):
+    """ Returns the dictionary of the derived channels computed from the raw words by process_raw_data_dict, in the dtypes of the channel files """
+    processed_dict = process_raw_data_dict({w_name:np.asarray(values,dtype=np.int64) for w_name,values in data_dict.items()},*waveform)
+    processed_dict[TIME_CHANNEL] = timestamp_ticks(data_dict)
+    for name in ['el','xel']:
+        processed_dict[name] = DERIVED_CHANNELS[name][2](processed_dict)
+    return {name:np.asarray(processed_dict[name]).astype(DERIVED_CHANNELS[name][0]) for name in DERIVED_CHANNELS}
+
+
+def assert_channels_equal(channels_dict,expected_dict):
+    """ Checks every derived channel against the expected values """
+    assert set(channels_dict) == set(expected_dict)
+    for name in expected_dict:
+        assert np.array_equal(channels_dict[name],expected_dict[name]), name
+
+
+def test_derived_channels_match_processing(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    waveform, data_dict = write_recording(filename,[300,250,450])
+    channels_dict = read_derived_channels(filename,list(DERIVED_CHANNELS))
+    assert_channels_equal(channels_dict,expected_channels(data_dict,waveform))
+    assert channels_dict['FPS 1 HL'].max() == 4095*16+4095//16
+
+
+def test_build_derived_channels(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    waveform, _ = write_recording(filename,[1000])
+    # Computed again from the recording, e.g. for an old or converted recording
+    assert build_derived_channels(filename) == 1000
+    assert_channels_equal(read_derived_channels(filename,list(DERIVED_CHANNELS)),expected_channels(read_recording_file(filename),waveform))
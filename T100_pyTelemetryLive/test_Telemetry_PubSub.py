@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+""" Tests of the live frame reader on the publish/subscribe channel: the overlap with the first read of the FIFO, and the batches dropped by the publisher
+
+Usage: python -m pytest test_Telemetry_PubSub.py
+"""
+import time
+import numpy as np
+from Telemetry_Ring_Buffer import TelemetryRingBuffer
+from Telemetry_PubSub import TelemetryPublisher, LiveFrameReader, pubsub_socket_path
+
+COLUMNS = ['DAY','FRAME']
+
+def capture(ring_buffer,publisher,n_frames,publish=True):
+    """ Appends n_frames frames numbered by their write count to the FIFO, and publishes them unless publish is False (dropped by the publisher) """
+    frame_numbers = np.arange(ring_buffer.write_count,ring_buffer.write_count+n_frames)
+    rows = np.stack([np.full(n_frames,300),frame_numbers],axis=1)
+    ring_buffer.append(rows,receive_time=time.time())
+    if publish:
+        publisher.publish(rows,ring_buffer.write_count,time.time())
+
+
+def read_frames(reader,n_expected,timeout=5.):
+    """ Returns the frame numbers of the reads of the reader till n_expected frames are read """
+    frame_numbers = []
+    end_time = time.time() + timeout
+    while (len(frame_numbers) < n_expected) and (time.time() < end_time):
+        frame_numbers.extend(reader.read()['FRAME'].tolist())
+        time.sleep(0.01)
+    return frame_numbers
+
+
+def start_capture(tmp_path):
+    """ Returns the (ring buffer, publisher, reader subscribed to it) of a new capture """
+    ring_buffer_filename = str(tmp_path/'ring_buffer.dat')
+    ring_buffer = TelemetryRingBuffer.create(ring_buffer_filename,COLUMNS,1000)
+    publisher = TelemetryPublisher(pubsub_socket_path(ring_buffer_filename),COLUMNS)
+    reader = LiveFrameReader(ring_buffer_filename)
+    end_time = time.time() + 5.
+    while (publisher.n_subscribers == 0) and (time.time() < end_time):
+        time.sleep(0.01)
+    return ring_buffer, publisher, reader
+
+
+def test_overlap_with_first_read(tmp_path):
+    ring_buffer, publisher, reader = start_capture(tmp_path)
+    capture(ring_buffer,publisher,10)
+    # The first read takes the frames already in the FIFO, which are also queued for the subscriber
+    assert reader.read()['FRAME'].tolist() == list(range(10))
+    capture(ring_buffer,publisher,5)
+    assert read_frames(reader,5) == list(range(10,15))
+    reader.close()
+    publisher.close()
+
+
+def test_dropped_batches_read_from_fifo(tmp_path):
+    ring_buffer, publisher, reader = start_capture(tmp_path)
+    assert len(reader.read()['FRAME']) == 0
+    capture(ring_buffer,publisher,10)
+    capture(ring_buffer,publisher,7,publish=False)
+    capture(ring_buffer,publisher,5)
+    capture(ring_buffer,publisher,3)
+    assert read_frames(reader,25) == list(range(25))
+    capture(ring_buffer,publisher,4)
+    assert read_frames(reader,4) == list(range(25,29))
+    reader.close()
+    publisher.close()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+""" Tests of the chunked recording file format: the reader against the writer, and its handling of corrupted and truncated files
+
+Usage: python -m pytest test_Telemetry_Recording_File.py
+"""
+import os
+import numpy as np
+from Telemetry_Synthetic_Generator import SyntheticTelemetryGenerator
+from Telemetry_Recording_File import RecordingWriter, read_recording_file, read_recording_ticks, is_recording_file, CHUNK_HEADER_SIZE
+from Telemetry_Frame_Decoder import timestamp_ticks, TICKS_PER_DAY
+
+CHUNK_FRAMES = 100
+
+def write_recording(filename,batch_sizes,flush_after=()):
+    """ Writes the synthetic frames appended in batches of batch_sizes into the recording, flushing after the batch numbers in flush_after.
+    Returns the data dictionary of all the frames written """
+    generator = SyntheticTelemetryGenerator(seed=0)
+    batches = [generator.frames(n_frames) for n_frames in batch_sizes]
+    writer = RecordingWriter(filename,generator.layout['columns'],chunk_frames=CHUNK_FRAMES)
+    for i,batch in enumerate(batches):
+        writer.append(batch)
+        if i in flush_after:
+            writer.flush()
+    writer.close()
+    return {w_name:np.concatenate([batch[w_name] for batch in batches]) for w_name in writer.columns}
+
+
+def read_index_records(filename):
+    """ Returns the (chunk data offset, number of frames, first ticks, last ticks) records of the time index file """
+    with open(filename+'.idx','rb') as indexfile:
+        indexfile.read(8)
+        return np.frombuffer(indexfile.read(),dtype='<i8').reshape(-1,4)
+
+
+def assert_frames_equal(data_dict,expected_dict):
+    """ Checks that the frames read are the expected frames """
+    for w_name in expected_dict:
+        assert np.array_equal(data_dict[w_name],expected_dict[w_name]), w_name
+    assert np.array_equal(data_dict['TIME TICKS'],timestamp_ticks(expected_dict))
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    expected_dict = write_recording(filename,[37,100,250,13])
+    assert is_recording_file(filename)
+    assert_frames_equal(read_recording_file(filename),expected_dict)
+    # Only full chunks, except the last one written by close()
+    assert list(read_index_records(filename)[:,1]) == [100,100,100,100]
+    assert np.array_equal(read_recording_ticks(filename),timestamp_ticks(expected_dict))
+
+
+def test_flush_writes_short_chunk(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    expected_dict = write_recording(filename,[150,150],flush_after=(0,))
+    assert list(read_index_records(filename)[:,1]) == [100,50,100,50]
+    assert_frames_equal(read_recording_file(filename),expected_dict)
+
+
+def test_time_window_and_since_ticks(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    expected_dict = write_recording(filename,[1000])
+    time_ticks = timestamp_ticks(expected_dict)
+    start_time, end_time = time_ticks[250]/TICKS_PER_DAY, time_ticks[649]/TICKS_PER_DAY
+    data_dict = read_recording_file(filename,start_time=start_time,end_time=end_time)
+    assert_frames_equal(data_dict,{w_name:expected_dict[w_name][250:650] for w_name in expected_dict})
+    data_dict = read_recording_file(filename,since_ticks=int(time_ticks[899]))
+    assert_frames_equal(data_dict,{w_name:expected_dict[w_name][900:] for w_name in expected_dict})
+
+
+def test_crc_corruption_skips_chunk(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    expected_dict = write_recording(filename,[300])
+    # Flip a byte in the frames of the second chunk
+    corrupt_offset = int(read_index_records(filename)[1,0]) + 8*CHUNK_FRAMES + 11
+    with open(filename,'r+b') as recfile:
+        recfile.seek(corrupt_offset)
+        byte = recfile.read(1)
+        recfile.seek(corrupt_offset)
+        recfile.write(bytes([byte[0] ^ 0xFF]))
+    data_dict = read_recording_file(filename)
+    kept = np.r_[0:100,200:300]
+    assert_frames_equal(data_dict,{w_name:expected_dict[w_name][kept] for w_name in expected_dict})
+
+
+def test_truncated_file_without_index(tmp_path):
+    filename = str(tmp_path/'recording.tlm')
+    expected_dict = write_recording(filename,[300])
+    # Crash in the middle of writing the last chunk, before its index record
+    last_chunk_offset = int(read_index_records(filename)[2,0])
+    with open(filename,'r+b') as recfile:
+        recfile.truncate(last_chunk_offset + 100)
+    os.remove(filename+'.idx')
+    data_dict = read_recording_file(filename)
+    assert_frames_equal(data_dict,{w_name:expected_dict[w_name][:200] for w_name in expected_dict})
+    # A chunk header cut in the middle is also ignored
+    with open(filename,'r+b') as recfile:
+        recfile.truncate(last_chunk_offset - CHUNK_HEADER_SIZE + 10)
+    assert_frames_equal(read_recording_file(filename),{w_name:expected_dict[w_name][:200] for w_name in expected_dict})